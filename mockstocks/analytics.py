@@ -0,0 +1,376 @@
+import click
+import math
+
+from db import connect_app, immediate_transaction
+from helpers import from_cents
+
+
+## Cost basis and P&L analytics computed over history as columnar NumPy arrays, never row by row.    ##
+## Trades are grouped into holdings (user_id, ticker), oldest first within each holding. All money   ##
+## is in cents until formatted for display.                                                        ##
+##   holding_basis   - incremental average-cost basis (shares, cost, realized) kept up to date by   ##
+##                     every buy and sell, so the dashboard never replays history                   ##
+##   history_rollups - per holding totals of the trades archived out of history (see              ##
+##                     maintenance.py), added back in wherever history is replayed                  ##
+## NumPy is imported inside the functions using it: trades only need the SQL bookkeeping, so        ##
+## workers start without loading it and pay for it on the first analytics page instead.             ##
+
+# Newest sells listed with their realized P&L on the analytics page
+ANALYTICS_SELLS_SHOWN = 50
+
+# Columns of history_rollups, in this order. Money is in cents, growth is the summed log price change
+# over the periods shares were held (see time_weighted_returns)
+ROLLUP_COLUMNS = "user_id, ticker, trades, spent, received, realized_average, realized_fifo, growth, first_at, last_at"
+
+rollup_user_id_ind, rollup_ticker_ind, rollup_trades_ind, rollup_spent_ind, rollup_received_ind, rollup_realized_average_ind, \
+    rollup_realized_fifo_ind, rollup_growth_ind, rollup_first_at_ind, rollup_last_at_ind = range(10)
+
+
+def record_buy_basis(dbcon, user_id, symbol, shares, price):
+    """Add a buy (price in cents) to the holding's average-cost basis, inside the trade's transaction."""
+    dbcon.execute("INSERT INTO holding_basis (user_id, symbol, shares, cost, realized) VALUES (?, ?, ?, ?, 0) "
+                  "ON CONFLICT (user_id, symbol) DO UPDATE SET shares = shares + excluded.shares, cost = cost + excluded.cost",
+                  (user_id, symbol, shares, shares * price,))
+
+
+def record_sell_basis(dbcon, user_id, symbol, shares, price):
+    """
+    Take a sell (price in cents) out of the holding's average-cost basis, inside the trade's transaction.
+
+    The sold shares leave at the average cost, the difference to the sale
+    price is added to the realized P&L.
+    """
+    dbcon.execute("UPDATE holding_basis SET "
+                  "realized = realized + ? - CAST(ROUND(cost * ? * 1.0 / shares) AS INTEGER), "
+                  "cost = cost - CAST(ROUND(cost * ? * 1.0 / shares) AS INTEGER), "
+                  "shares = shares - ? "
+                  "WHERE user_id = ? AND symbol = ? AND shares > 0",
+                  (shares * price, shares, shares, shares, user_id, symbol,))
+
+
+def load_history(sql_cursor, user_id=None):
+    """
+    Load the history of one user (or everyone) as columnar arrays, ordered by holding then time.
+
+    Returns a dictionary of equally long arrays: user_id, ticker, timestamp,
+    buy (bool), shares, price (cents) and transaction_id.
+    """
+    import numpy as np
+
+    where, params = ("WHERE user_id = ? ", (user_id,)) if user_id is not None else ("", ())
+    rows = sql_cursor.execute(f"SELECT user_id, ticker, timestamp, order_type, shares, price, transaction_id FROM history {where}"
+                              "ORDER BY user_id, ticker, timestamp, transaction_id", params).fetchall()
+
+    columns = list(zip(*rows)) if rows else [()] * 7
+    return {
+        "user_id": np.array(columns[0], dtype=np.int64),
+        "ticker": np.array(columns[1], dtype=object),
+        "timestamp": np.array(columns[2], dtype=object),
+        "buy": np.array(columns[3], dtype=object) == "buy",
+        "shares": np.array(columns[4], dtype=np.int64),
+        "price": np.array(columns[5], dtype=np.float64),
+        "transaction_id": np.array(columns[6], dtype=np.int64),
+    }
+
+
+def load_rollups(sql_cursor, user_id):
+    """Return {ticker: rollup row} of the trades archived out of one user's history."""
+    rows = sql_cursor.execute(f"SELECT {ROLLUP_COLUMNS} FROM history_rollups WHERE user_id = ?", (user_id,)).fetchall()
+    return {row[rollup_ticker_ind]: row for row in rows}
+
+
+def _affine_scan(alpha, beta):
+    """
+    Solve x[k] = alpha[k] * x[k - 1] + beta[k] (with x[-1] = 0) for every k.
+
+    Affine maps compose associatively, so a log-step prefix scan gets every
+    x[k] in log2(n) vectorized passes instead of one Python step per trade.
+    """
+    alpha, beta = alpha.copy(), beta.copy()
+    step = 1
+    while step < len(alpha):
+        beta[step:] = alpha[step:] * beta[:-step] + beta[step:]
+        alpha[step:] = alpha[step:] * alpha[:-step]
+        step *= 2
+    return beta
+
+
+def _grouped_cumsum(values, first, group):
+    """Running sum of values restarting at every holding's first trade."""
+    import numpy as np
+
+    total = np.cumsum(values)
+    return total - (total - values)[first][group]
+
+
+def cost_basis(history):
+    """
+    Compute FIFO and average-cost basis and realized P&L over history from load_history.
+
+    Returns (holdings, trades): holdings holds one array entry per holding,
+    trades one per history row (realized P&L is zero for buys).
+    """
+    import numpy as np
+
+    buy, shares, price = history["buy"], history["shares"], history["price"]
+    n = len(shares)
+
+    # Holding boundaries: a trade starts a new holding when its user or ticker differs from the previous one
+    first = np.ones(n, dtype=bool)
+    first[1:] = (history["user_id"][1:] != history["user_id"][:-1]) | (history["ticker"][1:] != history["ticker"][:-1])
+    group = np.cumsum(first) - 1
+    starts = np.flatnonzero(first)
+    last = np.append(starts[1:], n)[:len(starts)] - 1
+
+    # Shares held after each trade, and before it
+    signed = np.where(buy, shares, -shares)
+    position = _grouped_cumsum(signed, first, group)
+    previous = position - signed
+
+    # Average cost per share after each trade. Buys blend in at their price, sells leave it unchanged,
+    # buying into an empty holding (alpha 0) starts over
+    alpha = np.where(buy, np.divide(previous, position, out=np.zeros(n), where=position > 0), 1.0)
+    beta = np.where(buy, np.divide(shares * price, position, out=np.zeros(n), where=position > 0), 0.0)
+    average = _affine_scan(alpha, beta)
+    average_before = np.where(first, 0.0, np.roll(average, 1))
+    realized_average = np.where(buy, 0.0, shares * (price - average_before))
+
+    # FIFO: the first S shares sold of a holding always come from its first S shares bought, so each sell's
+    # cost is the difference of the cumulative buy cost curve, interpolated at the cumulative shares sold
+    bought = np.cumsum(np.where(buy, shares, 0))
+    spent = np.cumsum(np.where(buy, shares * price, 0.0))
+    curve_shares = np.concatenate(([0], bought[buy]))
+    curve_cost = np.concatenate(([0.0], spent[buy]))
+    base = (bought - np.where(buy, shares, 0))[first][group]
+    sold = _grouped_cumsum(np.where(buy, 0, shares), first, group)
+    consumed = np.interp(base + sold, curve_shares, curve_cost)
+    fifo_cost = consumed - np.interp(base + sold - np.where(buy, 0, shares), curve_shares, curve_cost)
+    realized_fifo = np.where(buy, 0.0, shares * price - fifo_cost)
+
+    holdings = {
+        "user_id": history["user_id"][starts],
+        "ticker": history["ticker"][starts],
+        "shares": position[last],
+        "average_cost": np.where(position[last] > 0, average[last], 0.0),
+        "average_basis": position[last] * average[last],
+        "fifo_basis": spent[last] - consumed[last],
+        "realized_average": np.add.reduceat(realized_average, starts) if n else np.zeros(0),
+        "realized_fifo": np.add.reduceat(realized_fifo, starts) if n else np.zeros(0),
+        "last_price": price[last],
+        "starts": starts,
+    }
+    trades = {"realized_average": realized_average, "realized_fifo": realized_fifo, "previous": previous, "first": first}
+    return holdings, trades
+
+
+def _period_growth(history, trades):
+    """Log price change of every holding period ending at a trade, zero where no shares were held."""
+    import numpy as np
+
+    price = history["price"]
+    held = ~trades["first"] & (trades["previous"] > 0)
+    growth = np.zeros(len(price))
+    growth[held] = np.log(price[held] / np.roll(price, 1)[held])
+    return growth
+
+
+def time_weighted_returns(history, holdings, trades, prices):
+    """
+    Time-weighted return of every holding.
+
+    Each holding period between two trades returns the price change between
+    them, the last one runs from the last trade to the current price
+    ({symbol: cents}, holdings without one end at their last trade). Periods
+    are chained, so money moved in and out by the trades themselves does not
+    distort the return.
+    """
+    import numpy as np
+
+    price = history["price"]
+    growth = _period_growth(history, trades)
+    total = np.add.reduceat(growth, holdings["starts"]) if len(price) else np.zeros(0)
+
+    current = np.array([prices.get(ticker) or last for ticker, last in zip(holdings["ticker"], holdings["last_price"])],
+                       dtype=np.float64)
+    total += np.where(holdings["shares"] > 0, np.log(current / holdings["last_price"]), 0.0)
+    return np.expm1(total)
+
+
+def portfolio_analytics(sql_cursor, user_id, cash, prices):
+    """
+    Cost basis, P&L and returns of one user for display, in dollars.
+
+    cash is the user's cash and prices the current {symbol: price} of their
+    holdings, both in cents. Returns (holdings, sells, summary).
+    """
+    import numpy as np
+
+    history = load_history(sql_cursor, user_id)
+    basis, trades = cost_basis(history)
+    returns = time_weighted_returns(history, basis, trades, prices)
+
+    # Totals of archived trades by ticker, added to the holdings replayed from history
+    rollups = load_rollups(sql_cursor, user_id)
+
+    holdings = []
+    for i, ticker in enumerate(basis["ticker"]):
+        shares = int(basis["shares"][i])
+        value = shares * prices[ticker] if prices.get(ticker) is not None else None
+        realized_average, realized_fifo, twr = basis["realized_average"][i], basis["realized_fifo"][i], float(returns[i])
+        if ticker in rollups:
+            realized_average += rollups[ticker][rollup_realized_average_ind]
+            realized_fifo += rollups[ticker][rollup_realized_fifo_ind]
+            twr = math.expm1(math.log1p(twr) + rollups[ticker][rollup_growth_ind])
+        holdings.append({
+            "ticker": ticker,
+            "shares": shares,
+            "average_cost": from_cents(basis["average_cost"][i]),
+            "average_basis": from_cents(basis["average_basis"][i]),
+            "fifo_basis": from_cents(basis["fifo_basis"][i]),
+            "value": from_cents(value) if value is not None else None,
+            "unrealized_average": from_cents(value - basis["average_basis"][i]) if value is not None else None,
+            "unrealized_fifo": from_cents(value - basis["fifo_basis"][i]) if value is not None else None,
+            "realized_average": from_cents(realized_average),
+            "realized_fifo": from_cents(realized_fifo),
+            "twr": twr,
+        })
+
+    # Holdings whose trades were all archived were closed out, only their realized P&L and return remain
+    for ticker in rollups.keys() - set(basis["ticker"].tolist()):
+        rollup = rollups[ticker]
+        holdings.append({
+            "ticker": ticker,
+            "shares": 0,
+            "average_cost": 0.0,
+            "average_basis": 0.0,
+            "fifo_basis": 0.0,
+            "value": 0.0,
+            "unrealized_average": 0.0,
+            "unrealized_fifo": 0.0,
+            "realized_average": from_cents(rollup[rollup_realized_average_ind]),
+            "realized_fifo": from_cents(rollup[rollup_realized_fifo_ind]),
+            "twr": math.expm1(rollup[rollup_growth_ind]),
+        })
+    holdings.sort(key=lambda holding: holding["ticker"])
+
+    # Newest ANALYTICS_SELLS_SHOWN sells first, picked by timestamp (then transaction id) before building any row
+    sold = np.flatnonzero(~history["buy"])
+    newest = np.lexsort((history["transaction_id"][sold], history["timestamp"][sold].astype(str)))
+    sells = []
+    for i in sold[newest[::-1][:ANALYTICS_SELLS_SHOWN]]:
+        sells.append({
+            "timestamp": history["timestamp"][i],
+            "ticker": history["ticker"][i],
+            "shares": int(history["shares"][i]),
+            "price": from_cents(history["price"][i]),
+            "realized_average": from_cents(trades["realized_average"][i]),
+            "realized_fifo": from_cents(trades["realized_fifo"][i]),
+        })
+
+    # Accounts never receive deposits or withdrawals, so the time-weighted return of the whole account
+    # is simply its current value over its opening cash (cash before any trade)
+    spent = float(np.sum(np.where(history["buy"], history["shares"] * history["price"], 0.0)))
+    received = float(np.sum(np.where(history["buy"], 0.0, history["shares"] * history["price"])))
+    spent += sum(rollup[rollup_spent_ind] for rollup in rollups.values())
+    received += sum(rollup[rollup_received_ind] for rollup in rollups.values())
+    opening = cash + spent - received
+    value = cash + sum(holding["shares"] * prices[holding["ticker"]] for holding in holdings
+                       if prices.get(holding["ticker"]) is not None)
+    summary = {
+        "realized_average": sum(holding["realized_average"] for holding in holdings),
+        "realized_fifo": sum(holding["realized_fifo"] for holding in holdings),
+        "twr": value / opening - 1 if opening else 0.0,
+    }
+
+    return holdings, sells, summary
+
+
+def archive_rollups(history, holdings, trades, before):
+    """
+    Find the trades of every holding that can leave history: those up to its
+    last trade before the timestamp before that left it without shares.
+
+    Replaying a holding from such a point gives the same basis as replaying all
+    of it, so only the totals of the archived trades need to be kept. Returns
+    one (user_id, ticker, through transaction_id, rollup values) tuple per
+    holding with trades to archive, where rollup values follow ROLLUP_COLUMNS
+    from trades on.
+    """
+    import numpy as np
+
+    buy, shares, price = history["buy"], history["shares"], history["price"]
+    n = len(shares)
+    if not n:
+        return []
+
+    starts = holdings["starts"]
+    group = np.cumsum(trades["first"]) - 1
+    index = np.arange(n)
+
+    # Last trade of each holding, before the cutoff, after which no shares were left. Holdings that ever went
+    # short (which only old data can hold) are kept whole, replaying part of them would change their basis
+    position = trades["previous"] + np.where(buy, shares, -shares)
+    went_short = np.maximum.reduceat(position < 0, starts)[group]
+    flat = (position == 0) & ~went_short & (history["timestamp"] < before)
+    through = np.maximum.reduceat(np.where(flat, index, -1), starts)
+    archived = index <= through[group]
+
+    def total(values):
+        return np.add.reduceat(np.where(archived, values, 0), starts)
+
+    counts = total(np.ones(n, dtype=np.int64))
+    spent = total(np.where(buy, shares * price, 0.0))
+    received = total(np.where(buy, 0.0, shares * price))
+    realized_average = total(trades["realized_average"])
+    realized_fifo = total(trades["realized_fifo"])
+    growth = total(_period_growth(history, trades))
+
+    rollups = []
+    for i in np.flatnonzero(counts):
+        rollups.append((int(holdings["user_id"][i]), holdings["ticker"][i], int(history["transaction_id"][through[i]]),
+                        (int(counts[i]), int(round(spent[i])), int(round(received[i])), int(round(realized_average[i])),
+                         int(round(realized_fifo[i])), float(growth[i]), history["timestamp"][starts[i]],
+                         history["timestamp"][through[i]])))
+    return rollups
+
+
+def fill_basis(dbcon, user_id=None):
+    """Recompute the average-cost basis table from history inside the caller's transaction."""
+    import numpy as np
+
+    history = load_history(dbcon.cursor(), user_id)
+    basis, trades = cost_basis(history)
+
+    where, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    dbcon.execute(f"DELETE FROM holding_basis {where}", params)
+    dbcon.executemany("INSERT INTO holding_basis (user_id, symbol, shares, cost, realized) VALUES (?, ?, ?, ?, ?)",
+                      zip(basis["user_id"].tolist(), basis["ticker"].tolist(), basis["shares"].tolist(),
+                          np.rint(basis["average_basis"]).astype(np.int64).tolist(),
+                          np.rint(basis["realized_average"]).astype(np.int64).tolist()))
+
+
+def fill_rollup_basis(dbcon, user_id=None):
+    """
+    Add the realized P&L of archived trades to the basis table inside the
+    caller's transaction, after fill_basis has rebuilt it from what is left of history.
+    """
+    where, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("WHERE true", ())
+    dbcon.execute("INSERT INTO holding_basis (user_id, symbol, shares, cost, realized) "
+                  f"SELECT user_id, ticker, 0, 0, realized_average FROM history_rollups {where} "
+                  "ON CONFLICT (user_id, symbol) DO UPDATE SET realized = realized + excluded.realized", params)
+
+
+def init_analytics_app(app):
+    """Register the basis rebuild CLI command on app."""
+
+    @app.cli.command("rebuild-basis")
+    def rebuild_basis_command():
+        """Recompute every holding's average-cost basis from history and the archived trade rollups."""
+        dbcon = connect_app(app)
+        try:
+            with immediate_transaction(dbcon):
+                fill_basis(dbcon)
+                fill_rollup_basis(dbcon)
+        finally:
+            dbcon.close()
+        click.echo("Cost basis rebuilt")
@@ -1,26 +1,51 @@
+import hmac
 import os
-import sqlite3
-import datetime
+import time
 
-from flask import Flask, flash, redirect, render_template, request, session
-from flask_session import Session
+from analytics import portfolio_analytics
+from flask import (Blueprint, Flask, Response, before_render_template, current_app, flash, g, jsonify, make_response,
+                   redirect, render_template, request, session, stream_template, template_rendered, url_for)
 from tempfile import mkdtemp
-from werkzeug.security import check_password_hash, generate_password_hash
-from helpers import apology, login_required, lookup, usd
+from baskets import execute_basket, parse_basket_csv, parse_basket_form
+from budget import PRIORITY_TRADE
+from caching import cache_control, not_modified, page_etag
+from db import get_db
+from exports import EXPORT_FORMATS, export_response, iter_rows
+from helpers import MarketDataUnavailable, apology, from_cents, login_required, lookup, lookup_many, to_cents, usd
+from leaderboard import leaderboard_computed_at_ind, leaderboard_rank_ind, leaderboard_username_ind, leaderboard_value_ind
+from ledger import (HISTORY_COLUMNS, history_page, history_where, ledger_order_type_ind, ledger_price_ind,
+                    ledger_shares_ind, ledger_ticker_ind, ledger_timestamp_ind, ledger_transaction_id_ind,
+                    parse_history_filters)
+from live import portfolio_events
+from metrics import record_operation, registry, request_duration, requests_total, slow_request_report, timed
+from orders import (ORDER_COLUMNS, cancel_order, order_closed_at_ind, order_fill_price_ind, order_id_ind,
+                    order_kind_ind, order_note_ind, order_placed_at_ind, order_shares_ind, order_side_ind, order_status_ind,
+                    order_symbol_ind, order_trigger_price_ind, place_order)
+from passwords import HasherBusy
+from trades import TradeError, execute_buy, execute_sell
+from valuations import (DASHBOARD_QUERY, dashboard_cash_ind, dashboard_company_ind, dashboard_cost_ind,
+                        dashboard_price_ind, dashboard_priced_at_ind, dashboard_shares_ind, dashboard_symbol_ind,
+                        dashboard_username_ind)
+from valuations import rebuild as rebuild_valuations
 
 # NOTE: use the following to use the data provided by IEX.
 #       Replace KEY with your own key
 # export API_KEY=KEY
+#
+#       or replay a recorded quote tape offline (no key needed)
+# export MARKET_DATA_PROVIDER=replay MARKET_DATA_TAPE=quotes.csv.gz
 
 ## The following is the schema of the database 'finance.db' being used in this app.               ##
 ## The variables shown after each table are used for data fetching/writing with the SQL database  ##
 ## which provides clarity about what data is being queried                                        ##
+## Money (users.cash, history.price) is stored as integer cents. The schema is created/upgraded   ##
+## by the numbered steps in migrations.py and tracked in the schema_version table                 ##
 
 # CREATE TABLE users (
 #     id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
 #     username TEXT NOT NULL,
 #     hash TEXT NOT NULL,
-#     cash NUMERIC NOT NULL DEFAULT 10000.00
+#     cash INTEGER NOT NULL DEFAULT 1000000
 #     );
 
 users_id_ind, users_username_ind, users_hash_ind, users_cash_ind = range(4)
@@ -33,10 +58,12 @@ users_id_ind, users_username_ind, users_hash_ind, users_cash_ind = range(4)
 #   user_id INTEGER NOT NULL,
 #   order_type TEXT NOT NULL CHECK (order_type IN ('sell', 'buy')),
 #   ticker TEXT NOT NULL,
-#   shares NUMERIC NOT NULL,
-#   price NUMERIC NOT NULL,
+#   shares INTEGER NOT NULL,
+#   price INTEGER NOT NULL,
 #   timestamp DATETIME NOT NULL
 # );
+# CREATE INDEX history_user_timestamp ON history (user_id, timestamp, transaction_id);
+# Old trades are moved out into an archive database by the maintenance job (see maintenance.py)
 
 history_transaction_id_ind, history_user_id_ind, history_order_type_ind, history_ticker_ind, history_shares_ind, history_price_ind, history_timestamp_ind = range(7)
 
@@ -47,100 +74,370 @@ history_transaction_id_ind, history_user_id_ind, history_order_type_ind, history
 #   company TEXT NOT NULL,
 #   total_shares NUMERIC NOT NULL
 # );
+# CREATE UNIQUE INDEX portfolio_user_symbol ON portfolio (user_id, symbol);
+# A holding is deleted by the sell that leaves it without shares
+
+# Account valuation snapshots (symbol_prices, holding_values, account_values) are described in valuations.py
 
 portfolio_holding_id_ind, portfolio_user_id_ind, portfolio_symbol_ind, portfolio_company_ind, portfolio_total_shares_ind = range(5)
 
-# Configure application
-app = Flask(__name__)
+# Views of the app, registered on it by create_app
+views = Blueprint("views", __name__)
+
+
+def create_app(config=None):
+    """
+    Create and configure the app.
+
+    config overrides settings, every other setting is read from the
+    environment. Before the first request the app restores the quote snapshot
+    and prepares the hot SQL statements on its pooled connections; how long
+    each startup phase took is logged and exposed on /metrics.
+    """
+
+    # Modules only needed to wire the app up are imported here, so importing this module stays cheap
+    from analytics import init_analytics_app
+    from caching import init_caching_app
+    from db import connect_app, init_db_app
+    from helpers import configure_market_data, configure_quote_cache, configure_request_budget, market_data_metrics
+    from leaderboard import init_leaderboard_app
+    from live import init_live_app
+    from maintenance import init_maintenance_app
+    from migrations import HOT_QUERIES, init_migrations_app
+    from orders import init_orders_app
+    from passwords import PasswordHasher
+    from providers import create_provider
+    from scheduler import Scheduler
+    from sessions import SQLiteSessionInterface
+    from symbols import init_symbols_app
+    from valuations import init_valuations_app
+    from warmstart import StartupTimer, init_warm_start_app
+
+    timer = StartupTimer()
+
+    # Configure application
+    app = Flask(__name__)
+    app.config.update(config or {})
+
+    # Custom filter
+    app.jinja_env.filters["usd"] = usd
+
+    # Pages are not stored by browsers unless their route says otherwise, static files get fingerprinted URLs
+    init_caching_app(app)
+
+    # Configure session to use an indexed SQLite table (instead of signed cookies)
+    app.config.setdefault("SESSION_PERMANENT", False)
+    app.config.setdefault("SESSION_DATABASE", os.environ.get("SESSION_DATABASE", os.path.join(app.root_path, "sessions.db")))
+    app.config.setdefault("SESSION_TTL", int(os.environ.get("SESSION_TTL", 86400)))
+    app.session_interface = SQLiteSessionInterface(app.config["SESSION_DATABASE"], app.config["SESSION_TTL"])
+
+    # Configure database: path resolved next to this file unless overridden, plus SQLite pragmas.
+    # Up to SQLITE_POOL_SIZE connections stay open between requests
+    app.config.setdefault("DATABASE", os.environ.get("DATABASE", os.path.join(app.root_path, "finance.db")))
+    app.config.setdefault("SQLITE_SYNCHRONOUS", os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"))
+    app.config.setdefault("SQLITE_CACHE_SIZE", int(os.environ.get("SQLITE_CACHE_SIZE", -20000)))
+    app.config.setdefault("SQLITE_MMAP_SIZE", int(os.environ.get("SQLITE_MMAP_SIZE", 268435456)))
+    app.config.setdefault("SQLITE_BUSY_TIMEOUT", int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)))
+    app.config.setdefault("SQLITE_POOL_SIZE", int(os.environ.get("SQLITE_POOL_SIZE", 8)))
+    init_db_app(app)
+
+    # Apply pending schema migrations at startup (can also be run with `flask migrate`)
+    app.config.setdefault("MIGRATE_ON_STARTUP", os.environ.get("MIGRATE_ON_STARTUP", "1") == "1")
+    with timer.phase("migrations"):
+        init_migrations_app(app)
+
+    # Account valuation snapshots are repriced on a background thread with every fetched price (rebuild with
+    # `flask rebuild-valuations`)
+    app.extensions["valuation_repricer"] = init_valuations_app(app)
+
+    # Cost basis kept per holding by every trade (rebuild from history with `flask rebuild-basis`)
+    init_analytics_app(app)
+
+    # Empty leg rows shown on the /basket form
+    app.config.setdefault("BASKET_FORM_ROWS", int(os.environ.get("BASKET_FORM_ROWS", 10)))
+
+    # Number of transactions shown per /history page
+    app.config.setdefault("HISTORY_PAGE_SIZE", int(os.environ.get("HISTORY_PAGE_SIZE", 50)))
+
+    # Configure quote cache: freshness (seconds) for page views, stricter freshness for trades
+    app.config.setdefault("QUOTE_CACHE_TTL", float(os.environ.get("QUOTE_CACHE_TTL", 60)))
+    app.config.setdefault("QUOTE_CACHE_SIZE", int(os.environ.get("QUOTE_CACHE_SIZE", 1024)))
+    app.config.setdefault("QUOTE_TRADE_MAX_AGE", float(os.environ.get("QUOTE_TRADE_MAX_AGE", 5)))
+
+    # Quote cache backend: "memory" (per process) or "sqlite" (shared by every worker on the host)
+    app.config.setdefault("QUOTE_CACHE_BACKEND", os.environ.get("QUOTE_CACHE_BACKEND", "memory"))
+    app.config.setdefault("QUOTE_CACHE_PATH", os.environ.get("QUOTE_CACHE_PATH", os.path.join(app.root_path, "quotecache.db")))
+
+    # Quote snapshot loaded at startup and saved every QUOTE_SNAPSHOT_INTERVAL seconds (0 only at exit);
+    # quotes older than QUOTE_SNAPSHOT_MAX_AGE seconds are dropped. An empty path disables it
+    app.config.setdefault("QUOTE_SNAPSHOT_PATH", os.environ.get("QUOTE_SNAPSHOT_PATH",
+                                                                os.path.join(app.root_path, "quotesnapshot.json.gz")))
+    app.config.setdefault("QUOTE_SNAPSHOT_INTERVAL", float(os.environ.get("QUOTE_SNAPSHOT_INTERVAL", 60)))
+    app.config.setdefault("QUOTE_SNAPSHOT_MAX_AGE", float(os.environ.get("QUOTE_SNAPSHOT_MAX_AGE", 86400)))
+
+    # Configure market data client: connection pool size, timeouts (seconds) and retry budget
+    app.config.setdefault("MARKET_DATA_POOL_SIZE", int(os.environ.get("MARKET_DATA_POOL_SIZE", 10)))
+    app.config.setdefault("MARKET_DATA_CONNECT_TIMEOUT", float(os.environ.get("MARKET_DATA_CONNECT_TIMEOUT", 3.05)))
+    app.config.setdefault("MARKET_DATA_READ_TIMEOUT", float(os.environ.get("MARKET_DATA_READ_TIMEOUT", 5)))
+    app.config.setdefault("MARKET_DATA_RETRIES", int(os.environ.get("MARKET_DATA_RETRIES", 2)))
+    app.config.setdefault("MARKET_DATA_BACKOFF", float(os.environ.get("MARKET_DATA_BACKOFF", 0.2)))
+
+    # Market data provider: "iex" (live, needs API_KEY) or "replay" (offline recorded tape)
+    app.config.setdefault("MARKET_DATA_PROVIDER", os.environ.get("MARKET_DATA_PROVIDER", "iex"))
+    app.config.setdefault("API_KEY", os.environ.get("API_KEY"))
+    app.config.setdefault("MARKET_DATA_TAPE", os.environ.get("MARKET_DATA_TAPE"))
+    app.config.setdefault("MARKET_DATA_REPLAY_LATENCY", float(os.environ.get("MARKET_DATA_REPLAY_LATENCY", 0)))
+    app.config.setdefault("MARKET_DATA_REPLAY_SPEED", float(os.environ.get("MARKET_DATA_REPLAY_SPEED", 1)))
+    with timer.phase("market data provider"):
+        provider = create_provider(app.config)
+        configure_market_data(provider)
+
+    # The quote cache is set up once the provider is known: with the shared backend a worker waits for another's
+    # refresh of a symbol for as long as that refresh can take, retries and backoff included, plus a second
+    configure_quote_cache(app.config["QUOTE_CACHE_TTL"], app.config["QUOTE_CACHE_SIZE"],
+                          app.config["QUOTE_CACHE_BACKEND"], app.config["QUOTE_CACHE_PATH"],
+                          provider.max_call_time() + 1.0)
+
+    # Local symbol listing (CSV with a symbol,name header, written by `flask update-symbols`): unknown tickers are
+    # rejected without an upstream call, and the file is reloaded when it changes
+    app.config.setdefault("SYMBOL_LISTING", os.environ.get("SYMBOL_LISTING", os.path.join(app.root_path, "symbols.csv")))
+    app.config.setdefault("SYMBOL_LISTING_CHECK_INTERVAL", float(os.environ.get("SYMBOL_LISTING_CHECK_INTERVAL", 5)))
+    app.config.setdefault("SYMBOL_SEARCH_LIMIT", int(os.environ.get("SYMBOL_SEARCH_LIMIT", 10)))
+    with timer.phase("symbol listing"):
+        app.extensions["symbol_index"] = init_symbols_app(app)
+
+    # Upstream request budget; trades take priority over /quote, which takes priority over portfolio refresh.
+    # The budget is per worker process, so divide the provider's limits by the number of workers
+    app.config.setdefault("MARKET_DATA_RATE_PER_SECOND", float(os.environ.get("MARKET_DATA_RATE_PER_SECOND", 100)))
+    app.config.setdefault("MARKET_DATA_RATE_PER_MINUTE", float(os.environ.get("MARKET_DATA_RATE_PER_MINUTE", 3000)))
+    configure_request_budget(app.config["MARKET_DATA_RATE_PER_SECOND"], app.config["MARKET_DATA_RATE_PER_MINUTE"])
+
+    # Requests slower than this many seconds get their SQL / upstream breakdown logged (0 disables the log)
+    app.config.setdefault("SLOW_REQUEST_THRESHOLD", float(os.environ.get("SLOW_REQUEST_THRESHOLD", 1.0)))
+
+    # /metrics is only served when METRICS_ENABLED is set, and when METRICS_TOKEN is set only to scrapers sending
+    # it as "Authorization: Bearer <token>"
+    app.config.setdefault("METRICS_ENABLED", os.environ.get("METRICS_ENABLED", "0") == "1")
+    app.config.setdefault("METRICS_TOKEN", os.environ.get("METRICS_TOKEN", ""))
+    registry.add_collector(market_data_metrics)
+    registry.add_collector(timer.metrics)
+
+    # Password hashing: pbkdf2 runs in PASSWORD_HASH_WORKERS processes (0 hashes inline) with at most
+    # PASSWORD_HASH_QUEUE_DEPTH logins / registrations in flight, beyond that they get a 503.
+    # Hashes made with other parameters than PASSWORD_HASH_METHOD / PASSWORD_SALT_LENGTH are upgraded on login.
+    app.config.setdefault("PASSWORD_HASH_WORKERS", int(os.environ.get("PASSWORD_HASH_WORKERS",
+                                                                      max(1, (os.cpu_count() or 2) // 2))))
+    app.config.setdefault("PASSWORD_HASH_QUEUE_DEPTH", int(os.environ.get("PASSWORD_HASH_QUEUE_DEPTH",
+                                                                          4 * app.config["PASSWORD_HASH_WORKERS"] or 1)))
+    app.config.setdefault("PASSWORD_HASH_METHOD", os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256"))
+    app.config.setdefault("PASSWORD_SALT_LENGTH", int(os.environ.get("PASSWORD_SALT_LENGTH", 8)))
+    app.extensions["password_hasher"] = PasswordHasher(app.config["PASSWORD_HASH_WORKERS"],
+                                                       app.config["PASSWORD_HASH_QUEUE_DEPTH"],
+                                                       app.config["PASSWORD_HASH_METHOD"], app.config["PASSWORD_SALT_LENGTH"])
+
+    # Live dashboard: one poller per worker refreshes every watched symbol each LIVE_POLL_INTERVAL seconds. Each
+    # stream holds a worker thread, so a worker serves at most LIVE_MAX_SUBSCRIBERS of them (0 for no limit) and
+    # ends those without a price change for LIVE_IDLE_TIMEOUT seconds; browsers reconnect LIVE_RETRY seconds later
+    app.config.setdefault("LIVE_POLL_INTERVAL", float(os.environ.get("LIVE_POLL_INTERVAL", 5)))
+    app.config.setdefault("LIVE_HEARTBEAT", float(os.environ.get("LIVE_HEARTBEAT", 15)))
+    app.config.setdefault("LIVE_MAX_SUBSCRIBERS", int(os.environ.get("LIVE_MAX_SUBSCRIBERS", 50)))
+    app.config.setdefault("LIVE_IDLE_TIMEOUT", float(os.environ.get("LIVE_IDLE_TIMEOUT", 120)))
+    app.config.setdefault("LIVE_RETRY", float(os.environ.get("LIVE_RETRY", 30)))
+    app.extensions["price_poller"] = init_live_app(app)
+
+    # Periodic batch jobs, run on a background thread by exactly one worker at a time
+    app.config.setdefault("SCHEDULER_ENABLED", os.environ.get("SCHEDULER_ENABLED", "1") == "1")
+    scheduler = app.extensions["scheduler"] = Scheduler(lambda: connect_app(app))
+
+    # Leaderboard: recomputed every LEADERBOARD_INTERVAL seconds, keeping the top LEADERBOARD_SIZE accounts
+    app.config.setdefault("LEADERBOARD_INTERVAL", float(os.environ.get("LEADERBOARD_INTERVAL", 300)))
+    app.config.setdefault("LEADERBOARD_SIZE", int(os.environ.get("LEADERBOARD_SIZE", 100)))
+    init_leaderboard_app(app, scheduler, app.extensions["valuation_repricer"])
+
+    # Resting limit / stop orders: matched on a background thread as prices arrive, and the prices of symbols
+    # with open orders are refreshed every ORDER_PRICE_INTERVAL seconds
+    app.config.setdefault("ORDER_MATCHER_ENABLED", os.environ.get("ORDER_MATCHER_ENABLED", "1") == "1")
+    app.config.setdefault("ORDER_PRICE_INTERVAL", float(os.environ.get("ORDER_PRICE_INTERVAL", 15)))
+    app.config.setdefault("ORDERS_SHOWN", int(os.environ.get("ORDERS_SHOWN", 100)))
+    app.extensions["order_matcher"] = init_orders_app(app, scheduler)
+
+    # Maintenance job every MAINTENANCE_INTERVAL seconds (0 only runs it with `flask maintenance`): deletes sold out
+    # holdings MAINTENANCE_BATCH_SIZE at a time, moves history older than HISTORY_RETENTION_DAYS (0 keeps it all) into
+    # the HISTORY_ARCHIVE database, refreshes planner statistics reading about ANALYSIS_LIMIT rows per index and
+    # frees up to VACUUM_PAGES pages
+    app.config.setdefault("MAINTENANCE_INTERVAL", float(os.environ.get("MAINTENANCE_INTERVAL", 86400)))
+    app.config.setdefault("MAINTENANCE_BATCH_SIZE", int(os.environ.get("MAINTENANCE_BATCH_SIZE", 500)))
+    app.config.setdefault("HISTORY_RETENTION_DAYS", float(os.environ.get("HISTORY_RETENTION_DAYS", 365)))
+    app.config.setdefault("HISTORY_ARCHIVE", os.environ.get("HISTORY_ARCHIVE", os.path.join(app.root_path, "archive.db")))
+    app.config.setdefault("ANALYSIS_LIMIT", int(os.environ.get("ANALYSIS_LIMIT", 1000)))
+    app.config.setdefault("VACUUM_PAGES", int(os.environ.get("VACUUM_PAGES", 2000)))
+    init_maintenance_app(app, scheduler)
+
+    # Warm start: last known quotes in the cache and hot statements prepared before the first request
+    init_warm_start_app(app, scheduler, timer, HOT_QUERIES)
+
+    app.register_blueprint(views)
+    before_render_template.connect(start_render_timer, app)
+    template_rendered.connect(record_render_time, app)
+
+    if app.config["SCHEDULER_ENABLED"]:
+        scheduler.start()
+
+    timer.finish()
+    app.logger.info(timer.report())
+    return app
+
+
+@views.app_errorhandler(HasherBusy)
+def password_hashing_busy(error):
+    """Shed logins / registrations while every password hashing slot is taken"""
+    body, code = apology("server busy - please try again", 503)
+    return body, code, {"Retry-After": "1"}
+
+
+@views.before_app_request
+def start_request_timer():
+    """Remember when the request started for the request metrics"""
+    g.request_started = time.perf_counter()
+
+
+@views.after_app_request
+def record_request_metrics(response):
+    """Time each route and log where slow requests spent their time"""
+
+    elapsed = time.perf_counter() - g.request_started
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    request_duration.labels_for(route, request.method).observe(elapsed)
+    requests_total.labels_for(route, request.method, str(response.status_code)).inc()
+
+    threshold = current_app.config["SLOW_REQUEST_THRESHOLD"]
+    if threshold and elapsed > threshold:
+        current_app.logger.warning(slow_request_report(route, elapsed))
 
-# Custom filter
-app.jinja_env.filters["usd"] = usd
+    return response
 
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
 
-# Make sure API key is set
-if not os.environ.get("API_KEY"):
-    raise RuntimeError("API_KEY not set")
+def start_render_timer(sender, template, context, **extra):
+    """Remember when template rendering started"""
+    g.render_started = time.perf_counter()
 
 
-@app.after_request
-def after_request(response):
-    """Ensure responses aren't cached"""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
-    return response
+def record_render_time(sender, template, context, **extra):
+    """Time Jinja rendering for the request metrics"""
+    if "render_started" in g:
+        record_operation("operation", "render", template.name, time.perf_counter() - g.pop("render_started"))
+
+
+@views.route("/metrics")
+def metrics():
+    """Expose request, SQL and upstream metrics in Prometheus text format"""
+
+    # Hidden unless enabled, the metrics reveal traffic, slow queries and upstream usage
+    if not current_app.config["METRICS_ENABLED"]:
+        return apology("not found", 404)
 
+    token = current_app.config["METRICS_TOKEN"]
+    if token and not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+        return apology("unauthorized", 401)
 
-@app.route("/")
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@views.route("/")
 @login_required
 def index():
     """Show portfolio of stocks"""
 
     try:
-        # Connect to the SQL database
-        dbcon = sqlite3.connect("finance.db")
+        # Connection to the SQL database, shared for the rest of the request
+        dbcon = get_db()
         sql_cursor = dbcon.cursor()
 
-        # Global indices for SQL
-        global portfolio_symbol_ind, portfolio_company_ind, portfolio_total_shares_ind
-
         # Lists to be appended to down below
         ticker = []
         company = []
         tot_shares = []
         price_per_share = []
         holding_price = []
+        average_cost = []
+        unrealized = []
 
-        # Gets portfolio info for user that is logged in
-        holdings = sql_cursor.execute("SELECT * FROM portfolio WHERE user_id = ? ORDER BY symbol ASC",
-                                      (session.get('user_id'),)).fetchall()
-
-        # Populates all the lists with all data relevant to each holding
-        for i in range(len(holdings)):
-            ticker.append(holdings[i][portfolio_symbol_ind])
-            company.append(holdings[i][portfolio_company_ind])
-            tot_shares.append(holdings[i][portfolio_total_shares_ind])
-            # Individual share price
-            stockInfo = lookup(ticker[i])
-            price_per_share.append(stockInfo["price"])
-            # Total holding price
-            holding_price.append(tot_shares[i] * stockInfo["price"])
-
-        funds = sql_cursor.execute("SELECT cash FROM users WHERE id = ?", (session.get('user_id'),)).fetchone()
-        user = sql_cursor.execute("SELECT username FROM users WHERE id = ?", (session.get('user_id'),)).fetchone()
+        # Reads the user's valuation snapshot: account totals plus one row per holding
+        rows = sql_cursor.execute(DASHBOARD_QUERY, (session.get('user_id'),)).fetchall()
 
         # Ensure the user exists before proceeding
-        if user is not None:
-            username = user[0]
-        else:
+        if not rows:
             return apology("User not found", 400)
 
-        # Account value summary
-        user_cash = funds[0]
-        stock_value = sum(holding_price)
+        # Accounts without a snapshot yet (e.g. just registered) get one built from portfolio and history
+        if rows[0][dashboard_cash_ind] is None:
+            rebuild_valuations(dbcon, session.get('user_id'))
+            rows = sql_cursor.execute(DASHBOARD_QUERY, (session.get('user_id'),)).fetchall()
+
+        # Holdings whose price is older than the quote cache TTL are priced with one batch lookup. The page shows
+        # those prices right away; the snapshots are written by the repricer thread, never by this request
+        now = time.time()
+        stale = [row[dashboard_symbol_ind] for row in rows if row[dashboard_symbol_ind] is not None and
+                 (row[dashboard_priced_at_ind] is None or
+                  now - row[dashboard_priced_at_ind] > current_app.config["QUOTE_CACHE_TTL"])]
+        prices_delayed = False
+        fresh = {}
+        if stale:
+            quotes = lookup_many(stale)
+            # Cache hits never reach the price listener, so hand the repricer every quote
+            current_app.extensions["valuation_repricer"].on_prices(quotes)
+            fresh = {symbol: to_cents(quote["price"]) for symbol, quote in quotes.items()
+                     if quote is not None and not quote.get("stale")}
+
+            # Lets the user know when market data was rate limited or unavailable
+            prices_delayed = any(quote is None or quote.get("stale") for quote in quotes.values())
+
+        # Populates all the lists with all data relevant to each holding
+        market_value = 0
+        for row in rows:
+            if row[dashboard_symbol_ind] is None:
+                continue
+            ticker.append(row[dashboard_symbol_ind])
+            company.append(row[dashboard_company_ind])
+            tot_shares.append(row[dashboard_shares_ind])
+            # Individual share price, None when no price is known at all
+            price = fresh.get(row[dashboard_symbol_ind], row[dashboard_price_ind])
+            price_per_share.append(from_cents(price) if price is not None else None)
+            # Total holding price
+            value = row[dashboard_shares_ind] * price if price is not None else 0
+            market_value += value
+            holding_price.append(from_cents(value))
+            # Average cost per share and unrealized gain, from the incrementally kept cost basis
+            cost = row[dashboard_cost_ind] or 0
+            average_cost.append(from_cents(cost / row[dashboard_shares_ind]))
+            unrealized.append(from_cents(value - cost) if price is not None else None)
+
+        username = rows[0][dashboard_username_ind]
+
+        # Account value summary, from the holdings as shown
+        user_cash = from_cents(rows[0][dashboard_cash_ind])
+        stock_value = from_cents(market_value)
         account_value = usd(user_cash + stock_value)
 
         return render_template("index.html", username=username, ticker=ticker, company=company, tot_shares=tot_shares,
                                 price_per_share=price_per_share, holding_price=holding_price,
-                                user_cash=user_cash, stock_value=stock_value, account_value=account_value)
+                                average_cost=average_cost, unrealized=unrealized,
+                                user_cash=user_cash, stock_value=stock_value, account_value=account_value,
+                                prices_delayed=prices_delayed)
 
     finally:
-        # Close database connection
+        # Close cursor, the connection itself is closed on app context teardown
         sql_cursor.close()
 
 
-@app.route("/buy", methods=["GET", "POST"])
+@views.route("/buy", methods=["GET", "POST"])
 @login_required
 def buy():
     """Buy shares of stock"""
 
     try:
-        # Connect to the SQL database
-        dbcon = sqlite3.connect("finance.db")
+        # Connection to the SQL database, shared for the rest of the request
+        dbcon = get_db()
         sql_cursor = dbcon.cursor()
 
         global portfolio_symbol_ind
@@ -175,7 +472,10 @@ def buy():
                 return apology("cannot buy fractional shares", 400)
 
             # Dictionary for user's desired stock info
-            stockDict = lookup(ticker)
+            try:
+                stockDict = lookup(ticker, max_age=current_app.config["QUOTE_TRADE_MAX_AGE"], priority=PRIORITY_TRADE)
+            except MarketDataUnavailable:
+                return apology("market data temporarily unavailable", 503)
 
             # Ensure ticker symbol actually exists
             if not stockDict:
@@ -186,46 +486,11 @@ def buy():
             stockPrice = stockDict["price"]
             stockSymbol = stockDict["symbol"]
 
-            # User's total cash prior to purchase
-            funds = sql_cursor.execute("SELECT cash FROM users WHERE id = ?", (session.get('user_id'),)).fetchone()
-
-            # Checks if user has enough funds for transaction
-            # funds[0]["cash"] extracts first element from funds list to get actual cash number
-            #   Ex: funds[0]["cash"] = 10000, whereas funds = [{'cash': 10000}]
-            if funds[0] < (stockPrice * shares):
-                return apology("insufficient funds", 400)
-
-            else:
-                # Formats timestamp before inserting into database
-                formatted_timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-                # Record stock purchase in history table
-                sql_cursor.execute("INSERT INTO history (user_id, order_type, ticker, shares, price, timestamp) VALUES(?, ?, ?, ?, ?, ?)",
-                                   (session.get('user_id'), 'buy', stockSymbol, shares, stockPrice, formatted_timestamp,))
-                dbcon.commit()
-
-                # Checks to see if user already owns shares of a stock they are purchasing
-                exists = sql_cursor.execute("SELECT symbol FROM portfolio WHERE user_id = ? AND symbol = ?",
-                                            (session.get('user_id'), stockSymbol),).fetchone()
-
-                # If they already own shares of this type of stock, add number of purchased shares to existing shares in user's portfolio
-                if exists and exists[0] == stockSymbol:
-                    currentShares = sql_cursor.execute(
-                        "SELECT total_shares FROM portfolio WHERE user_id = ? AND symbol = ?", (session.get('user_id'), stockSymbol,)).fetchone()
-                    newShares = currentShares[0] + shares
-                    sql_cursor.execute("UPDATE portfolio SET total_shares = ? WHERE user_id = ? AND symbol = ?",
-                                       (newShares, session.get('user_id'), stockSymbol,))
-                    dbcon.commit()
-                # Else, create a new row in user's portfolio for tracking this stock's info
-                else:
-                    sql_cursor.execute("INSERT INTO portfolio (user_id, symbol, company, total_shares) VALUES (?, ?, ?, ?)",
-                                       (session.get('user_id'), stockSymbol, stockName, shares,))
-                    dbcon.commit()
-
-                # Subtracts the total cost from the user's cash
-                newCash = funds[0] - (stockPrice * shares)
-                sql_cursor.execute("UPDATE users SET cash = ? WHERE id = ?", (newCash, session.get('user_id'),))
-                dbcon.commit()
+            # Executes the purchase as one transaction
+            try:
+                execute_buy(dbcon, session.get('user_id'), stockSymbol, stockName, int(shares), stockPrice)
+            except TradeError as error:
+                return apology(str(error), 400)
 
             # Redirect user to the hompage once purchase complete
             return redirect("/")
@@ -235,71 +500,303 @@ def buy():
             return render_template("buy.html")
 
     finally:
-        # Close database connection
+        # Close cursor, the connection itself is closed on app context teardown
         sql_cursor.close()
 
 
-@app.route("/history")
+@views.route("/basket", methods=["GET", "POST"])
 @login_required
-def history():
-    """Show history of transactions"""
+def basket():
+    """Buy and sell many stocks at once, all or nothing"""
 
-    try:
-        # Connect to the SQL database
-        dbcon = sqlite3.connect("finance.db")
-        sql_cursor = dbcon.cursor()
+    # User reached route via POST (as by submitting a form via POST)
+    if request.method == "POST":
 
-        # Indices used for SQL
-        global history_order_type_ind, history_ticker_ind, history_shares_ind, history_price_ind, history_timestamp_ind
+        # Legs come from an uploaded CSV file if there is one, otherwise from the form rows
+        try:
+            upload = request.files.get("basket")
+            if upload and upload.filename:
+                legs = parse_basket_csv(upload.stream)
+            else:
+                legs = parse_basket_form(request.form)
+        except ValueError as error:
+            return apology(str(error), 400)
+
+        # Prices every symbol of the basket with one batch lookup, fresh enough to trade on
+        try:
+            quotes = lookup_many([leg["symbol"] for leg in legs], max_age=current_app.config["QUOTE_TRADE_MAX_AGE"],
+                                 priority=PRIORITY_TRADE)
+        except MarketDataUnavailable:
+            return apology("market data temporarily unavailable", 503)
+
+        # Applies every leg in one transaction, or none of them
+        try:
+            report = execute_basket(get_db(), session.get('user_id'), legs, quotes)
+        except TradeError as error:
+            return apology(str(error), 400)
+
+        return render_template("basket_report.html", fills=report,
+                               bought=sum(fill["amount"] for fill in report if fill["side"] == "buy"),
+                               sold=sum(fill["amount"] for fill in report if fill["side"] == "sell"))
 
-        # Lists to be appended to down below
-        order_type = []
-        ticker = []
-        shares = []
-        price_per_share = []
-        transaction_price = []
-        timestamp = []
+    # User reached route via GET (as by clicking a link or via redirect)
+    else:
+        return render_template("basket.html", rows=current_app.config["BASKET_FORM_ROWS"])
 
-        # Gets historical info for user that is logged in
-        records = sql_cursor.execute("SELECT * FROM history WHERE user_id = ? ORDER BY timestamp DESC",
-                                     (session.get('user_id'),)).fetchall()
 
-        if not records:
-            return apology("no transaction history on this account", 400)
+@views.route("/symbols")
+@login_required
+def symbols():
+    """Autocomplete ticker symbols and company names from the local listing"""
+    return jsonify(current_app.extensions["symbol_index"].search(request.args.get("q", ""),
+                                                                 current_app.config["SYMBOL_SEARCH_LIMIT"]))
 
-        # Populates all the lists with all data relevant to each transaction
-        for i in range(len(records)):
-            order_type.append(records[i][history_order_type_ind])
-            ticker.append(records[i][history_ticker_ind])
-            shares.append(records[i][history_shares_ind])
-            price_per_share.append(records[i][history_price_ind])
-            transaction_price.append((records[i][history_shares_ind] * records[i][history_price_ind]))
-            timestamp.append((records[i][history_timestamp_ind]))
+
+@views.route("/history")
+@login_required
+@cache_control("private, no-cache")
+def history():
+    """Show history of transactions, one page at a time"""
+
+    try:
+        # Connection to the SQL database, shared for the rest of the request
+        dbcon = get_db()
+        sql_cursor = dbcon.cursor()
+
+        # The page only changes with a new transaction or when old ones are archived, so a browser holding it
+        # for the latest transaction and archive run gets a 304
+        latest, archived = sql_cursor.execute(
+            "SELECT (SELECT transaction_id FROM history WHERE user_id = ? ORDER BY timestamp DESC, transaction_id DESC LIMIT 1), "
+            "(SELECT COALESCE(SUM(trades), 0) FROM history_rollups WHERE user_id = ?)",
+            (session.get('user_id'), session.get('user_id'),)).fetchone()
+        etag = page_etag(session.get('user_id'), latest, archived, request.query_string,
+                         current_app.config["HISTORY_PAGE_SIZE"])
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        # Optional filters and page cursors, all pushed down into the SQL query
+        try:
+            filters = parse_history_filters(request.args)
+            records, prev_cursor, next_cursor = history_page(sql_cursor, session.get('user_id'), filters,
+                                                             current_app.config["HISTORY_PAGE_SIZE"],
+                                                             before=request.args.get("before"),
+                                                             after=request.args.get("after"))
+        except ValueError:
+            return apology("invalid history filter or page", 400)
+
+        if not records and not request.args and not archived:
+            return apology("no transaction history on this account", 400)
 
         # Get's account username
         user = sql_cursor.execute("SELECT username FROM users WHERE id = ?", (session.get('user_id'),)).fetchone()
         username = user[0]
 
-        return render_template("history.html", order_type=order_type, ticker=ticker, shares=shares,
-                                price_per_share=price_per_share, transaction_price=transaction_price,
-                                timestamp=timestamp, username=username)
+        # Filters are carried over into the next/prev page links
+        filter_args = {key: request.args.get(key) for key in ("ticker", "order_type", "start", "end")
+                       if request.args.get(key)}
+
+        # Rows are converted for display lazily while the page streams out
+        transactions = ({
+            "order_type": record[ledger_order_type_ind],
+            "ticker": record[ledger_ticker_ind],
+            "shares": record[ledger_shares_ind],
+            "price_per_share": from_cents(record[ledger_price_ind]),
+            "transaction_price": from_cents(record[ledger_shares_ind] * record[ledger_price_ind]),
+            "timestamp": record[ledger_timestamp_ind],
+        } for record in records)
+
+        # Streams the page so the first bytes go out before the whole table is rendered
+        response = make_response(stream_template("history.html", transactions=transactions, username=username,
+                                                 filter_args=filter_args, prev_cursor=prev_cursor,
+                                                 next_cursor=next_cursor, archived=archived))
+        response.set_etag(etag, weak=True)
+        return response
+
+    finally:
+        # Close cursor, the connection itself is closed on app context teardown
+        sql_cursor.close()
+
+
+@views.route("/analytics")
+@login_required
+def analytics():
+    """Show cost basis, realized and unrealized gains and returns"""
+
+    try:
+        # Connection to the SQL database, shared for the rest of the request
+        dbcon = get_db()
+        sql_cursor = dbcon.cursor()
+
+        # Current prices and cash come from the valuation snapshot, like the dashboard
+        rows = sql_cursor.execute(DASHBOARD_QUERY, (session.get('user_id'),)).fetchall()
+        if not rows:
+            return apology("User not found", 400)
+        if rows[0][dashboard_cash_ind] is None:
+            rebuild_valuations(dbcon, session.get('user_id'))
+            rows = sql_cursor.execute(DASHBOARD_QUERY, (session.get('user_id'),)).fetchall()
+
+        prices = {row[dashboard_symbol_ind]: row[dashboard_price_ind] for row in rows if row[dashboard_symbol_ind] is not None}
+
+        # Replays the whole history as vectorized array operations
+        holdings, sells, summary = portfolio_analytics(sql_cursor, session.get('user_id'), rows[0][dashboard_cash_ind], prices)
+
+        return render_template("analytics.html", username=rows[0][dashboard_username_ind], holdings=holdings,
+                               sells=sells, summary=summary)
+
+    finally:
+        # Close cursor, the connection itself is closed on app context teardown
+        sql_cursor.close()
+
+
+@views.route("/export/history")
+@login_required
+def export_history():
+    """Download transaction history as CSV or JSONL"""
+
+    # Ensure the requested format is supported
+    export_format = request.args.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return apology("export format must be csv or jsonl", 400)
+
+    # Optional ticker, order type and date range filters, pushed down into SQL
+    try:
+        filters = parse_history_filters(request.args)
+    except ValueError:
+        return apology("invalid history filter", 400)
+    where, params = history_where(session.get('user_id'), filters)
+
+    # Archived trades (see maintenance.py) are exported with the rest. UNION drops the copies a maintenance run
+    # interrupted between copying and deleting leaves in both databases
+    archive = current_app.config["HISTORY_ARCHIVE"]
+    if os.path.exists(archive):
+        sql = (f"SELECT {HISTORY_COLUMNS} FROM main.history WHERE {where} "
+               f"UNION SELECT {HISTORY_COLUMNS} FROM archive.history WHERE {where} "
+               "ORDER BY timestamp ASC, transaction_id ASC")
+        params, attach = params * 2, {"archive": archive}
+    else:
+        sql = f"SELECT {HISTORY_COLUMNS} FROM history WHERE {where} ORDER BY timestamp ASC, transaction_id ASC"
+        attach = None
+
+    # Rows stream straight from the cursor, prices converted from cents as they go
+    records = iter_rows(sql, params, attach=attach)
+    rows = ((record[ledger_transaction_id_ind], record[ledger_order_type_ind], record[ledger_ticker_ind],
+             record[ledger_shares_ind], f"{from_cents(record[ledger_price_ind]):.2f}", record[ledger_timestamp_ind])
+            for record in records)
+
+    return export_response(("transaction_id", "order_type", "ticker", "shares", "price", "timestamp"),
+                           rows, export_format, "history")
+
+
+@views.route("/export/portfolio")
+@login_required
+def export_portfolio():
+    """Download current holdings as CSV or JSONL"""
+
+    # Ensure the requested format is supported
+    export_format = request.args.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return apology("export format must be csv or jsonl", 400)
+
+    # Optional ticker filter, pushed down into SQL
+    where = "user_id = ? AND total_shares > 0"
+    params = [session.get('user_id')]
+    if request.args.get("ticker"):
+        where += " AND symbol = ?"
+        params.append(request.args.get("ticker").strip().upper())
+
+    rows = iter_rows(f"SELECT symbol, company, total_shares FROM portfolio WHERE {where} ORDER BY symbol ASC", params)
+
+    return export_response(("symbol", "company", "shares"), rows, export_format, "portfolio")
+
+
+@views.route("/leaderboard")
+@login_required
+def leaderboard():
+    """Show the top accounts by total value and the user's own rank"""
+
+    try:
+        # Connection to the SQL database, shared for the rest of the request
+        dbcon = get_db()
+        sql_cursor = dbcon.cursor()
+
+        # Reads the precomputed top accounts, the batch job does all the pricing
+        rows = sql_cursor.execute("SELECT rank, username, value, computed_at FROM leaderboard WHERE rank <= ? ORDER BY rank, user_id",
+                                  (current_app.config["LEADERBOARD_SIZE"],)).fetchall()
+
+        leaders = [{
+            "rank": row[leaderboard_rank_ind],
+            "username": row[leaderboard_username_ind],
+            "value": from_cents(row[leaderboard_value_ind]),
+        } for row in rows]
+        computed_at = (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(rows[0][leaderboard_computed_at_ind]))
+                       if rows else None)
+
+        # User's own rank, even when outside the top
+        own = sql_cursor.execute("SELECT rank, value FROM account_ranks WHERE user_id = ?", (session.get('user_id'),)).fetchone()
+
+        return render_template("leaderboard.html", leaders=leaders, computed_at=computed_at,
+                               own_rank=own[0] if own else None, own_value=from_cents(own[1]) if own else None)
+
+    finally:
+        # Close cursor, the connection itself is closed on app context teardown
+        sql_cursor.close()
+
+
+@views.route("/live")
+@login_required
+def live():
+    """Stream price and holding value changes of the user's portfolio as server-sent events"""
+
+    try:
+        # Connection to the SQL database, only used before the stream starts
+        dbcon = get_db()
+        sql_cursor = dbcon.cursor()
+
+        # Holdings as the dashboard last rendered them, from the valuation snapshot
+        rows = sql_cursor.execute(DASHBOARD_QUERY, (session.get('user_id'),)).fetchall()
+        holdings = {row[dashboard_symbol_ind]: (row[dashboard_shares_ind],
+                                                from_cents(row[dashboard_price_ind]) if row[dashboard_price_ind] is not None else None,
+                                                from_cents(row[dashboard_cost_ind] or 0))
+                    for row in rows if row[dashboard_symbol_ind] is not None}
+
+        # Nothing to watch, 204 tells the browser not to reconnect
+        if not holdings or rows[0][dashboard_cash_ind] is None:
+            return Response(status=204)
+
+        # Every stream pins a worker thread, past the cap the dashboard just stays static
+        poller = current_app.extensions["price_poller"]
+        subscription = poller.subscribe(holdings)
+        if subscription is None:
+            return Response(status=503, headers={"Retry-After": str(int(current_app.config["LIVE_RETRY"]))})
+
+        events = portfolio_events(poller, subscription, holdings, from_cents(rows[0][dashboard_cash_ind]),
+                                  current_app.config["LIVE_HEARTBEAT"], current_app.config["LIVE_IDLE_TIMEOUT"],
+                                  current_app.config["LIVE_RETRY"])
+        response = Response(events, mimetype="text/event-stream", headers={"X-Accel-Buffering": "no"})
+        # A client gone before the first chunk never starts the generator, so its finally would not unsubscribe
+        response.call_on_close(lambda: poller.unsubscribe(subscription))
+        return response
 
     finally:
-        # Close database connection
+        # Close cursor, the connection itself is closed on app context teardown
         sql_cursor.close()
 
 
-@app.route("/login", methods=["GET", "POST"])
+@views.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
 
     try:
-        # Connect to the SQL database
-        dbcon = sqlite3.connect("finance.db")
+        # Connection to the SQL database, shared for the rest of the request
+        dbcon = get_db()
         sql_cursor = dbcon.cursor()
 
         # Index for SQL
-        global users_id_ind
+        global users_id_ind, users_hash_ind
+
+        # Hashes passwords off the request thread (see passwords.py)
+        password_hasher = current_app.extensions["password_hasher"]
 
         # Forget any user_id
         session.clear()
@@ -319,9 +816,26 @@ def login():
             rows = sql_cursor.execute("SELECT * FROM users WHERE username = ?", (request.form.get("username"),)).fetchall()
 
             # Ensure username exists and password is correct
-            if len(rows) != 1 or not check_password_hash(rows[0][2], request.form.get("password")):
+            if len(rows) != 1:
+                return apology("invalid username and/or password", 400)
+            with timed("operation", "password_hash"):
+                valid = password_hasher.check(rows[0][users_hash_ind], request.form.get("password"))
+            if not valid:
                 return apology("invalid username and/or password", 400)
 
+            # Upgrade a hash made with outdated parameters while the plain password is at hand
+            if password_hasher.needs_rehash(rows[0][users_hash_ind]):
+                try:
+                    with timed("operation", "password_hash"):
+                        rehashed = password_hasher.hash(request.form.get("password"))
+                except HasherBusy:
+                    # Not worth failing the login over, try again on the next one
+                    pass
+                else:
+                    sql_cursor.execute("UPDATE users SET hash = ? WHERE id = ? AND hash = ?",
+                                       (rehashed, rows[0][users_id_ind], rows[0][users_hash_ind],))
+                    dbcon.commit()
+
             # Remember which user has logged in
             session["user_id"] = rows[0][users_id_ind]
 
@@ -333,11 +847,11 @@ def login():
             return render_template("login.html")
 
     finally:
-        # Close database connection
+        # Close cursor, the connection itself is closed on app context teardown
         sql_cursor.close()
 
 
-@app.route("/logout")
+@views.route("/logout")
 def logout():
     """Log user out"""
 
@@ -348,7 +862,97 @@ def logout():
     return redirect("/")
 
 
-@app.route("/quote", methods=["GET", "POST"])
+@views.route("/orders", methods=["GET", "POST"])
+@login_required
+def orders():
+    """Place resting limit / stop orders and list the user's orders"""
+
+    try:
+        # Connection to the SQL database, shared for the rest of the request
+        dbcon = get_db()
+        sql_cursor = dbcon.cursor()
+
+        # User reached route via POST (as by submitting a form via POST)
+        if request.method == "POST":
+
+            # Ensure every field was populated
+            for field in ("symbol", "side", "kind", "shares", "price"):
+                if not request.form.get(field):
+                    return apology(f"must provide {field}", 400)
+
+            # Ensure shares is a positive whole number and the trigger price a positive number
+            try:
+                shares = float(request.form.get("shares"))
+                trigger = float(request.form.get("price"))
+            except (ValueError):
+                return apology("Invalid, shares and price must be numeric", 400)
+            if shares < 1 or shares % 1 != 0:
+                return apology("shares must be a whole number greater than 0", 400)
+            if trigger <= 0:
+                return apology("price must be greater than 0", 400)
+
+            # Ensure ticker symbol actually exists
+            try:
+                stockDict = lookup(request.form.get("symbol"))
+            except MarketDataUnavailable:
+                return apology("market data temporarily unavailable", 503)
+            if not stockDict:
+                return apology("not a valid ticker symbol", 400)
+
+            # Stores the order and adds it to the matcher's book
+            try:
+                row = place_order(dbcon, session.get('user_id'), stockDict["symbol"], stockDict["name"],
+                                  request.form.get("side"), request.form.get("kind"), int(shares), trigger)
+            except TradeError as error:
+                return apology(str(error), 400)
+            current_app.extensions["order_matcher"].add(row)
+
+            # An order that is already marketable fills on the current price
+            current_app.extensions["order_matcher"].on_prices({stockDict["symbol"]: stockDict})
+
+            return redirect("/orders")
+
+        # User reached route via GET (as by clicking a link or via redirect)
+        else:
+            rows = sql_cursor.execute(f"SELECT {ORDER_COLUMNS} FROM orders WHERE user_id = ? ORDER BY order_id DESC LIMIT ?",
+                                      (session.get('user_id'), current_app.config["ORDERS_SHOWN"],)).fetchall()
+
+            order_list = [{
+                "order_id": row[order_id_ind],
+                "symbol": row[order_symbol_ind],
+                "side": row[order_side_ind],
+                "kind": row[order_kind_ind],
+                "shares": row[order_shares_ind],
+                "trigger_price": from_cents(row[order_trigger_price_ind]),
+                "status": row[order_status_ind],
+                "placed_at": row[order_placed_at_ind],
+                "closed_at": row[order_closed_at_ind],
+                "fill_price": from_cents(row[order_fill_price_ind]) if row[order_fill_price_ind] is not None else None,
+                "note": row[order_note_ind],
+            } for row in rows]
+
+            return render_template("orders.html", orders=order_list)
+
+    finally:
+        # Close cursor, the connection itself is closed on app context teardown
+        sql_cursor.close()
+
+
+@views.route("/orders/<int:order_id>/cancel", methods=["POST"])
+@login_required
+def cancel(order_id):
+    """Cancel one of the user's open orders"""
+
+    if not cancel_order(get_db(), session.get('user_id'), order_id):
+        return apology("order is not open", 400)
+
+    # Tombstone it in this worker's book, other workers drop it when they next prune theirs
+    current_app.extensions["order_matcher"].discard(order_id)
+
+    return redirect("/orders")
+
+
+@views.route("/quote", methods=["GET", "POST"])
 @login_required
 def quote():
     """Get stock quote."""
@@ -364,45 +968,50 @@ def quote():
         ticker = request.form.get("symbol")
 
         # Dictionary for user's desired stock info
-        stockDict = lookup(ticker)
+        try:
+            stockDict = lookup(ticker)
+        except MarketDataUnavailable:
+            return apology("market data temporarily unavailable", 503)
 
         # Ensure ticker symbol actually exists
         if not stockDict:
             return apology("not a valid ticker symbol", 400)
 
-        # Stores stock info in session objects
-        session['stockName'] = stockDict["name"]
-        session['stockPrice'] = usd(stockDict["price"])
-        session['stockSymbol'] = stockDict["symbol"]
-
-        # Render quoted template with looked up info
-        return redirect("/quoted.html")
+        # Render quoted template with looked up info, the symbol travels in the URL
+        return redirect(url_for(".quoted", symbol=stockDict["symbol"]))
 
     # User reached route via GET (as by clicking a link or via redirect)
     else:
         return render_template("quote.html")
 
 
-@app.route("/quoted.html")
+@views.route("/quoted.html")
 @login_required
 def quoted():
     """Provide quoted stock price."""
 
-    # Retrieve session data for stock info
-    stockName = session.get('stockName')
-    stockPrice = session.get('stockPrice')
-    stockSymbol = session.get('stockSymbol')
-    # Pass data into html file and render it
-    return render_template("quoted.html", name=stockName, price=stockPrice, ticker=stockSymbol)
+    # Stock info, served from the quote cache after the lookup in quote()
+    try:
+        stockDict = lookup(request.args.get("symbol", ""))
+    except MarketDataUnavailable:
+        return apology("market data temporarily unavailable", 503)
+
+    # Ensure ticker symbol actually exists
+    if not stockDict:
+        return apology("not a valid ticker symbol", 400)
+
+    # Pass data into html file and render it, flagging last known (stale) prices
+    return render_template("quoted.html", name=stockDict["name"], price=usd(stockDict["price"]),
+                           ticker=stockDict["symbol"], stale=stockDict.get("stale", False))
 
 
-@app.route("/register", methods=["GET", "POST"])
+@views.route("/register", methods=["GET", "POST"])
 def register():
     """Register user"""
 
     try:
-        # Connect to the SQL database
-        dbcon = sqlite3.connect("finance.db")
+        # Connection to the SQL database, shared for the rest of the request
+        dbcon = get_db()
         sql_cursor = dbcon.cursor()
 
         # Forget any user_id
@@ -468,7 +1077,8 @@ def register():
                 return apology("password must contain at 1 special character", 400)
 
             # Hashes user's new password
-            hashPass = generate_password_hash(newPass, method='pbkdf2:sha256', salt_length=8)
+            with timed("operation", "password_hash"):
+                hashPass = current_app.extensions["password_hasher"].hash(newPass)
 
             # Adds new user to the database
             sql_cursor.execute("INSERT INTO users (username, hash) VALUES(?, ?)", (newUsername, hashPass,))
@@ -482,18 +1092,18 @@ def register():
             return render_template("register.html")
 
     finally:
-        # Close database connection
+        # Close cursor, the connection itself is closed on app context teardown
         sql_cursor.close()
 
 
-@app.route("/sell", methods=["GET", "POST"])
+@views.route("/sell", methods=["GET", "POST"])
 @login_required
 def sell():
     """Sell shares of stock"""
 
     try:
-        # Connect to the SQL database
-        dbcon = sqlite3.connect("finance.db")
+        # Connection to the SQL database, shared for the rest of the request
+        dbcon = get_db()
         sql_cursor = dbcon.cursor()
 
         # Indices for SQL
@@ -519,8 +1129,15 @@ def sell():
             if shares < 1:
                 return apology("Invalid, purchased shares must be great than value of 0", 400)
 
+            # Ensure shares is a whole number
+            if shares % 1 != 0:
+                return apology("cannot sell fractional shares", 400)
+
             # Dictionary for user's desired stock info
-            stockDict = lookup(symbol)
+            try:
+                stockDict = lookup(symbol, max_age=current_app.config["QUOTE_TRADE_MAX_AGE"], priority=PRIORITY_TRADE)
+            except MarketDataUnavailable:
+                return apology("market data temporarily unavailable", 503)
 
             # Ensure ticker symbol actually exists
             if not stockDict:
@@ -531,37 +1148,11 @@ def sell():
             stockPrice = stockDict["price"]
             stockSymbol = stockDict["symbol"]
 
-            # Selects all of user's available stocks
-            holdings = sql_cursor.execute("SELECT * FROM portfolio WHERE user_id = ? AND symbol = ?",
-                                          (user_id, stockSymbol,)).fetchall()
-
-            # Informs user if they do not own stock and returns apology
-            if not holdings:
-                return apology("you do not own any shares of this stock", 400)
-
-            current_shares = holdings[0][portfolio_total_shares_ind]
-
-            # Ensure user has sufficient shares to complete sell order
-            if shares > current_shares:
-                return apology("not enough shares to complete transaction", 400)
-
-            # Updates user's portfolio accordingly
-            sql_cursor.execute("UPDATE portfolio SET total_shares = total_shares - ? WHERE user_id = ? AND symbol = ?",
-                               (shares, user_id, stockSymbol,))
-            dbcon.commit()
-
-            # Adds cash gains to user's total cash in account
-            gains = shares * stockPrice
-            sql_cursor.execute("UPDATE users SET cash = cash + ? WHERE id = ?", (gains, user_id,))
-            dbcon.commit()
-
-            # Formats timestamp before inserting into database
-            formatted_timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-            # Record transaction into history table
-            sql_cursor.execute("INSERT INTO history (user_id, order_type, ticker, shares, price, timestamp) VALUES(?, ?, ?, ?, ?, ?)",
-                               (user_id, 'sell', stockSymbol, shares, stockPrice, formatted_timestamp,))
-            dbcon.commit()
+            # Executes the sale as one transaction
+            try:
+                execute_sell(dbcon, user_id, stockSymbol, int(shares), stockPrice)
+            except TradeError as error:
+                return apology(str(error), 400)
 
             # Redirect user to the hompage once purchase complete
             return redirect("/")
@@ -585,5 +1176,5 @@ def sell():
             return render_template("sell.html", ticker=ticker)
 
     finally:
-        # Close database connection
+        # Close cursor, the connection itself is closed on app context teardown
         sql_cursor.close()
@@ -0,0 +1,103 @@
+import csv
+import io
+
+from db import immediate_transaction
+from helpers import from_cents, to_cents
+from trades import TradeError, apply_buy, apply_sell
+
+
+## Basket orders: many buy / sell legs priced together and applied in one transaction. ##
+
+# Most legs accepted in one basket
+BASKET_MAX_LEGS = 100
+
+# Columns of an uploaded basket CSV (a header row is required)
+BASKET_CSV_COLUMNS = ("symbol", "side", "shares")
+
+
+def _leg(number, symbol, side, shares):
+    """Validate one leg, raises ValueError with a message for the user."""
+
+    symbol = (symbol or "").strip().upper()
+    side = (side or "").strip().lower()
+    if not symbol:
+        raise ValueError(f"leg {number}: must provide ticker symbol")
+    if side not in ("buy", "sell"):
+        raise ValueError(f"leg {number}: side must be buy or sell")
+    try:
+        shares = float(shares)
+    except (TypeError, ValueError):
+        raise ValueError(f"leg {number}: shares must be numeric")
+    if shares < 1 or shares % 1 != 0:
+        raise ValueError(f"leg {number}: shares must be a whole number greater than 0")
+    return {"symbol": symbol, "side": side, "shares": int(shares)}
+
+
+def parse_basket_form(form):
+    """Read legs from the parallel symbol / side / shares form rows, skipping blank rows."""
+
+    legs = []
+    for symbol, side, shares in zip(form.getlist("symbol"), form.getlist("side"), form.getlist("shares")):
+        if not symbol.strip() and not shares.strip():
+            continue
+        legs.append(_leg(len(legs) + 1, symbol, side, shares))
+    return _checked(legs)
+
+
+def parse_basket_csv(stream):
+    """Read legs from an uploaded CSV file with a symbol,side,shares header."""
+
+    try:
+        reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig"))
+        if reader.fieldnames is None or not set(BASKET_CSV_COLUMNS) <= {name.strip().lower() for name in reader.fieldnames}:
+            raise ValueError("basket CSV needs a symbol,side,shares header")
+        legs = []
+        for row in reader:
+            row = {(key or "").strip().lower(): value for key, value in row.items()}
+            if not any((value or "").strip() for value in row.values() if isinstance(value, str)):
+                continue
+            legs.append(_leg(len(legs) + 1, row["symbol"], row["side"], row["shares"]))
+            if len(legs) > BASKET_MAX_LEGS:
+                break
+    except (UnicodeDecodeError, csv.Error):
+        raise ValueError("basket file is not a valid CSV")
+    return _checked(legs)
+
+
+def _checked(legs):
+    if not legs:
+        raise ValueError("basket has no legs")
+    if len(legs) > BASKET_MAX_LEGS:
+        raise ValueError(f"basket has more than {BASKET_MAX_LEGS} legs")
+    return legs
+
+
+def execute_basket(dbcon, user_id, legs, quotes):
+    """
+    Apply every leg at its quoted price in one transaction and return the fill report.
+
+    quotes maps each symbol to its quote. Sells are applied before buys so
+    their proceeds can pay for the buys; if any leg cannot be filled (cash or
+    shares across the whole basket) nothing is applied and TradeError names
+    the failing leg. Each report row is the leg plus price and amount in dollars.
+    """
+
+    report = []
+    for number, leg in enumerate(legs, start=1):
+        quote = quotes.get(leg["symbol"])
+        if quote is None or quote.get("stale"):
+            raise TradeError(f"leg {number} ({leg['symbol']}): no current price")
+        report.append(dict(leg, number=number, company=quote["name"], price=quote["price"],
+                           amount=from_cents(leg["shares"] * to_cents(quote["price"]))))
+
+    with immediate_transaction(dbcon):
+        for fill in sorted(report, key=lambda fill: fill["side"] != "sell"):
+            try:
+                if fill["side"] == "sell":
+                    apply_sell(dbcon, user_id, fill["symbol"], fill["shares"], fill["price"])
+                else:
+                    apply_buy(dbcon, user_id, fill["symbol"], fill["company"], fill["shares"], fill["price"])
+            except TradeError as error:
+                raise TradeError(f"leg {fill['number']} ({fill['side']} {fill['symbol']}): {error}")
+
+    return report
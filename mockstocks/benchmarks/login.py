@@ -0,0 +1,162 @@
+"""
+Measure login throughput and how much a login burst slows the other routes.
+
+Runs the same traffic three times against one seeded database: dashboard and
+quote sessions alone, then with a burst of concurrent logins hashing inline on
+the request threads (the old behaviour), then with the logins going through
+the bounded password hashing pool. Run from the mockstocks directory, e.g.
+    python -m benchmarks.login --logins 16 --sessions 4 --duration 15 --workers 2 --output login.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.run import Recorder, percentile
+from benchmarks.seed import BENCH_PASSWORD, bench_symbols, seed, write_bench_tape
+
+
+# Routes the background sessions keep hitting while the logins run
+OTHER_ROUTES = ("/", "/quote")
+
+
+def login_burst(app, recorder, users, index, deadline):
+    """Log in as synthetic users back to back until deadline, backing off as told when shed with a 503."""
+    client = app.test_client()
+    attempt = index
+    while time.perf_counter() < deadline:
+        form = {"username": f"bench{1 + attempt % users}", "password": BENCH_PASSWORD}
+        response = recorder.timed("/login", lambda: client.post("/login", data=form))
+        if response.status_code == 503:
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+        attempt += 1
+
+
+def other_traffic(client, recorder, symbols, index, deadline):
+    """Alternate between the dashboard and a quote on an already logged in client until deadline."""
+    request = index
+    while time.perf_counter() < deadline:
+        if request % 2 == 0:
+            recorder.timed("/", lambda: client.get("/"))
+        else:
+            symbol = symbols[request % len(symbols)]
+            recorder.timed("/quote", lambda: client.post("/quote", data={"symbol": symbol}))
+        request += 1
+
+
+def run_phase(app, clients, symbols, users, logins, duration):
+    """Run the other routes, plus logins threads when logins > 0, for duration seconds."""
+
+    recorder = Recorder()
+    started = time.perf_counter()
+    deadline = started + duration
+    threads = [threading.Thread(target=other_traffic, args=(client, recorder, symbols, i, deadline))
+               for i, client in enumerate(clients)]
+    threads += [threading.Thread(target=login_burst, args=(app, recorder, users, i, deadline)) for i in range(logins)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started
+
+    def stats(samples):
+        latencies = sorted(sample[0] for sample in samples)
+        return {
+            "requests": len(samples),
+            "rps": len(samples) / wall_time,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+        }
+
+    logins_done = recorder.samples.get("/login", [])
+    other = [sample for route in OTHER_ROUTES for sample in recorder.samples.get(route, [])]
+    return {
+        "login": dict(stats([sample for sample in logins_done if sample[1] == 302]),
+                      rejected=sum(1 for sample in logins_done if sample[1] == 503)),
+        "other": stats(other),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--symbols", type=int, default=50)
+    parser.add_argument("--logins", type=int, default=16, help="concurrent threads logging in")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent dashboard / quote sessions")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per phase")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="password hashing processes for the pooled phase")
+    parser.add_argument("--queue-depth", type=int, help="hashes in flight before a 503 (default 4 per worker)")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated upstream latency in seconds")
+    parser.add_argument("--output", help="write results as JSON here")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="mockstocks-bench-")
+    database = os.path.join(workdir, "bench.db")
+    tape = os.path.join(workdir, "tape.csv.gz")
+    symbols = bench_symbols(args.symbols)
+
+    seed(database, args.users, 10, 1000, args.symbols)
+    write_bench_tape(tape, symbols)
+
+    # create_app reads its configuration from the environment
+    os.environ.update({
+        "DATABASE": database,
+        "MARKET_DATA_PROVIDER": "replay",
+        "MARKET_DATA_TAPE": tape,
+        "MARKET_DATA_REPLAY_LATENCY": str(args.latency),
+        "MARKET_DATA_RATE_PER_SECOND": "1000000",
+        "MARKET_DATA_RATE_PER_MINUTE": "60000000",
+        "SCHEDULER_ENABLED": "0",
+        "SLOW_REQUEST_THRESHOLD": "0",
+    })
+    from app import create_app
+    from passwords import PasswordHasher
+
+    app = create_app()
+    method, salt_length = app.config["PASSWORD_HASH_METHOD"], app.config["PASSWORD_SALT_LENGTH"]
+    inline = PasswordHasher(0, 1, method, salt_length)
+    pooled = PasswordHasher(args.workers, args.queue_depth or 4 * args.workers, method, salt_length)
+
+    # Log the background sessions in once, up front
+    app.extensions["password_hasher"] = inline
+    clients = []
+    for i in range(args.sessions):
+        client = app.test_client()
+        client.post("/login", data={"username": f"bench{1 + i % args.users}", "password": BENCH_PASSWORD})
+        clients.append(client)
+
+    result = {"phases": {}}
+    for phase, hasher, logins in (("no logins", inline, 0), ("inline hashing", inline, args.logins),
+                                  ("hashing pool", pooled, args.logins)):
+        app.extensions["password_hasher"] = hasher
+        result["phases"][phase] = run_phase(app, clients, symbols, args.users, logins, args.duration)
+    pooled.close()
+
+    result["run"] = {
+        "at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+    }
+
+    # Human-readable report
+    print(f"{'phase':<16}{'login/s':>9}{'login p95':>11}{'503s':>6}{'other/s':>9}{'other p50':>11}{'other p95':>11}")
+    for phase, stats in result["phases"].items():
+        login, other = stats["login"], stats["other"]
+        print(f"{phase:<16}{login['rps']:>9.1f}{login['p95_ms']:>11.1f}{login['rejected']:>6}"
+              f"{other['rps']:>9.1f}{other['p50_ms']:>11.1f}{other['p95_ms']:>11.1f}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
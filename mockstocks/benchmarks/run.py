@@ -0,0 +1,269 @@
+"""
+Drive the Flask app with concurrent simulated sessions and report per-route throughput and latency.
+
+Quotes come from the offline replay provider with injectable latency, so runs
+are reproducible and never touch IEX. Run from the mockstocks directory, e.g.
+    python -m benchmarks.run --users 200 --history 1000000 --sessions 16 --duration 30 \\
+        --latency 0.05 --output results.json --baseline baseline.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.seed import BENCH_PASSWORD, bench_symbols, seed, write_bench_tape
+
+
+# Relative weight of each simulated action
+DEFAULT_MIX = {
+    "/": 30,
+    "/quote": 15,
+    "/buy": 10,
+    "/sell": 10,
+    "/history": 25,
+    "/login": 5,
+    "/register": 5,
+}
+
+
+class Recorder:
+    """Per-route latencies and per-request SQL / upstream call counts, filled in by session threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self._local = threading.local()
+
+    def count(self, counter):
+        """Count one SQL statement or upstream call against the request running on this thread."""
+        counts = getattr(self._local, "counts", None)
+        if counts is not None:
+            counts[counter] += 1
+
+    def timed(self, route, call):
+        """Run one request, recording its latency, status and counters under route, and return its response."""
+        self._local.counts = {"sql": 0, "upstream": 0}
+        start = time.perf_counter()
+        response = call()
+        elapsed = time.perf_counter() - start
+        response.close()
+        counts = self._local.counts
+        self._local.counts = None
+        with self._lock:
+            self.samples.setdefault(route, []).append((elapsed, response.status_code, counts["sql"], counts["upstream"]))
+        return response
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def instrument(recorder, app):
+    """
+    Count SQL statements on app's pooled connections and every new one, and
+    calls into the market data provider.
+    """
+
+    import db
+    import helpers
+
+    def count_statement(statement):
+        recorder.count("sql")
+
+    # create_app already opened (and warmed) the pooled connections
+    for dbcon in app.extensions["db_pool"].idle():
+        dbcon.set_trace_callback(count_statement)
+
+    connect = db.connect
+
+    def counting_connect(*args, **kwargs):
+        dbcon = connect(*args, **kwargs)
+        dbcon.set_trace_callback(count_statement)
+        return dbcon
+
+    db.connect = counting_connect
+
+    provider = helpers.provider
+    quote, quotes = provider.quote, provider.quotes
+
+    def counting_quote(symbol):
+        recorder.count("upstream")
+        return quote(symbol)
+
+    def counting_quotes(symbols):
+        recorder.count("upstream")
+        return quotes(symbols)
+
+    provider.quote, provider.quotes = counting_quote, counting_quotes
+
+
+def simulate_session(app, recorder, user_id, symbols, mix, deadline, rng):
+    """Log in as one synthetic user and issue weighted random requests until deadline."""
+
+    client = app.test_client()
+    login = {"username": f"bench{user_id}", "password": BENCH_PASSWORD}
+    recorder.timed("/login", lambda: client.post("/login", data=login))
+
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    registered = 0
+
+    while time.perf_counter() < deadline:
+        route = rng.choices(routes, weights)[0]
+        symbol = rng.choice(symbols)
+
+        if route == "/":
+            recorder.timed(route, lambda: client.get("/"))
+        elif route == "/history":
+            recorder.timed(route, lambda: client.get("/history"))
+        elif route == "/quote":
+            recorder.timed(route, lambda: client.post("/quote", data={"symbol": symbol}))
+        elif route == "/buy":
+            recorder.timed(route, lambda: client.post("/buy", data={"symbol": symbol, "shares": "1"}))
+        elif route == "/sell":
+            recorder.timed(route, lambda: client.post("/sell", data={"symbol": symbol, "shares": "1"}))
+        elif route == "/login":
+            recorder.timed(route, lambda: client.post("/login", data=login))
+        elif route == "/register":
+            registered += 1
+            password = BENCH_PASSWORD
+            form = {"username": f"new{user_id}_{registered}_{rng.random()}", "password": password,
+                    "confirmation": password}
+            recorder.timed(route, lambda: client.post("/register", data=form))
+            # Registering logs the session out, log back in as the synthetic user
+            client.post("/login", data=login)
+
+
+def summarize(recorder, wall_time):
+    """Build the machine-readable result for every route."""
+
+    routes = {}
+    total = 0
+    for route, samples in sorted(recorder.samples.items()):
+        latencies = sorted(sample[0] for sample in samples)
+        total += len(samples)
+        routes[route] = {
+            "requests": len(samples),
+            "rps": len(samples) / wall_time,
+            "errors": sum(1 for sample in samples if sample[1] >= 500),
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "sql_per_request": sum(sample[2] for sample in samples) / len(samples),
+            "upstream_per_request": sum(sample[3] for sample in samples) / len(samples),
+        }
+    return {"rps": total / wall_time, "requests": total, "routes": routes}
+
+
+def compare(result, baseline, tolerance):
+    """Return a description of every route that regressed beyond tolerance versus baseline."""
+
+    regressions = []
+    for route, old in baseline.get("routes", {}).items():
+        new = result["routes"].get(route)
+        if new is None:
+            continue
+        if new["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {old['p95_ms']:.1f}ms -> {new['p95_ms']:.1f}ms")
+        if new["rps"] < old["rps"] * (1 - tolerance):
+            regressions.append(f"{route}: rps {old['rps']:.1f} -> {new['rps']:.1f}")
+        if new["sql_per_request"] > old["sql_per_request"] * (1 + tolerance):
+            regressions.append(f"{route}: sql/request {old['sql_per_request']:.1f} -> {new['sql_per_request']:.1f}")
+        if new["upstream_per_request"] > old["upstream_per_request"] * (1 + tolerance):
+            regressions.append(f"{route}: upstream/request {old['upstream_per_request']:.2f} -> {new['upstream_per_request']:.2f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="use this already seeded database instead of seeding a temporary one")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--holdings", type=int, default=20)
+    parser.add_argument("--history", type=int, default=100000)
+    parser.add_argument("--symbols", type=int, default=500)
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent simulated sessions")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated upstream latency in seconds")
+    parser.add_argument("--mix", help="JSON object of route weights, e.g. '{\"/\": 1}'")
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--baseline", help="compare against this earlier results file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="mockstocks-bench-")
+    database = args.db or os.path.join(workdir, "bench.db")
+    tape = os.path.join(workdir, "tape.csv.gz")
+    symbols = bench_symbols(args.symbols)
+
+    if not args.db:
+        seed(database, args.users, args.holdings, args.history, args.symbols, args.seed)
+    write_bench_tape(tape, symbols, seed=args.seed)
+
+    # create_app reads its configuration from the environment
+    os.environ.update({
+        "DATABASE": database,
+        "MARKET_DATA_PROVIDER": "replay",
+        "MARKET_DATA_TAPE": tape,
+        "MARKET_DATA_REPLAY_LATENCY": str(args.latency),
+        "MARKET_DATA_RATE_PER_SECOND": "1000000",
+        "MARKET_DATA_RATE_PER_MINUTE": "60000000",
+    })
+    from app import create_app
+    app = create_app()
+
+    recorder = Recorder()
+    instrument(recorder, app)
+    mix = json.loads(args.mix) if args.mix else DEFAULT_MIX
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=simulate_session,
+                                args=(app, recorder, 1 + i % args.users, symbols, mix, deadline,
+                                      random.Random(args.seed + i)))
+               for i in range(args.sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started
+
+    result = summarize(recorder, wall_time)
+    result["run"] = {
+        "at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "args": vars(args),
+    }
+
+    # Human-readable report
+    print(f"{'route':<12}{'req':>8}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'sql/req':>9}{'up/req':>8}{'5xx':>6}")
+    for route, stats in result["routes"].items():
+        print(f"{route:<12}{stats['requests']:>8}{stats['rps']:>9.1f}{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}"
+              f"{stats['p99_ms']:>9.1f}{stats['sql_per_request']:>9.1f}{stats['upstream_per_request']:>8.2f}{stats['errors']:>6}")
+    print(f"total {result['requests']} requests, {result['rps']:.1f} req/s")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(result, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+Seed a benchmark copy of 'finance.db' with synthetic users, portfolios and history.
+
+Run from the mockstocks directory, e.g.
+    python -m benchmarks.seed --db /tmp/bench.db --users 1000 --history 2000000
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from werkzeug.security import generate_password_hash
+
+
+# Password shared by every synthetic user, hashed once while seeding
+BENCH_PASSWORD = "bench12!pw"
+
+# Original schema of 'finance.db' (see app.py), migrations.py upgrades it from there
+BASE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        username TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        cash NUMERIC NOT NULL DEFAULT 10000.00
+        )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS username ON users (username)",
+    """CREATE TABLE IF NOT EXISTS history (
+        transaction_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        user_id INTEGER NOT NULL,
+        order_type TEXT NOT NULL CHECK (order_type IN ('sell', 'buy')),
+        ticker TEXT NOT NULL,
+        shares NUMERIC NOT NULL,
+        price NUMERIC NOT NULL,
+        timestamp DATETIME NOT NULL
+        )""",
+    """CREATE TABLE IF NOT EXISTS portfolio (
+        holding_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        user_id INTEGER NOT NULL,
+        symbol TEXT NOT NULL,
+        company TEXT NOT NULL,
+        total_shares NUMERIC NOT NULL
+        )""",
+]
+
+
+def bench_symbols(count):
+    """Return count synthetic ticker symbols."""
+    return [f"S{i:04d}" for i in range(count)]
+
+
+def write_bench_tape(path, symbols, ticks=600, seed=0):
+    """Write a random-walk quote tape for symbols, one tick per second."""
+
+    # Imported here so seeding does not need the app's modules on the path
+    from providers import write_tape
+
+    rng = random.Random(seed)
+    start = time.time()
+    prices = {symbol: rng.uniform(5, 500) for symbol in symbols}
+
+    def generate():
+        for tick in range(ticks):
+            for symbol in symbols:
+                prices[symbol] = max(1.0, prices[symbol] * (1 + rng.gauss(0, 0.002)))
+                yield symbol, start + tick, prices[symbol], f"{symbol} Corp"
+
+    write_tape(path, generate())
+
+
+def seed(path, users, holdings, history, symbols, seed=0):
+    """Create a fresh, fully migrated database at path filled with synthetic data."""
+
+    from migrations import migrate
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = random.Random(seed)
+    dbcon = sqlite3.connect(path)
+    dbcon.execute("PRAGMA journal_mode = WAL")
+    dbcon.execute("PRAGMA synchronous = OFF")
+    for statement in BASE_SCHEMA:
+        dbcon.execute(statement)
+    dbcon.commit()
+    migrate(dbcon)
+
+    hashed = generate_password_hash(BENCH_PASSWORD, method='pbkdf2:sha256', salt_length=8)
+    names = bench_symbols(symbols)
+
+    # Users, cash in integer cents
+    dbcon.executemany("INSERT INTO users (id, username, hash, cash) VALUES (?, ?, ?, ?)",
+                      ((i, f"bench{i}", hashed, rng.randint(100000, 10000000)) for i in range(1, users + 1)))
+
+    # Portfolios, one row per (user, symbol)
+    def portfolio_rows():
+        for user_id in range(1, users + 1):
+            for symbol in rng.sample(names, min(holdings, len(names))):
+                yield user_id, symbol, f"{symbol} Corp", rng.randint(1, 500)
+
+    dbcon.executemany("INSERT INTO portfolio (user_id, symbol, company, total_shares) VALUES (?, ?, ?, ?)", portfolio_rows())
+
+    # History spread over the last two years, prices in integer cents
+    now = datetime.datetime.now()
+
+    def history_rows():
+        for _ in range(history):
+            moment = now - datetime.timedelta(seconds=rng.randint(0, 2 * 365 * 86400))
+            yield (rng.randint(1, users), rng.choice(("buy", "sell")), rng.choice(names), rng.randint(1, 100),
+                   rng.randint(100, 50000), moment.strftime('%Y-%m-%d %H:%M:%S'))
+
+    dbcon.executemany("INSERT INTO history (user_id, order_type, ticker, shares, price, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                      history_rows())
+    dbcon.commit()
+    dbcon.execute("ANALYZE")
+    dbcon.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True, help="database file to create (overwritten)")
+    parser.add_argument("--tape", help="also write a replay quote tape for the seeded symbols here")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--holdings", type=int, default=20, help="positions per user")
+    parser.add_argument("--history", type=int, default=100000, help="total history rows")
+    parser.add_argument("--symbols", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    seed(args.db, args.users, args.holdings, args.history, args.symbols, args.seed)
+    if args.tape:
+        write_bench_tape(args.tape, bench_symbols(args.symbols), seed=args.seed)
+    print(f"Seeded {args.db} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
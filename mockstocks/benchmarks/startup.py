@@ -0,0 +1,150 @@
+"""
+Measure worker startup time and the latency of the first requests after a restart.
+
+Seeds a database, runs one worker that browses every user's pages (filling the
+database snapshots and writing the quote snapshot at exit), then starts fresh
+worker processes cold (no quote snapshot, no pooled connections) and warm
+(quote snapshot loaded, statements prepared on pooled connections) and times
+importing the app, create_app and each worker's first requests. Run from the
+mockstocks directory, e.g.
+    python -m benchmarks.startup --runs 5 --latency 0.05 --output startup.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.seed import BENCH_PASSWORD, bench_symbols, seed, write_bench_tape
+
+
+# Requests timed in order right after startup, by one logged in session
+FIRST_REQUESTS = ("/", "/quote", "/history")
+
+
+def worker(users):
+    """Start the app in this process, browse as the first user and return the timings."""
+
+    started = time.perf_counter()
+    from app import create_app
+    imported = time.perf_counter()
+    app = create_app()
+    created = time.perf_counter()
+
+    from benchmarks.run import Recorder, instrument
+
+    recorder = Recorder()
+    instrument(recorder, app)
+
+    client = app.test_client()
+    client.post("/login", data={"username": "bench1", "password": BENCH_PASSWORD})
+
+    # Quotes one symbol the user holds, so a warm cache can answer it
+    with app.app_context():
+        from db import get_db
+        symbol = get_db().execute("SELECT symbol FROM portfolio WHERE user_id = 1 ORDER BY symbol LIMIT 1").fetchone()[0]
+
+    recorder.timed("/", lambda: client.get("/"))
+    recorder.timed("/quote", lambda: client.post("/quote", data={"symbol": symbol}))
+    recorder.timed("/history", lambda: client.get("/history"))
+
+    # Every other user's dashboard, which leaves fresh prices and quotes behind for the next worker
+    for user_id in range(2, users + 1):
+        other = app.test_client()
+        other.post("/login", data={"username": f"bench{user_id}", "password": BENCH_PASSWORD})
+        other.get("/")
+
+    return {
+        "import_ms": (imported - started) * 1000,
+        "create_app_ms": (created - imported) * 1000,
+        "first": {route: {"ms": recorder.samples[route][0][0] * 1000, "sql": recorder.samples[route][0][2],
+                          "upstream": recorder.samples[route][0][3]}
+                  for route in FIRST_REQUESTS},
+    }
+
+
+def start_worker(env, users):
+    """Run worker in a fresh interpreter with env and return its timings."""
+    output = subprocess.run([sys.executable, "-m", "benchmarks.startup", "--worker", "--users", str(users)],
+                            env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def summarize(runs):
+    """Median of every timing over runs."""
+    return {
+        "import_ms": statistics.median(run["import_ms"] for run in runs),
+        "create_app_ms": statistics.median(run["create_app_ms"] for run in runs),
+        "first": {route: {key: statistics.median(run["first"][route][key] for run in runs)
+                          for key in ("ms", "sql", "upstream")}
+                  for route in FIRST_REQUESTS},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--holdings", type=int, default=20)
+    parser.add_argument("--history", type=int, default=100000)
+    parser.add_argument("--symbols", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=3, help="worker starts per mode")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated upstream latency in seconds")
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(worker(args.users)))
+        return 0
+
+    workdir = tempfile.mkdtemp(prefix="mockstocks-bench-")
+    database = os.path.join(workdir, "bench.db")
+    tape = os.path.join(workdir, "tape.csv.gz")
+    snapshot = os.path.join(workdir, "quotes.json.gz")
+
+    seed(database, args.users, args.holdings, args.history, args.symbols)
+    # A short tape, so loading it does not swamp the rest of create_app
+    write_bench_tape(tape, bench_symbols(args.symbols), ticks=20)
+
+    env = dict(os.environ, DATABASE=database, SESSION_DATABASE=os.path.join(workdir, "sessions.db"),
+               MARKET_DATA_PROVIDER="replay", MARKET_DATA_TAPE=tape, MARKET_DATA_REPLAY_LATENCY=str(args.latency),
+               MARKET_DATA_RATE_PER_SECOND="1000000", MARKET_DATA_RATE_PER_MINUTE="60000000",
+               QUOTE_SNAPSHOT_PATH=snapshot, SCHEDULER_ENABLED="0", PASSWORD_HASH_WORKERS="0",
+               SLOW_REQUEST_THRESHOLD="0")
+    modes = {
+        "cold": dict(env, QUOTE_SNAPSHOT_PATH="", SQLITE_POOL_SIZE="0"),
+        "warm": env,
+    }
+
+    # Migrates the new database and leaves a quote snapshot behind
+    start_worker(env, args.users)
+
+    result = {"modes": {}}
+    for mode, mode_env in modes.items():
+        result["modes"][mode] = summarize([start_worker(mode_env, args.users) for _ in range(args.runs)])
+    result["run"] = {
+        "at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "args": vars(args),
+    }
+
+    # Human-readable report
+    print(f"{'mode':<6}{'import ms':>11}{'create_app ms':>15}" + "".join(f"{route + ' ms':>12}{'up':>4}" for route in FIRST_REQUESTS))
+    for mode, stats in result["modes"].items():
+        print(f"{mode:<6}{stats['import_ms']:>11.1f}{stats['create_app_ms']:>15.1f}"
+              + "".join(f"{stats['first'][route]['ms']:>12.1f}{stats['first'][route]['upstream']:>4.0f}"
+                        for route in FIRST_REQUESTS))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+import threading
+import time
+
+
+# Priority classes for upstream market data calls, most important first
+PRIORITY_TRADE, PRIORITY_QUOTE, PRIORITY_REFRESH = range(3)
+PRIORITY_NAMES = {PRIORITY_TRADE: "trade", PRIORITY_QUOTE: "quote", PRIORITY_REFRESH: "refresh"}
+
+# Share of each bucket a priority class must leave untouched for more important callers (see TokenBucket.floor)
+PRIORITY_RESERVES = {PRIORITY_TRADE: 0.0, PRIORITY_QUOTE: 0.2, PRIORITY_REFRESH: 0.5}
+
+
+class TokenBucket:
+    """Token bucket refilling at rate tokens per second up to capacity. Not thread-safe on its own."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def floor(self, cost, reserve):
+        """
+        Tokens a call of cost must leave behind at this reserve: its share of
+        the capacity but at least one token, only as far as a full bucket still
+        fits the call, so small buckets never lock a priority class out.
+        """
+        wanted = max(reserve * self.capacity, 1.0) if reserve > 0 else 0.0
+        return min(wanted, max(0.0, self.capacity - cost))
+
+    def can_take(self, cost, reserve):
+        return self.tokens - cost >= self.floor(cost, reserve)
+
+    def wait_time(self, cost, reserve):
+        """Seconds until cost tokens can be taken above the reserve."""
+        missing = self.floor(cost, reserve) + cost - self.tokens
+        return max(0.0, missing / self.rate)
+
+
+class RequestBudget:
+    """
+    Governor for upstream market data calls with a per-second and a per-minute budget.
+
+    Lower priority classes may only spend tokens while the buckets are above
+    their reserve, so trades keep headroom when /quote or portfolio refreshes
+    drain the budget. The budget is per process: N workers together may call
+    the upstream N times the configured rates.
+    """
+
+    def __init__(self, per_second=100, per_minute=3000):
+        self._lock = threading.Lock()
+        self.configure(per_second, per_minute)
+
+        # Granted / denied calls per priority class
+        self.granted = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.denied = dict.fromkeys(PRIORITY_NAMES, 0)
+
+    def configure(self, per_second, per_minute):
+        """Reset the buckets to the given rates."""
+        if per_second <= 0 or per_minute <= 0:
+            raise RuntimeError(f"market data rates must be positive, got {per_second}/s and {per_minute}/min")
+        with self._lock:
+            self._buckets = [TokenBucket(per_second, per_second), TokenBucket(per_minute / 60, per_minute)]
+
+    def acquire(self, priority, cost=1, timeout=0.0):
+        """
+        Spend cost tokens for a call of the given priority.
+
+        Waits up to timeout seconds for tokens to refill; returns False if the
+        budget is still exhausted for this priority.
+        """
+
+        reserve = PRIORITY_RESERVES[priority]
+        deadline = time.monotonic() + timeout
+
+        while True:
+            with self._lock:
+                for bucket in self._buckets:
+                    bucket.refill()
+                if all(bucket.can_take(cost, reserve) for bucket in self._buckets):
+                    for bucket in self._buckets:
+                        bucket.tokens -= cost
+                    self.granted[priority] += 1
+                    return True
+                wait = max(bucket.wait_time(cost, reserve) for bucket in self._buckets)
+
+            if time.monotonic() + wait > deadline:
+                with self._lock:
+                    self.denied[priority] += 1
+                return False
+            time.sleep(wait)
+
+    def stats(self):
+        """Return remaining tokens and granted/denied counts per priority class."""
+        with self._lock:
+            for bucket in self._buckets:
+                bucket.refill()
+            return {
+                "second_tokens": self._buckets[0].tokens,
+                "second_capacity": self._buckets[0].capacity,
+                "minute_tokens": self._buckets[1].tokens,
+                "minute_capacity": self._buckets[1].capacity,
+                "granted": {PRIORITY_NAMES[p]: count for p, count in self.granted.items()},
+                "denied": {PRIORITY_NAMES[p]: count for p, count in self.denied.items()},
+            }
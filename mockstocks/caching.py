@@ -0,0 +1,132 @@
+import hashlib
+import os
+
+from flask import current_app, request, session, url_for
+from werkzeug.security import safe_join
+
+
+## HTTP caching: a Cache-Control policy per route, content-hashed static URLs and weak ETags. ##
+
+# Pages without a policy of their own are never stored, so nothing shows up again after logout
+DEFAULT_CACHE_CONTROL = "no-cache, no-store, must-revalidate"
+
+# Fingerprinted static URLs change whenever the file does, so browsers keep them for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Static files requested without (or with an outdated) fingerprint are revalidated on every use
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Query argument carrying a static file's fingerprint
+FINGERPRINT_ARG = "v"
+
+
+def cache_control(value):
+    """Decorate a route to send value as its Cache-Control header instead of the no-store default."""
+    def decorator(f):
+        f.cache_control = value
+        return f
+    return decorator
+
+
+class StaticFingerprints:
+    """Short content hashes of the files in a static folder, recomputed when a file's mtime or size changes."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        # filename -> ((mtime_ns, size), fingerprint)
+        self._fingerprints = {}
+
+    def get(self, filename):
+        """Return the fingerprint of filename, or None if it is not a file in the folder."""
+
+        path = safe_join(self.folder, filename)
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            return None
+
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self._fingerprints.get(filename)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with open(path, "rb") as static_file:
+            fingerprint = hashlib.sha256(static_file.read()).hexdigest()[:12]
+        self._fingerprints[filename] = (version, fingerprint)
+        return fingerprint
+
+
+def content_version(*folders):
+    """Hash every file under folders, so page ETags change when templates or static files are deployed."""
+
+    digest = hashlib.sha256()
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, folder).encode())
+                with open(path, "rb") as content:
+                    digest.update(content.read())
+    return digest.hexdigest()[:12]
+
+
+def page_etag(*parts):
+    """Weak ETag value for a page rendered from parts (user, latest row id, query string...) by this deployment."""
+    digest = hashlib.sha256(repr((current_app.config["CONTENT_VERSION"],) + parts).encode())
+    return digest.hexdigest()[:20]
+
+
+def not_modified(etag):
+    """Return a 304 response when the client already holds the page tagged etag, else None."""
+
+    # A pending flash message would be lost in a 304, so such pages are rendered again
+    if "_flashes" in session or not request.if_none_match.contains_weak(etag):
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def init_caching_app(app):
+    """Give app a Cache-Control policy per route and content fingerprinted static file URLs."""
+
+    fingerprints = StaticFingerprints(app.static_folder)
+    app.config["CONTENT_VERSION"] = content_version(os.path.join(app.root_path, app.template_folder), app.static_folder)
+
+    def fingerprinted_url_for(endpoint, **values):
+        """url_for for templates, adding the content fingerprint to static file URLs."""
+        if endpoint == "static" and "filename" in values:
+            fingerprint = fingerprints.get(values["filename"])
+            if fingerprint is not None:
+                values[FINGERPRINT_ARG] = fingerprint
+        return url_for(endpoint, **values)
+
+    app.jinja_env.globals["url_for"] = fingerprinted_url_for
+
+    @app.after_request
+    def apply_cache_policy(response):
+        """Set Cache-Control from the route's policy, unless the view already set one"""
+
+        if request.endpoint == "static":
+            fingerprint = request.args.get(FINGERPRINT_ARG)
+            if fingerprint and fingerprint == fingerprints.get(request.view_args.get("filename")):
+                response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+            else:
+                response.headers["Cache-Control"] = REVALIDATE_CACHE_CONTROL
+            return response
+
+        if "Cache-Control" in response.headers:
+            return response
+
+        view = app.view_functions.get(request.endpoint)
+        policy = getattr(view, "cache_control", None)
+        if policy is not None:
+            response.headers["Cache-Control"] = policy
+        else:
+            response.headers["Cache-Control"] = DEFAULT_CACHE_CONTROL
+            response.headers["Expires"] = 0
+            response.headers["Pragma"] = "no-cache"
+        return response
+
+    return fingerprints
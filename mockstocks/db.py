@@ -0,0 +1,145 @@
+import queue
+import sqlite3
+
+from contextlib import contextmanager
+from flask import current_app, g
+from metrics import InstrumentedConnection
+
+
+def connect(path, synchronous="NORMAL", cache_size=-20000, mmap_size=268435456, busy_timeout=5000,
+            check_same_thread=True):
+    """
+    Open a SQLite connection in WAL mode with tuned pragmas.
+
+    WAL lets readers (/, /history) run while a writer (/buy, /sell) holds the
+    database; cache_size is in pages (negative means KiB), mmap_size in bytes
+    and busy_timeout in milliseconds. Every statement is timed for /metrics.
+    check_same_thread False lets a pool hand the connection to another thread.
+    """
+
+    dbcon = sqlite3.connect(path, timeout=busy_timeout / 1000, factory=InstrumentedConnection,
+                            check_same_thread=check_same_thread)
+    dbcon.execute("PRAGMA journal_mode = WAL")
+    dbcon.execute(f"PRAGMA synchronous = {synchronous}")
+    dbcon.execute(f"PRAGMA cache_size = {int(cache_size)}")
+    dbcon.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+    dbcon.execute(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+    return dbcon
+
+
+@contextmanager
+def immediate_transaction(dbcon):
+    """
+    Run the enclosed statements in one BEGIN IMMEDIATE transaction.
+
+    The write lock is taken up front, so concurrent orders from the same user
+    queue behind each other instead of racing on stale reads. Commits once on
+    success and rolls back on any exception.
+    """
+
+    dbcon.execute("BEGIN IMMEDIATE")
+    try:
+        yield dbcon
+    except BaseException:
+        dbcon.rollback()
+        raise
+    dbcon.commit()
+
+
+def connect_app(app, check_same_thread=True):
+    """Open a connection using the database path and pragmas configured on app."""
+    return connect(app.config["DATABASE"],
+                   synchronous=app.config["SQLITE_SYNCHRONOUS"],
+                   cache_size=app.config["SQLITE_CACHE_SIZE"],
+                   mmap_size=app.config["SQLITE_MMAP_SIZE"],
+                   busy_timeout=app.config["SQLITE_BUSY_TIMEOUT"],
+                   check_same_thread=check_same_thread)
+
+
+class ConnectionPool:
+    """
+    Connections kept open between requests, at most size of them idle.
+
+    A reused connection skips opening the file and setting the pragmas, and
+    keeps its page cache and its cache of prepared statements warm. Each one
+    is used by a single request at a time; a request that finds none idle
+    opens a new one, which is closed again if the pool is full when released.
+    """
+
+    def __init__(self, connect, size=8):
+        # connect() opens a new connection usable from any thread
+        self.connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+
+    def acquire(self):
+        """Return an idle connection, or a new one if there is none."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, dbcon):
+        """Hand a connection back, rolling back whatever transaction it left open."""
+        try:
+            if dbcon.in_transaction:
+                dbcon.rollback()
+        except sqlite3.Error:
+            dbcon.close()
+            return
+        if self._idle.qsize() < self.size:
+            self._idle.put_nowait(dbcon)
+        else:
+            dbcon.close()
+
+    def warm(self, statements):
+        """
+        Open every pooled connection now and prepare statements ((sql, sample
+        parameters) pairs) on each. Only reads are run, writes are skipped.
+        Returns the number of statements prepared per connection.
+        """
+
+        reads = [(sql, params) for sql, params in statements if sql.lstrip().upper().startswith("SELECT")]
+        connections = [self.acquire() for _ in range(self.size - self._idle.qsize())]
+        for dbcon in connections:
+            for sql, params in reads:
+                # Stepping once compiles the statement into the connection's statement cache
+                cursor = dbcon.execute(sql, params)
+                cursor.fetchone()
+                cursor.close()
+        for dbcon in connections:
+            self.release(dbcon)
+        return len(reads)
+
+    def idle(self):
+        """Return the connections idle right now, e.g. to instrument them; they stay in the pool."""
+        return list(self._idle.queue)
+
+    def close(self):
+        """Close every idle connection."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def get_db():
+    """Return the connection for the current request, taking it from the app's pool on first use."""
+    if "db" not in g:
+        g.db = current_app.extensions["db_pool"].acquire()
+    return g.db
+
+
+def close_db(exception=None):
+    """Return the current request's connection to the pool, if one was taken."""
+    dbcon = g.pop("db", None)
+    if dbcon is not None:
+        current_app.extensions["db_pool"].release(dbcon)
+
+
+def init_db_app(app):
+    """Give app a connection pool and register the connection teardown."""
+    app.extensions["db_pool"] = ConnectionPool(lambda: connect_app(app, check_same_thread=False),
+                                               app.config["SQLITE_POOL_SIZE"])
+    app.teardown_appcontext(close_db)
@@ -0,0 +1,79 @@
+import csv
+import io
+import json
+
+from db import connect_app
+from flask import Response, current_app, stream_with_context
+
+
+# Rows pulled from the database per fetchmany() call while streaming an export
+EXPORT_CHUNK_SIZE = 1000
+
+# Supported export formats and their content types
+EXPORT_FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+def iter_rows(sql, params, chunk_size=EXPORT_CHUNK_SIZE, attach=None):
+    """
+    Yield rows of a query chunk by chunk so only one chunk is ever in memory.
+
+    The generator opens its own connection, because the response body keeps
+    streaming after the request's connection has been torn down. attach maps
+    schema names to database files to ATTACH to it first.
+    """
+
+    dbcon = connect_app(current_app)
+    try:
+        for name, path in (attach or {}).items():
+            dbcon.execute(f"ATTACH DATABASE ? AS {name}", (path,))
+        cursor = dbcon.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        dbcon.close()
+
+
+def csv_chunks(columns, rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield CSV text: a header line, then one string per chunk of rows."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def jsonl_chunks(columns, rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield newline-delimited JSON, one object per row, grouped per chunk of rows."""
+
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row))) + "\n")
+        if len(lines) == chunk_size:
+            yield "".join(lines)
+            lines = []
+
+    yield "".join(lines)
+
+
+def export_response(columns, rows, export_format, filename):
+    """
+    Stream rows as a CSV or JSONL download.
+
+    No Content-Length is set, so the server sends the body with chunked transfer encoding.
+    """
+
+    chunks = csv_chunks if export_format == "csv" else jsonl_chunks
+    response = Response(stream_with_context(chunks(columns, rows)), mimetype=EXPORT_FORMATS[export_format])
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}.{export_format}"
+    return response
@@ -1,9 +1,38 @@
-import os
-import requests
-import urllib.parse
+import logging
+import time
 
+from budget import PRIORITY_QUOTE, PRIORITY_REFRESH, PRIORITY_TRADE, RequestBudget
+from concurrent.futures import ThreadPoolExecutor
 from flask import redirect, render_template, request, session
 from functools import wraps
+from metrics import timed
+from quotecache import LeaseTimeout, QuoteCache, SharedQuoteCache
+
+# Shared in-process cache sitting in front of the market data provider
+quote_cache = QuoteCache()
+
+# Rate governor shared by every upstream market data call
+request_budget = RequestBudget()
+
+# Seconds a trade may wait for the request budget to refill before giving up
+TRADE_BUDGET_WAIT = 2.0
+
+# Source of quotes, set up by configure_market_data (see providers.py)
+provider = None
+
+# Upper bound on concurrent single-symbol requests when the batch endpoint fails
+LOOKUP_MAX_WORKERS = 8
+
+# Local listing of valid symbols (see symbols.py), set up by configure_symbol_index
+symbol_index = None
+
+# Callables taking {symbol: quote}, called whenever quotes are fetched from upstream (each quote carries
+# its wall clock "fetched_at")
+price_listeners = []
+
+
+class MarketDataUnavailable(Exception):
+    """Raised when a quote cannot be fetched right now (request budget spent or upstream failing), unlike an unknown symbol."""
 
 
 def apology(message, code=400):
@@ -35,30 +64,230 @@ def login_required(f):
     return decorated_function
 
 
-def lookup(symbol):
-    """Look up quote for symbol."""
+def configure_quote_cache(ttl, maxsize, backend="memory", path=None, lease_timeout=10.0):
+    """
+    Set up the quote cache with a freshness TTL (seconds) and size bound.
 
-    # Contact API
-    try:
-        api_key = os.environ.get("API_KEY")
-        url = f"https://cloud.iexapis.com/stable/stock/{urllib.parse.quote_plus(symbol)}/quote?token={api_key}"
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.RequestException:
+    backend "memory" keeps quotes in this process, "sqlite" shares them
+    between every worker process on the host through the file at path, a
+    worker waiting up to lease_timeout seconds for another's refresh.
+    """
+    global quote_cache
+    if backend == "sqlite":
+        quote_cache = SharedQuoteCache(path, ttl, maxsize, lease_timeout)
+    elif backend == "memory":
+        quote_cache = QuoteCache(ttl, maxsize)
+    else:
+        raise RuntimeError(f"unknown quote cache backend: {backend}")
+
+
+def configure_market_data(new_provider):
+    """Serve quotes from new_provider, closing the previous one."""
+    global provider
+    old = provider
+    provider = new_provider
+    if old is not None:
+        old.close()
+
+
+def configure_symbol_index(index):
+    """Reject tickers missing from index locally, before any upstream call."""
+    global symbol_index
+    symbol_index = index
+
+
+def known_symbol(symbol):
+    """False when the local symbol listing says symbol does not exist."""
+    return symbol_index is None or symbol_index.valid(symbol)
+
+
+def add_price_listener(listener):
+    """Call listener({symbol: quote}) with every batch of quotes freshly fetched from upstream."""
+    price_listeners.append(listener)
+
+
+def _notify_price_listeners(quotes):
+    """Hand freshly fetched quotes to every price listener, a failing listener never fails the lookup."""
+    quotes = {symbol: quote for symbol, quote in quotes.items() if quote is not None}
+    if not quotes:
+        return
+    for listener in price_listeners:
+        try:
+            listener(quotes)
+        except Exception:
+            logging.getLogger(__name__).exception("price listener failed")
+
+
+def market_data_latency():
+    """Return the latency histogram of upstream market data calls."""
+    return provider.latency.snapshot()
+
+
+def configure_request_budget(per_second, per_minute):
+    """Set the upstream request budget per second and per minute."""
+    request_budget.configure(per_second, per_minute)
+
+
+def request_budget_stats():
+    """Return remaining tokens and granted/denied calls per priority class."""
+    return request_budget.stats()
+
+
+def quote_cache_stats():
+    """Return hit, miss and eviction counters of the quote cache."""
+    return quote_cache.stats()
+
+
+def market_data_metrics():
+    """Return quote cache and request budget statistics as metric families for /metrics."""
+
+    cache = quote_cache.stats()
+    budget = request_budget.stats()
+    return [
+        ("mockstocks_quote_cache_entries", "gauge", "Quotes currently cached.", [({}, cache["size"])]),
+        ("mockstocks_quote_cache_events_total", "counter", "Quote cache hits, misses, evictions and coalesced loads.",
+         [({"event": event}, cache[event]) for event in ("hits", "misses", "evictions", "coalesced")]),
+        ("mockstocks_upstream_budget_tokens", "gauge", "Tokens left in the upstream request budget.",
+         [({"window": "second"}, budget["second_tokens"]), ({"window": "minute"}, budget["minute_tokens"])]),
+        ("mockstocks_upstream_budget_calls_total", "counter", "Upstream calls granted or denied by the budget.",
+         [({"priority": priority, "outcome": outcome}, count)
+          for outcome in ("granted", "denied") for priority, count in budget[outcome].items()]),
+    ]
+
+
+def lookup(symbol, max_age=None, priority=PRIORITY_QUOTE):
+    """
+    Look up quote for symbol, None for tickers missing from the local listing.
+
+    Quotes are served from the cache when younger than max_age seconds
+    (defaults to the cache TTL); trades pass a stricter max_age than views.
+    Upstream calls are governed by the request budget. When it is exhausted
+    (or IEX fails), callers below trade priority get the last known price
+    with "stale" set; without one, or for trades, MarketDataUnavailable is
+    raised.
+    """
+
+    symbol = symbol.strip().upper()
+
+    # Unknown tickers never reach the upstream
+    if not known_symbol(symbol):
         return None
 
-    # Parse response
+    def governed_fetch(symbol):
+        timeout = TRADE_BUDGET_WAIT if priority == PRIORITY_TRADE else 0.0
+        if not request_budget.acquire(priority, timeout=timeout):
+            raise MarketDataUnavailable(f"request budget exhausted for {symbol}")
+        with timed("upstream", "quote", symbol):
+            quote = _stamp(provider.quote(symbol))
+        _notify_price_listeners({symbol: quote})
+        return quote
+
     try:
-        quote = response.json()
-        return {
-            "name": quote["companyName"],
-            "price": float(quote["latestPrice"]),
-            "symbol": quote["symbol"]
-        }
-    except (KeyError, TypeError, ValueError):
+        return quote_cache.get(symbol, governed_fetch, max_age)
+    except (MarketDataUnavailable, LeaseTimeout) as error:
+        quote = _stale_quote(symbol) if priority != PRIORITY_TRADE else None
+        if quote is not None:
+            return quote
+        if isinstance(error, MarketDataUnavailable):
+            raise
+        raise MarketDataUnavailable(str(error)) from error
+
+
+def _stamp(quote):
+    """Record when quote was fetched from upstream, e.g. for the valuation snapshots."""
+    if quote is not None:
+        quote["fetched_at"] = time.time()
+    return quote
+
+
+def _stale_quote(symbol):
+    """Return the last known quote for symbol marked as stale, or None."""
+    entry = quote_cache.peek(symbol)
+    if entry is None:
         return None
+    return dict(entry[1], stale=True)
+
+
+def lookup_many(symbols, max_age=None, priority=PRIORITY_REFRESH):
+    """
+    Look up quotes for many symbols at once.
+
+    Returns a dictionary mapping each requested symbol to its quote (or None).
+    Symbols missing from the cache are fetched with the provider's batch call,
+    with the same request budget and stale fallback as lookup. Trades get
+    every quote or MarketDataUnavailable; other callers get None for quotes
+    that could not be fetched.
+    """
+
+    # Normalize and de-duplicate symbols while keeping their order
+    wanted = list(dict.fromkeys(symbol.strip().upper() for symbol in symbols))
+
+    # Serve what we can from the cache
+    quotes = {}
+    missing = []
+    for symbol in wanted:
+        # Unknown tickers never reach the upstream
+        if not known_symbol(symbol):
+            quotes[symbol] = None
+            continue
+        quote = quote_cache.get_fresh(symbol, max_age)
+        if quote is None:
+            missing.append(symbol)
+        else:
+            quotes[symbol] = quote
+
+    def fallback_lookup(symbol):
+        try:
+            return lookup(symbol, max_age, priority)
+        except MarketDataUnavailable:
+            if priority == PRIORITY_TRADE:
+                raise
+            return None
+
+    # Fetch the rest in chunks the provider accepts
+    timeout = TRADE_BUDGET_WAIT if priority == PRIORITY_TRADE else 0.0
+    for i in range(0, len(missing), provider.batch_limit):
+        chunk = missing[i:i + provider.batch_limit]
+
+        # Out of budget for this priority, serve last known prices instead (trades never trade on them)
+        if not request_budget.acquire(priority, timeout=timeout):
+            if priority == PRIORITY_TRADE:
+                raise MarketDataUnavailable(f"request budget exhausted for {len(chunk)} symbols")
+            quotes.update({symbol: _stale_quote(symbol) for symbol in chunk})
+            continue
+
+        with timed("upstream", "quotes", f"{len(chunk)} symbols"):
+            fetched = provider.quotes(chunk)
+        if fetched is not None:
+            fetched = {symbol: _stamp(quote) for symbol, quote in fetched.items()}
+
+        if fetched is None:
+            # Batch endpoint failed, fall back to a bounded fan-out of single lookups
+            with ThreadPoolExecutor(max_workers=min(LOOKUP_MAX_WORKERS, len(chunk))) as pool:
+                fetched = dict(zip(chunk, pool.map(fallback_lookup, chunk)))
+        else:
+            for symbol, quote in fetched.items():
+                if quote is not None:
+                    quote_cache.put(symbol, quote)
+            _notify_price_listeners(fetched)
+
+        quotes.update(fetched)
+
+    return {symbol: quotes.get(symbol.strip().upper()) for symbol in symbols}
 
 
 def usd(value):
-    """Format value as USD."""
+    """Format value as USD, negatives as -$5.00 (like the dashboard's script)."""
+    if value < 0:
+        return f"-${-value:,.2f}"
     return f"${value:,.2f}"
+
+
+def to_cents(dollars):
+    """Convert a dollar amount into the integer cents stored in the database."""
+    return int(round(dollars * 100))
+
+
+def from_cents(cents):
+    """Convert integer cents from the database into dollars."""
+    return cents / 100
@@ -0,0 +1,70 @@
+import click
+import time
+
+from budget import PRIORITY_REFRESH
+from db import connect_app, immediate_transaction
+from helpers import lookup_many
+
+
+## Global leaderboard, recomputed by a periodic batch job and read by /leaderboard as is. ##
+##   leaderboard   - the top LEADERBOARD_SIZE accounts with their rank and value (cents) ##
+##   account_ranks - every account's rank and value, for "your rank" below the top      ##
+
+# Columns selected from leaderboard, in this order
+leaderboard_rank_ind, leaderboard_username_ind, leaderboard_value_ind, leaderboard_computed_at_ind = range(4)
+
+
+def refresh_leaderboard(dbcon, repricer, size=100):
+    """
+    Recompute every account's value and rank in one pass.
+
+    The distinct symbols held by anyone are priced once with batch lookups
+    into the shared symbol_prices snapshot (through repricer, see
+    valuations.Repricer), then a single aggregate join over portfolio values
+    every account and a window function ranks them. A holding whose symbol
+    has no fetched price yet is valued at its snapshot price, or failing that
+    the holder's own last trade of it, like valuations.fill_snapshots.
+    """
+
+    # Prices each held symbol once, whoever holds it. Cache hits never reach the price listener, so every
+    # quote goes to the repricer, which merges them with the fetched ones and writes each price once
+    symbols = [row[0] for row in dbcon.execute("SELECT DISTINCT symbol FROM portfolio WHERE total_shares > 0")]
+    if symbols:
+        repricer.apply(lookup_many(symbols, priority=PRIORITY_REFRESH))
+
+    # Unpriced holdings fall back to the snapshot, then to one seek on history_user_ticker_timestamp
+    now = time.time()
+    with immediate_transaction(dbcon):
+        dbcon.execute("DELETE FROM account_ranks")
+        dbcon.execute("INSERT INTO account_ranks (user_id, rank, value) "
+                      "SELECT id, RANK() OVER (ORDER BY value DESC), value FROM ("
+                      "  SELECT u.id, u.cash + COALESCE(SUM(p.total_shares * COALESCE(s.price, v.price, ("
+                      "    SELECT h.price FROM history h WHERE h.user_id = p.user_id AND h.ticker = p.symbol "
+                      "    ORDER BY h.timestamp DESC, h.transaction_id DESC LIMIT 1))), 0) AS value "
+                      "  FROM users u "
+                      "  LEFT JOIN portfolio p ON p.user_id = u.id AND p.total_shares > 0 "
+                      "  LEFT JOIN symbol_prices s ON s.symbol = p.symbol "
+                      "  LEFT JOIN holding_values v ON v.user_id = p.user_id AND v.symbol = p.symbol "
+                      "  GROUP BY u.id)")
+
+        dbcon.execute("DELETE FROM leaderboard")
+        dbcon.execute("INSERT INTO leaderboard (rank, user_id, username, value, computed_at) "
+                      "SELECT r.rank, r.user_id, u.username, r.value, ? FROM account_ranks r JOIN users u ON u.id = r.user_id "
+                      "ORDER BY r.rank, r.user_id LIMIT ?", (now, size,))
+
+
+def init_leaderboard_app(app, scheduler, repricer):
+    """Schedule the leaderboard batch job and register its CLI command on app."""
+
+    scheduler.add_job("leaderboard", app.config["LEADERBOARD_INTERVAL"],
+                      lambda dbcon: refresh_leaderboard(dbcon, repricer, app.config["LEADERBOARD_SIZE"]))
+
+    @app.cli.command("refresh-leaderboard")
+    def refresh_leaderboard_command():
+        """Recompute the leaderboard now."""
+        dbcon = connect_app(app)
+        try:
+            refresh_leaderboard(dbcon, repricer, app.config["LEADERBOARD_SIZE"])
+        finally:
+            dbcon.close()
+        click.echo("Leaderboard refreshed")
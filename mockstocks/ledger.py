@@ -0,0 +1,107 @@
+import datetime
+
+
+# Columns selected for history pages and exports, in this order
+HISTORY_COLUMNS = "transaction_id, order_type, ticker, shares, price, timestamp"
+
+ledger_transaction_id_ind, ledger_order_type_ind, ledger_ticker_ind, ledger_shares_ind, ledger_price_ind, ledger_timestamp_ind = range(6)
+
+
+def parse_history_filters(args):
+    """
+    Read the optional ticker, order type and date range filters from request args.
+
+    Dates are YYYY-MM-DD and both ends are inclusive. Raises ValueError on bad input.
+    """
+
+    filters = {}
+
+    if args.get("ticker"):
+        filters["ticker"] = args.get("ticker").strip().upper()
+
+    if args.get("order_type"):
+        if args.get("order_type") not in ("buy", "sell"):
+            raise ValueError("order type must be buy or sell")
+        filters["order_type"] = args.get("order_type")
+
+    if args.get("start"):
+        filters["start"] = datetime.datetime.strptime(args.get("start"), "%Y-%m-%d").date()
+
+    if args.get("end"):
+        filters["end"] = datetime.datetime.strptime(args.get("end"), "%Y-%m-%d").date()
+
+    return filters
+
+
+def history_where(user_id, filters):
+    """Build the WHERE clause and parameters selecting a user's history rows matching filters."""
+
+    clauses = ["user_id = ?"]
+    params = [user_id]
+
+    if "ticker" in filters:
+        clauses.append("ticker = ?")
+        params.append(filters["ticker"])
+
+    if "order_type" in filters:
+        clauses.append("order_type = ?")
+        params.append(filters["order_type"])
+
+    # Timestamps are stored as 'YYYY-MM-DD HH:MM:SS' text, so date bounds compare as strings
+    if "start" in filters:
+        clauses.append("timestamp >= ?")
+        params.append(filters["start"].isoformat())
+
+    if "end" in filters:
+        clauses.append("timestamp < ?")
+        params.append((filters["end"] + datetime.timedelta(days=1)).isoformat())
+
+    return " AND ".join(clauses), params
+
+
+def encode_cursor(row):
+    """Encode the (timestamp, transaction_id) keyset position of a history row."""
+    return f"{row[ledger_timestamp_ind]}|{row[ledger_transaction_id_ind]}"
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor. Raises ValueError on bad input."""
+    timestamp, transaction_id = cursor.rsplit("|", 1)
+    return timestamp, int(transaction_id)
+
+
+def history_page(sql_cursor, user_id, filters, page_size, before=None, after=None):
+    """
+    Fetch one page of a user's history, newest first, using keyset pagination
+    on (timestamp, transaction_id).
+
+    before / after are cursors of the row the page should start below / above.
+    Returns (rows, prev_cursor, next_cursor), a cursor is None when there is no such page.
+    """
+
+    where, params = history_where(user_id, filters)
+
+    if after is not None:
+        # Walk towards newer rows, then flip them back into newest-first order
+        rows = sql_cursor.execute(f"SELECT {HISTORY_COLUMNS} FROM history WHERE {where} "
+                                  "AND (timestamp, transaction_id) > (?, ?) "
+                                  "ORDER BY timestamp ASC, transaction_id ASC LIMIT ?",
+                                  params + [*decode_cursor(after), page_size + 1]).fetchall()
+        has_newer = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_older = True
+    else:
+        keyset = ""
+        if before is not None:
+            keyset = "AND (timestamp, transaction_id) < (?, ?) "
+            params = params + list(decode_cursor(before))
+        rows = sql_cursor.execute(f"SELECT {HISTORY_COLUMNS} FROM history WHERE {where} {keyset}"
+                                  "ORDER BY timestamp DESC, transaction_id DESC LIMIT ?",
+                                  params + [page_size + 1]).fetchall()
+        has_older = len(rows) > page_size
+        rows = rows[:page_size]
+        has_newer = before is not None
+
+    prev_cursor = encode_cursor(rows[0]) if rows and has_newer else None
+    next_cursor = encode_cursor(rows[-1]) if rows and has_older else None
+    return rows, prev_cursor, next_cursor
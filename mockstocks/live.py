@@ -0,0 +1,169 @@
+import json
+import logging
+import queue
+import threading
+
+from budget import PRIORITY_REFRESH
+from helpers import add_price_listener, lookup_many
+
+
+class Subscription:
+    """The symbols one connected client watches and the queue its price updates arrive on."""
+
+    def __init__(self, symbols, maxsize=100):
+        self.symbols = frozenset(symbols)
+        self.queue = queue.Queue(maxsize)
+
+
+class PricePoller:
+    """
+    One background poller shared by every live client of this worker.
+
+    Once per interval it fetches the union of the symbols all subscribers
+    watch with one batch lookup and hands each subscriber only the prices of
+    its symbols that changed. Prices fetched anywhere else in the worker are
+    fanned out the same way through the price listener. The thread starts with
+    the first subscriber and idles while there are none.
+    """
+
+    def __init__(self, interval=5.0, max_subscribers=0):
+        self.interval = interval
+        # Open streams allowed at once, 0 for no limit
+        self.max_subscribers = max_subscribers
+
+        self._subscriptions = set()
+        # symbol -> last price sent to subscribers
+        self._last_prices = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+
+    def subscribe(self, symbols):
+        """Start watching symbols, returns the Subscription to read updates from or None when at max_subscribers."""
+        subscription = Subscription(symbols)
+        with self._lock:
+            if self.max_subscribers and len(self._subscriptions) >= self.max_subscribers:
+                return None
+            self._subscriptions.add(subscription)
+            self._wake.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="price-poller", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def watched(self):
+        """Union of the symbols every subscriber watches."""
+        with self._lock:
+            return set().union(*(subscription.symbols for subscription in self._subscriptions))
+
+    def last_prices(self, symbols):
+        """Last price sent to subscribers for each of symbols that has one."""
+        with self._lock:
+            return {symbol: self._last_prices[symbol] for symbol in symbols if symbol in self._last_prices}
+
+    def publish(self, quotes):
+        """Send changed prices from quotes ({symbol: quote}) to the subscribers watching them."""
+
+        with self._lock:
+            changed = {}
+            for symbol, quote in quotes.items():
+                if quote is None or quote.get("stale") or self._last_prices.get(symbol) == quote["price"]:
+                    continue
+                changed[symbol] = quote["price"]
+            if not changed:
+                return
+            self._last_prices.update(changed)
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            update = {symbol: price for symbol, price in changed.items() if symbol in subscription.symbols}
+            if update:
+                try:
+                    subscription.queue.put_nowait(update)
+                except queue.Full:
+                    # A stalled client misses this update, it gets the next one
+                    pass
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                # Nobody is watching, sleep until someone subscribes
+                while not self._subscriptions:
+                    self._wake.wait()
+
+            try:
+                symbols = self.watched()
+                if symbols:
+                    self.publish(lookup_many(sorted(symbols), max_age=self.interval, priority=PRIORITY_REFRESH))
+            except Exception:
+                logging.getLogger(__name__).exception("live price poll failed")
+
+            with self._lock:
+                self._wake.wait(self.interval)
+
+
+def format_event(event, data):
+    """Encode one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def portfolio_events(poller, subscription, holdings, cash, heartbeat=15.0, idle_timeout=0.0, retry=30.0):
+    """
+    Stream server-sent events with price and holding value deltas for one portfolio.
+
+    subscription is the poller subscription to the holdings' symbols, dropped
+    when the stream ends. holdings maps each symbol to (shares, price, cost) in
+    dollars as last rendered (price None when unknown) and cash is in dollars.
+    Each event carries the changed symbols' price, value and unrealized gain
+    plus the new totals, rounded to cents. A comment line is sent every
+    heartbeat seconds to keep the connection open. After idle_timeout seconds
+    (0 for never) without a change the stream ends, and the browser is told to
+    reconnect retry seconds later, so quiet dashboards do not hold a worker.
+    """
+
+    prices = {symbol: holding[1] for symbol, holding in holdings.items()}
+
+    def event(update):
+        prices.update(update)
+        stock_value = sum(shares * prices[symbol] for symbol, (shares, _, _) in holdings.items()
+                          if prices[symbol] is not None)
+        return format_event("prices", {
+            "holdings": {symbol: {"price": round(price, 2),
+                                  "value": round(holdings[symbol][0] * price, 2),
+                                  "unrealized": round(holdings[symbol][0] * price - holdings[symbol][2], 2)}
+                         for symbol, price in update.items()},
+            "stock_value": round(stock_value, 2),
+            "account_value": round(cash + stock_value, 2),
+        })
+
+    try:
+        yield f"retry: {int(retry * 1000)}\n\n"
+
+        # Catches up on prices that moved between rendering the page and subscribing
+        update = {symbol: price for symbol, price in poller.last_prices(holdings).items() if price != prices[symbol]}
+        if update:
+            yield event(update)
+
+        idle = 0.0
+        while not idle_timeout or idle < idle_timeout:
+            try:
+                update = subscription.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                idle += heartbeat
+                yield ": keepalive\n\n"
+                continue
+            idle = 0.0
+            yield event(update)
+    finally:
+        poller.unsubscribe(subscription)
+
+
+def init_live_app(app):
+    """Create the shared price poller of app and feed it every price fetched in this worker."""
+    poller = PricePoller(app.config["LIVE_POLL_INTERVAL"], app.config["LIVE_MAX_SUBSCRIBERS"])
+    add_price_listener(poller.publish)
+    return poller
@@ -0,0 +1,186 @@
+import click
+import datetime
+import logging
+
+from analytics import archive_rollups, cost_basis, load_history
+from db import connect_app, immediate_transaction
+
+
+## Database maintenance, run as a periodic batch job and by `flask maintenance`:                    ##
+##   1. sold out holdings left in portfolio (sells drop them as they happen) are deleted in batches  ##
+##   2. history older than the retention window moves into a separate archive database file. Only  ##
+##      the trades of a holding up to a point where it held no shares are moved, and their totals   ##
+##      are kept in history_rollups, so cost basis, P&L and returns come out the same as before      ##
+##   3. the query planner statistics are refreshed with a bounded ANALYZE, and pages freed by the   ##
+##      archived rows are given back to the file system by an incremental vacuum                    ##
+
+# Same columns as history, which it receives rows from unchanged
+ARCHIVE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS archive.history (
+        transaction_id INTEGER PRIMARY KEY NOT NULL,
+        user_id INTEGER NOT NULL,
+        order_type TEXT NOT NULL,
+        ticker TEXT NOT NULL,
+        shares INTEGER NOT NULL,
+        price INTEGER NOT NULL,
+        timestamp DATETIME NOT NULL
+        )""",
+    "CREATE INDEX IF NOT EXISTS archive.history_user_timestamp ON history (user_id, timestamp, transaction_id)",
+]
+
+# PRAGMA auto_vacuum value of a database whose free pages can be released a few at a time
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def compact_holdings(dbcon, batch_size=500):
+    """Delete portfolio rows without shares, batch_size per transaction. Returns the number deleted."""
+
+    deleted = 0
+    while True:
+        with immediate_transaction(dbcon):
+            count = dbcon.execute("DELETE FROM portfolio WHERE holding_id IN "
+                                  "(SELECT holding_id FROM portfolio WHERE total_shares <= 0 LIMIT ?)",
+                                  (batch_size,)).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def archive_user_history(dbcon, user_id, before):
+    """
+    Move one user's archivable trades older than before (a history timestamp)
+    into the attached archive and add them to the user's rollups. Returns the
+    number of trades moved.
+    """
+
+    history = load_history(dbcon.cursor(), user_id)
+    basis, trades = cost_basis(history)
+    rollups = archive_rollups(history, basis, trades, before)
+    if not rollups:
+        return 0
+
+    # Rows are copied and committed first, so a crash before the delete below leaves them in both databases
+    # (and the next run copies them again harmlessly), never in neither
+    for user_id, ticker, through_id, values in rollups:
+        dbcon.execute("INSERT OR IGNORE INTO archive.history "
+                      "SELECT transaction_id, user_id, order_type, ticker, shares, price, timestamp FROM main.history "
+                      "WHERE user_id = ? AND ticker = ? AND (timestamp, transaction_id) <= (?, ?)",
+                      (user_id, ticker, values[-1], through_id,))
+    dbcon.commit()
+
+    moved = 0
+    with immediate_transaction(dbcon):
+        for user_id, ticker, through_id, values in rollups:
+            moved += dbcon.execute("DELETE FROM main.history "
+                                   "WHERE user_id = ? AND ticker = ? AND (timestamp, transaction_id) <= (?, ?)",
+                                   (user_id, ticker, values[-1], through_id,)).rowcount
+            dbcon.execute("INSERT INTO history_rollups (user_id, ticker, trades, spent, received, realized_average, "
+                          "realized_fifo, growth, first_at, last_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                          "ON CONFLICT (user_id, ticker) DO UPDATE SET trades = trades + excluded.trades, "
+                          "spent = spent + excluded.spent, received = received + excluded.received, "
+                          "realized_average = realized_average + excluded.realized_average, "
+                          "realized_fifo = realized_fifo + excluded.realized_fifo, growth = growth + excluded.growth, "
+                          "first_at = MIN(first_at, excluded.first_at), last_at = MAX(last_at, excluded.last_at)",
+                          (user_id, ticker, *values,))
+    return moved
+
+
+def archive_history(dbcon, archive_path, retention_days):
+    """
+    Archive the history older than retention_days of every user, one user per
+    transaction, into the database file at archive_path.
+    Returns (users archived, trades moved).
+    """
+
+    before = (datetime.datetime.now() - datetime.timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+
+    dbcon.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    try:
+        for statement in ARCHIVE_SCHEMA:
+            dbcon.execute(statement)
+        dbcon.commit()
+
+        # Only users with trades old enough, each found with one index seek
+        user_ids = [row[0] for row in dbcon.execute("SELECT id FROM users WHERE EXISTS "
+                                                    "(SELECT 1 FROM history WHERE user_id = users.id AND timestamp < ?)",
+                                                    (before,))]
+        users = moved = 0
+        for user_id in user_ids:
+            count = archive_user_history(dbcon, user_id, before)
+            if count:
+                users += 1
+                moved += count
+    finally:
+        # An archive cannot be detached while a transaction is open on it
+        if dbcon.in_transaction:
+            dbcon.rollback()
+        dbcon.execute("DETACH DATABASE archive")
+
+    return users, moved
+
+
+def optimize(dbcon, vacuum_pages=2000, analysis_limit=1000):
+    """
+    Refresh the planner statistics, looking at no more than about
+    analysis_limit rows per index, and free up to vacuum_pages unused pages
+    when the database is in incremental auto-vacuum mode (see full_vacuum).
+    Returns the number of pages freed.
+    """
+
+    dbcon.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+    dbcon.execute("ANALYZE main")
+    dbcon.commit()
+
+    if dbcon.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        return 0
+    free = dbcon.execute("PRAGMA freelist_count").fetchone()[0]
+    # Each step of the pragma frees one page and execute() only takes the first, executescript() runs it to the end
+    dbcon.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+    return free - dbcon.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def full_vacuum(dbcon):
+    """
+    Rewrite the whole database into incremental auto-vacuum mode, so later
+    maintenance runs can free pages a few at a time. Blocks every writer
+    while it runs; meant to be run once, e.g. during a deploy.
+    """
+    dbcon.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    dbcon.execute("VACUUM")
+
+
+def run_maintenance(dbcon, archive_path, retention_days, batch_size=500, vacuum_pages=2000, analysis_limit=1000):
+    """Run every maintenance step, returns a summary of what was done."""
+
+    summary = {"holdings_deleted": compact_holdings(dbcon, batch_size)}
+    if retention_days > 0:
+        summary["users_archived"], summary["trades_archived"] = archive_history(dbcon, archive_path, retention_days)
+    summary["pages_freed"] = optimize(dbcon, vacuum_pages, analysis_limit)
+    logging.getLogger(__name__).info("maintenance: %s", summary)
+    return summary
+
+
+def init_maintenance_app(app, scheduler):
+    """Schedule the maintenance job and register its CLI command on app."""
+
+    def maintain(dbcon):
+        return run_maintenance(dbcon, app.config["HISTORY_ARCHIVE"], app.config["HISTORY_RETENTION_DAYS"],
+                               app.config["MAINTENANCE_BATCH_SIZE"], app.config["VACUUM_PAGES"],
+                               app.config["ANALYSIS_LIMIT"])
+
+    if app.config["MAINTENANCE_INTERVAL"] > 0:
+        scheduler.add_job("maintenance", app.config["MAINTENANCE_INTERVAL"], maintain)
+
+    @app.cli.command("maintenance")
+    @click.option("--full-vacuum", "rewrite", is_flag=True,
+                  help="Rewrite the database into incremental auto-vacuum mode first.")
+    def maintenance_command(rewrite):
+        """Compact holdings, archive old history and vacuum the database."""
+        dbcon = connect_app(app)
+        try:
+            if rewrite:
+                full_vacuum(dbcon)
+            summary = maintain(dbcon)
+        finally:
+            dbcon.close()
+        click.echo(", ".join(f"{key.replace('_', ' ')}: {value}" for key, value in summary.items()))
@@ -0,0 +1,71 @@
+import random
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from metrics import Histogram
+
+
+# HTTP statuses worth retrying: throttling and transient upstream failures
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class MarketDataClient:
+    """
+    Shared HTTP client for market data.
+
+    Keeps a pooled keep-alive requests.Session so quotes reuse TCP/TLS
+    connections, applies connect/read timeouts to every call and retries
+    idempotent GETs a bounded number of times with jittered exponential backoff.
+    The underlying connection pool is safe to share between worker threads.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=5.0, retries=2, backoff=0.2):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # Latency of every upstream attempt, including retried ones
+        self.latency = Histogram()
+
+    def get_json(self, url, params=None):
+        """
+        GET url and return the decoded JSON body.
+
+        Raises requests.RequestException once the retry budget is spent, or
+        ValueError if the body is not JSON.
+        """
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                with self.session.get(url, params=params, timeout=self.timeout) as response:
+                    if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                        response.raise_for_status()
+                        return response.json()
+                    # Leaving the block closes the retried response, handing its connection back to the pool
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            finally:
+                self.latency.observe(time.perf_counter() - start)
+
+            # Back off with full jitter before the next attempt
+            attempt += 1
+            time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def max_call_time(self):
+        """Longest get_json can take in seconds: every attempt timing out, plus the longest backoffs between them."""
+        return (self.retries + 1) * sum(self.timeout) + sum(self.backoff * (2 ** attempt)
+                                                             for attempt in range(1, self.retries + 1))
+
+    def close(self):
+        """Close every pooled connection."""
+        self.session.close()
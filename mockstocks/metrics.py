@@ -0,0 +1,228 @@
+import bisect
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from flask import g, has_request_context
+
+
+# Default histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Thread-safe cumulative histogram of observed durations."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one observation."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """Return cumulative bucket counts, the total count and the sum of observations."""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            cumulative.append((bound, running))
+        return {"buckets": cumulative, "count": running, "sum": total}
+
+
+class Counter:
+    """Thread-safe monotonically increasing counter."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Family:
+    """A named metric with one Counter or Histogram per combination of label values."""
+
+    def __init__(self, name, kind, help, labels=()):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels_for(self, *values):
+        """Return the child metric for these label values, creating it on first use."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, Histogram() if self.kind == "histogram" else Counter())
+        return child
+
+    def children(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+
+class Registry:
+    """Collection of metric families rendered together in Prometheus text format."""
+
+    def __init__(self):
+        self._families = []
+        # Callables returning (name, kind, help, [(labels dict, value)]) for values owned elsewhere
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        family = Family(name, "counter", help, labels)
+        self._families.append(family)
+        return family
+
+    def histogram(self, name, help, labels=()):
+        family = Family(name, "histogram", help, labels)
+        self._families.append(family)
+        return family
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+
+        lines = []
+        for family in self._families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, child in family.children():
+                labels = dict(zip(family.labels, values))
+                if family.kind == "counter":
+                    lines.append(f"{family.name}{_format_labels(labels)} {child.value}")
+                    continue
+                snapshot = child.snapshot()
+                for bound, count in snapshot["buckets"]:
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{family.name}_bucket{_format_labels(dict(labels, le=le))} {count}")
+                lines.append(f"{family.name}_sum{_format_labels(labels)} {snapshot['sum']}")
+                lines.append(f"{family.name}_count{_format_labels(labels)} {snapshot['count']}")
+
+        for collector in self._collectors:
+            for name, kind, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+# Metrics collected by the app and served on /metrics
+registry = Registry()
+
+request_duration = registry.histogram("mockstocks_http_request_duration_seconds",
+                                      "Time spent handling HTTP requests.", ("route", "method"))
+requests_total = registry.counter("mockstocks_http_requests_total",
+                                  "HTTP requests handled.", ("route", "method", "status"))
+sql_duration = registry.histogram("mockstocks_sql_query_duration_seconds",
+                                  "Time spent executing SQL statements.", ("statement",))
+upstream_duration = registry.histogram("mockstocks_upstream_call_duration_seconds",
+                                       "Time spent in market data provider calls.", ("call",))
+operation_duration = registry.histogram("mockstocks_operation_duration_seconds",
+                                        "Time spent in other expensive operations.", ("operation",))
+
+
+def _breakdown():
+    """Return the per-request breakdown list on flask.g, or None outside a request."""
+    if not has_request_context():
+        return None
+    return g.setdefault("metrics_breakdown", [])
+
+
+def record_sql(sql, elapsed):
+    """Record one SQL statement, keyed by its leading keyword."""
+    statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "EMPTY"
+    sql_duration.labels_for(statement).observe(elapsed)
+    breakdown = _breakdown()
+    if breakdown is not None:
+        breakdown.append(("sql", sql, elapsed))
+
+
+def record_operation(kind, operation, detail, elapsed):
+    """Record an upstream call or other timed operation (password hashing, rendering)."""
+    family = upstream_duration if kind == "upstream" else operation_duration
+    family.labels_for(operation).observe(elapsed)
+    breakdown = _breakdown()
+    if breakdown is not None:
+        breakdown.append((kind, f"{operation} {detail}".strip(), elapsed))
+
+
+@contextmanager
+def timed(kind, operation, detail=""):
+    """Time the enclosed block as an upstream call or other operation."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_operation(kind, operation, detail, time.perf_counter() - start)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times every statement it executes."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - start)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (and execute shortcut) time every statement."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def slow_request_report(route, elapsed):
+    """Summarize where a slow request spent its time, slowest steps first."""
+
+    breakdown = g.get("metrics_breakdown", [])
+    totals = {}
+    for kind, _, step in breakdown:
+        count, spent = totals.get(kind, (0, 0.0))
+        totals[kind] = (count + 1, spent + step)
+
+    lines = [f"slow request {route} took {elapsed * 1000:.1f}ms: "
+             + ", ".join(f"{kind} {count} calls {spent * 1000:.1f}ms" for kind, (count, spent) in sorted(totals.items()))]
+    for kind, detail, step in sorted(breakdown, key=lambda item: item[2], reverse=True)[:10]:
+        lines.append(f"  {step * 1000:8.1f}ms {kind} {' '.join(detail.split())}")
+    return "\n".join(lines)
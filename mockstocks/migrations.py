@@ -0,0 +1,295 @@
+import click
+import datetime
+import logging
+
+from db import connect_app, immediate_transaction
+from valuations import DASHBOARD_QUERY
+
+
+## Schema migrations for 'finance.db'.                                                             ##
+## Each migration is (version, description, steps) where steps are SQL statements or callables     ##
+## taking the connection. Migrations run in order, each in its own transaction, and applied        ##
+## versions are recorded in the schema_version table. Never edit a released step, append a new one ##
+## Steps never call into other modules, whose code keeps changing after the migration shipped.     ##
+
+
+def _merge_duplicate_holdings(dbcon):
+    """Fold duplicate (user_id, symbol) portfolio rows into the oldest one."""
+    dbcon.execute("UPDATE portfolio SET total_shares = (SELECT SUM(p.total_shares) FROM portfolio p "
+                  "WHERE p.user_id = portfolio.user_id AND p.symbol = portfolio.symbol) "
+                  "WHERE holding_id IN (SELECT MIN(holding_id) FROM portfolio GROUP BY user_id, symbol HAVING COUNT(*) > 1)")
+    dbcon.execute("DELETE FROM portfolio WHERE holding_id NOT IN (SELECT MIN(holding_id) FROM portfolio GROUP BY user_id, symbol)")
+
+
+def _fill_holding_basis(dbcon):
+    """
+    Average-cost basis and realized P&L of every holding, replayed from history.
+    Buys blend into the average cost, a buy into a holding without shares starts
+    it over, and sells realize the difference to the average cost.
+    """
+    holdings = {}
+    for user_id, ticker, order_type, shares, price in dbcon.execute(
+            "SELECT user_id, ticker, order_type, shares, price FROM history "
+            "ORDER BY user_id, ticker, timestamp, transaction_id"):
+        position, average, realized = holdings.get((user_id, ticker), (0, 0.0, 0.0))
+        if order_type == "buy":
+            position += shares
+            average = (average * (position - shares) + shares * price) / position if position > 0 else 0.0
+        else:
+            realized += shares * (price - average)
+            position -= shares
+        holdings[(user_id, ticker)] = (position, average, realized)
+
+    dbcon.executemany("INSERT INTO holding_basis (user_id, symbol, shares, cost, realized) VALUES (?, ?, ?, ?, ?)",
+                      ((user_id, ticker, position, round(position * average), round(realized))
+                       for (user_id, ticker), (position, average, realized) in holdings.items()))
+
+
+MIGRATIONS = [
+    (1, "unique holding per user and symbol", [
+        _merge_duplicate_holdings,
+        "CREATE UNIQUE INDEX IF NOT EXISTS portfolio_user_symbol ON portfolio (user_id, symbol)",
+    ]),
+    (2, "index history by user and time", [
+        "CREATE INDEX IF NOT EXISTS history_user_timestamp ON history (user_id, timestamp, transaction_id)",
+    ]),
+    (3, "store money as integer cents", [
+        """CREATE TABLE users_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            username TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            cash INTEGER NOT NULL DEFAULT 1000000
+            )""",
+        "INSERT INTO users_new (id, username, hash, cash) SELECT id, username, hash, CAST(ROUND(cash * 100) AS INTEGER) FROM users",
+        "DROP TABLE users",
+        "ALTER TABLE users_new RENAME TO users",
+        "CREATE UNIQUE INDEX username ON users (username)",
+        """CREATE TABLE history_new (
+            transaction_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            user_id INTEGER NOT NULL,
+            order_type TEXT NOT NULL CHECK (order_type IN ('sell', 'buy')),
+            ticker TEXT NOT NULL,
+            shares INTEGER NOT NULL,
+            price INTEGER NOT NULL,
+            timestamp DATETIME NOT NULL
+            )""",
+        "INSERT INTO history_new (transaction_id, user_id, order_type, ticker, shares, price, timestamp) "
+        "SELECT transaction_id, user_id, order_type, ticker, shares, CAST(ROUND(price * 100) AS INTEGER), timestamp FROM history",
+        "DROP TABLE history",
+        "ALTER TABLE history_new RENAME TO history",
+        "CREATE INDEX history_user_timestamp ON history (user_id, timestamp, transaction_id)",
+    ]),
+    (4, "index history by user and ticker for filtered history pages", [
+        "CREATE INDEX IF NOT EXISTS history_user_ticker_timestamp ON history (user_id, ticker, timestamp, transaction_id)",
+    ]),
+    (5, "account valuation snapshots", [
+        """CREATE TABLE symbol_prices (
+            symbol TEXT PRIMARY KEY NOT NULL,
+            price INTEGER NOT NULL,
+            priced_at REAL NOT NULL
+            ) WITHOUT ROWID""",
+        """CREATE TABLE holding_values (
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            company TEXT NOT NULL,
+            shares INTEGER NOT NULL,
+            price INTEGER,
+            value INTEGER,
+            PRIMARY KEY (user_id, symbol)
+            ) WITHOUT ROWID""",
+        "CREATE INDEX holding_values_symbol ON holding_values (symbol)",
+        """CREATE TABLE account_values (
+            user_id INTEGER PRIMARY KEY NOT NULL,
+            cash INTEGER NOT NULL,
+            market_value INTEGER NOT NULL,
+            priced_at REAL NOT NULL
+            )""",
+        # Holdings priced at their symbol's last traded price, symbol_prices is still empty
+        "INSERT INTO holding_values (user_id, symbol, company, shares, price, value) "
+        "SELECT p.user_id, p.symbol, p.company, p.total_shares, h.price, p.total_shares * h.price "
+        "FROM portfolio p LEFT JOIN (SELECT ticker, price FROM history WHERE transaction_id IN "
+        "(SELECT MAX(transaction_id) FROM history GROUP BY ticker)) h ON h.ticker = p.symbol "
+        "WHERE p.total_shares > 0",
+        "INSERT INTO account_values (user_id, cash, market_value, priced_at) "
+        "SELECT u.id, u.cash, (SELECT COALESCE(SUM(value), 0) FROM holding_values WHERE user_id = u.id), "
+        "(julianday('now') - 2440587.5) * 86400.0 FROM users u",
+    ]),
+    (6, "incremental average-cost basis per holding", [
+        """CREATE TABLE holding_basis (
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            shares INTEGER NOT NULL,
+            cost INTEGER NOT NULL,
+            realized INTEGER NOT NULL,
+            PRIMARY KEY (user_id, symbol)
+            ) WITHOUT ROWID""",
+        _fill_holding_basis,
+    ]),
+    (7, "leaderboard and scheduled jobs", [
+        """CREATE TABLE account_ranks (
+            user_id INTEGER PRIMARY KEY NOT NULL,
+            rank INTEGER NOT NULL,
+            value INTEGER NOT NULL
+            )""",
+        """CREATE TABLE leaderboard (
+            rank INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            computed_at REAL NOT NULL,
+            PRIMARY KEY (rank, user_id)
+            ) WITHOUT ROWID""",
+        """CREATE TABLE scheduled_jobs (
+            name TEXT PRIMARY KEY NOT NULL,
+            last_run REAL NOT NULL
+            ) WITHOUT ROWID""",
+    ]),
+    (8, "resting limit and stop orders", [
+        """CREATE TABLE orders (
+            order_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            company TEXT NOT NULL,
+            side TEXT NOT NULL CHECK (side IN ('buy', 'sell')),
+            kind TEXT NOT NULL CHECK (kind IN ('limit', 'stop')),
+            shares INTEGER NOT NULL,
+            trigger_price INTEGER NOT NULL,
+            status TEXT NOT NULL CHECK (status IN ('open', 'filled', 'cancelled', 'rejected')),
+            placed_at DATETIME NOT NULL,
+            closed_at DATETIME,
+            fill_price INTEGER,
+            note TEXT
+            )""",
+        "CREATE INDEX orders_user ON orders (user_id, order_id)",
+        "CREATE INDEX orders_open_symbol ON orders (symbol) WHERE status = 'open'",
+        "CREATE INDEX orders_open_id ON orders (order_id) WHERE status = 'open'",
+    ]),
+    (9, "drop sold out holdings and keep rollups of archived history", [
+        "DELETE FROM portfolio WHERE total_shares <= 0",
+        """CREATE TABLE history_rollups (
+            user_id INTEGER NOT NULL,
+            ticker TEXT NOT NULL,
+            trades INTEGER NOT NULL,
+            spent INTEGER NOT NULL,
+            received INTEGER NOT NULL,
+            realized_average INTEGER NOT NULL,
+            realized_fifo INTEGER NOT NULL,
+            growth REAL NOT NULL,
+            first_at DATETIME NOT NULL,
+            last_at DATETIME NOT NULL,
+            PRIMARY KEY (user_id, ticker)
+            ) WITHOUT ROWID""",
+    ]),
+]
+
+
+# Statements on the hot request paths, with sample parameters, that must never scan a whole table
+HOT_QUERIES = [
+    ("SELECT * FROM portfolio WHERE user_id = ? ORDER BY symbol ASC", (1,)),
+    ("SELECT total_shares FROM portfolio WHERE user_id = ? AND symbol = ?", (1, "AAPL")),
+    ("SELECT transaction_id, order_type, ticker, shares, price, timestamp FROM history WHERE user_id = ? "
+     "AND (timestamp, transaction_id) < (?, ?) ORDER BY timestamp DESC, transaction_id DESC LIMIT ?",
+     (1, "2023-01-01 00:00:00", 1, 50)),
+    ("SELECT transaction_id, order_type, ticker, shares, price, timestamp FROM history WHERE user_id = ? AND ticker = ? "
+     "ORDER BY timestamp DESC, transaction_id DESC LIMIT ?", (1, "AAPL", 50)),
+    ("SELECT (SELECT transaction_id FROM history WHERE user_id = ? ORDER BY timestamp DESC, transaction_id DESC LIMIT 1), "
+     "(SELECT COALESCE(SUM(trades), 0) FROM history_rollups WHERE user_id = ?)", (1, 1)),
+    ("SELECT cash, username FROM users WHERE id = ?", (1,)),
+    (DASHBOARD_QUERY, (1,)),
+    ("SELECT rank, username, value, computed_at FROM leaderboard WHERE rank <= ? ORDER BY rank, user_id", (100,)),
+    ("SELECT rank, value FROM account_ranks WHERE user_id = ?", (1,)),
+    ("SELECT order_id, symbol, side, kind, shares, trigger_price, status, placed_at, closed_at, fill_price, note "
+     "FROM orders WHERE user_id = ? ORDER BY order_id DESC LIMIT ?", (1, 100)),
+    ("SELECT order_id, user_id, symbol, company, side, kind, shares, trigger_price FROM orders "
+     "WHERE status = 'open' AND order_id > ? ORDER BY order_id", (0,)),
+    ("SELECT user_id, ticker, timestamp, order_type, shares, price, transaction_id FROM history WHERE user_id = ? "
+     "ORDER BY user_id, ticker, timestamp, transaction_id", (1,)),
+    ("SELECT user_id, ticker, trades, spent, received, realized_average, realized_fifo, growth, first_at, last_at "
+     "FROM history_rollups WHERE user_id = ?", (1,)),
+    ("UPDATE holding_values SET price = ?, value = shares * ? WHERE symbol = ? AND price IS NOT ?", (100, 100, "AAPL", 100)),
+    ("SELECT * FROM users WHERE username = ?", ("user",)),
+]
+
+
+def current_version(dbcon):
+    """Return the highest applied schema version, creating the tracking table if needed."""
+    dbcon.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, "
+                  "description TEXT NOT NULL, applied_at DATETIME NOT NULL)")
+    dbcon.commit()
+    row = dbcon.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(dbcon):
+    """Apply every pending migration, returns the list of versions applied."""
+
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        if version <= current_version(dbcon):
+            continue
+
+        with immediate_transaction(dbcon):
+            for step in steps:
+                if callable(step):
+                    step(dbcon)
+                else:
+                    dbcon.execute(step)
+            dbcon.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                          (version, description, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+        applied.append(version)
+
+    return applied
+
+
+def check_query_plans(dbcon, queries=HOT_QUERIES):
+    """
+    Return (sql, plan detail) for every hot query whose plan scans a whole table
+    or sorts through a temporary b-tree instead of using an index.
+    """
+
+    regressions = []
+    for sql, params in queries:
+        for row in dbcon.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[-1]
+            if (detail.startswith("SCAN") and detail != "SCAN CONSTANT ROW") or "TEMP B-TREE" in detail:
+                regressions.append((sql, detail))
+    return regressions
+
+
+def init_migrations_app(app):
+    """Register the migration CLI commands on app and migrate at startup if configured."""
+
+    @app.cli.command("migrate")
+    def migrate_command():
+        """Apply pending schema migrations."""
+        dbcon = connect_app(app)
+        try:
+            applied = migrate(dbcon)
+        finally:
+            dbcon.close()
+        click.echo(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+
+    @app.cli.command("check-query-plans")
+    def check_query_plans_command():
+        """Fail if a hot query falls back to a full table scan or sort."""
+        dbcon = connect_app(app)
+        try:
+            regressions = check_query_plans(dbcon)
+        finally:
+            dbcon.close()
+        for sql, detail in regressions:
+            click.echo(f"{detail}: {sql}", err=True)
+        if regressions:
+            raise SystemExit(1)
+        click.echo("All hot queries use indexes")
+
+    # The schema just migrated is checked against the hot queries, so a missing index shows up in the log at deploy
+    if app.config["MIGRATE_ON_STARTUP"]:
+        dbcon = connect_app(app)
+        try:
+            migrate(dbcon)
+            regressions = check_query_plans(dbcon)
+        finally:
+            dbcon.close()
+        for sql, detail in regressions:
+            logging.getLogger(__name__).warning("hot query plan regressed, %s: %s", detail, sql)
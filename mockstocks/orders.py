@@ -0,0 +1,323 @@
+import heapq
+import logging
+import queue
+import threading
+import time
+
+from budget import PRIORITY_REFRESH
+from db import connect_app, immediate_transaction
+from helpers import add_price_listener, lookup_many, to_cents
+from trades import TradeError, _timestamp, apply_buy, apply_sell
+
+
+## Resting limit and stop orders.                                                                   ##
+## Orders live in the orders table; each worker keeps an in-memory book per symbol so a price     ##
+## update only pops the orders whose trigger it crossed. Prices in the table are integer cents.    ##
+##   buy limit / sell stop  fire when the price falls to the trigger or below                      ##
+##   sell limit / buy stop  fire when the price rises to the trigger or above                      ##
+
+ORDER_SIDES = ("buy", "sell")
+ORDER_KINDS = ("limit", "stop")
+
+# Columns selected for order lists, in this order
+ORDER_COLUMNS = "order_id, symbol, side, kind, shares, trigger_price, status, placed_at, closed_at, fill_price, note"
+
+order_id_ind, order_symbol_ind, order_side_ind, order_kind_ind, order_shares_ind, order_trigger_price_ind, \
+    order_status_ind, order_placed_at_ind, order_closed_at_ind, order_fill_price_ind, order_note_ind = range(11)
+
+# Columns loaded into the in-memory books, in this order
+BOOK_COLUMNS = "order_id, user_id, symbol, company, side, kind, shares, trigger_price"
+
+book_order_id_ind, book_user_id_ind, book_symbol_ind, book_company_ind, book_side_ind, book_kind_ind, \
+    book_shares_ind, book_trigger_price_ind = range(8)
+
+# A book's heaps are rebuilt once more than this fraction of their entries are closed orders
+COMPACT_DEAD_FRACTION = 0.5
+
+
+def fires_on_fall(side, kind):
+    """True for orders triggered by the price falling to their trigger, False for a rise."""
+    return (side, kind) in (("buy", "limit"), ("sell", "stop"))
+
+
+class OrderBook:
+    """
+    Open orders of one symbol in two heaps keyed by trigger price.
+
+    falling holds orders that fire at or below their trigger, highest trigger
+    on top; rising holds orders that fire at or above theirs, lowest on top.
+    A price update only pops from the tops while they are crossed. Closed
+    orders are left in the heaps and counted in dead until compact().
+    """
+
+    def __init__(self):
+        self.falling = []
+        self.rising = []
+        self.dead = 0
+
+    def add(self, order_id, trigger, on_fall):
+        if on_fall:
+            heapq.heappush(self.falling, (-trigger, order_id))
+        else:
+            heapq.heappush(self.rising, (trigger, order_id))
+
+    def crossed(self, price):
+        """Pop and return the ids of every order whose trigger price (cents) has been crossed."""
+        ids = []
+        while self.falling and -self.falling[0][0] >= price:
+            ids.append(heapq.heappop(self.falling)[1])
+        while self.rising and self.rising[0][0] <= price:
+            ids.append(heapq.heappop(self.rising)[1])
+        return ids
+
+    def compact(self, live):
+        """Rebuild both heaps keeping only the order ids in live."""
+        self.falling = [entry for entry in self.falling if entry[1] in live]
+        self.rising = [entry for entry in self.rising if entry[1] in live]
+        heapq.heapify(self.falling)
+        heapq.heapify(self.rising)
+        self.dead = 0
+
+    def __len__(self):
+        return len(self.falling) + len(self.rising)
+
+
+class Matcher:
+    """
+    Background matcher filling resting orders as prices arrive.
+
+    Price updates are queued by the price listener and handled on one thread.
+    Orders placed on other workers are picked up incrementally from the table
+    before each batch. Orders cancelled on this worker are tombstoned with
+    discard(); those closed on other workers are found every prune_interval
+    seconds. A book's heaps are compacted once too many entries are dead.
+    """
+
+    def __init__(self, connect, prune_interval=60.0):
+        # connect() opens a new connection to the database holding the orders table
+        self.connect = connect
+        self.prune_interval = prune_interval
+
+        # symbol -> OrderBook, order_id -> book row, guarded by _lock
+        self.books = {}
+        self.orders = {}
+        self.last_order_id = 0
+        self._lock = threading.Lock()
+
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def add(self, row):
+        """Add an open order (a BOOK_COLUMNS row) to its symbol's book."""
+        with self._lock:
+            if row[book_order_id_ind] in self.orders:
+                return
+            self.orders[row[book_order_id_ind]] = row
+            self.books.setdefault(row[book_symbol_ind], OrderBook()).add(
+                row[book_order_id_ind], row[book_trigger_price_ind], fires_on_fall(row[book_side_ind], row[book_kind_ind]))
+
+    def discard(self, order_id):
+        """Forget a closed order, compacting its book when too many of its heap entries are dead."""
+        with self._lock:
+            row = self.orders.pop(order_id, None)
+            book = self.books.get(row[book_symbol_ind]) if row is not None else None
+            if book is None:
+                return
+            book.dead += 1
+            if book.dead > COMPACT_DEAD_FRACTION * len(book):
+                book.compact(self.orders)
+                if not book:
+                    del self.books[row[book_symbol_ind]]
+
+    def prune(self, dbcon):
+        """Discard orders closed since they were loaded, e.g. cancelled or filled on another worker."""
+        with self._lock:
+            if not self.orders:
+                return
+            # Orders added while the table is read are newer than known and left alone
+            known = max(self.orders)
+        still_open = {row[0] for row in dbcon.execute("SELECT order_id FROM orders WHERE status = 'open' AND order_id <= ?",
+                                                      (known,))}
+        with self._lock:
+            closed = [order_id for order_id in self.orders if order_id <= known and order_id not in still_open]
+        for order_id in closed:
+            self.discard(order_id)
+
+    def rebuild(self, dbcon):
+        """Reload every open order from the table, e.g. on restart."""
+        with self._lock:
+            self.books = {}
+            self.orders = {}
+            self.last_order_id = 0
+        self.sync(dbcon)
+
+    def sync(self, dbcon):
+        """Load open orders placed since the last sync, possibly by another worker."""
+        rows = dbcon.execute(f"SELECT {BOOK_COLUMNS} FROM orders WHERE status = 'open' AND order_id > ? ORDER BY order_id",
+                             (self.last_order_id,)).fetchall()
+        for row in rows:
+            self.add(row)
+        if rows:
+            self.last_order_id = max(self.last_order_id, rows[-1][book_order_id_ind])
+
+    def crossed(self, symbol, price):
+        """Pop the open orders of symbol crossed by price (cents), as book rows."""
+        with self._lock:
+            book = self.books.get(symbol)
+            if book is None:
+                return []
+            ids = book.crossed(price)
+            rows = [self.orders.pop(order_id) for order_id in ids if order_id in self.orders]
+            book.dead = max(0, book.dead - (len(ids) - len(rows)))
+            if not book:
+                del self.books[symbol]
+            return rows
+
+    def on_prices(self, quotes):
+        """Price listener: queue fresh quotes for the matcher thread, never blocks the lookup."""
+        # Dropped while the thread is not running, nothing would take them off the queue
+        if self._thread is not None:
+            self._queue.put(quotes)
+
+    def match(self, dbcon, quotes):
+        """Fill every order crossed by quotes ({symbol: quote}), returns the ids filled."""
+
+        self.sync(dbcon)
+        filled = []
+        for symbol, quote in quotes.items():
+            if quote is None or quote.get("stale"):
+                continue
+            for row in self.crossed(symbol, to_cents(quote["price"])):
+                try:
+                    if fill_order(dbcon, row, quote["price"]):
+                        filled.append(row[book_order_id_ind])
+                except Exception:
+                    # Still open in the table, keep it in the book for the next price update
+                    self.add(row)
+                    raise
+        return filled
+
+    def _loop(self):
+        dbcon = self.connect()
+        try:
+            self.rebuild(dbcon)
+            pruned_at = time.monotonic()
+            while True:
+                try:
+                    quotes = self._queue.get(timeout=self.prune_interval)
+                except queue.Empty:
+                    quotes = {}
+                if quotes is None:
+                    return
+                try:
+                    if time.monotonic() - pruned_at >= self.prune_interval:
+                        self.prune(dbcon)
+                        pruned_at = time.monotonic()
+                    if quotes:
+                        self.match(dbcon, quotes)
+                except Exception:
+                    logging.getLogger(__name__).exception("order matching failed")
+        finally:
+            dbcon.close()
+
+    def start(self):
+        """Rebuild the books from the table and start matching on a daemon thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="order-matcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the matcher thread once the queued price updates are handled."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def place_order(dbcon, user_id, symbol, company, side, kind, shares, trigger):
+    """
+    Store a new open order (trigger in dollars) and return its book row.
+
+    Sell orders must be covered by shares the user holds right now; whether a
+    buy is affordable is only known when it fills.
+    """
+
+    if side not in ORDER_SIDES or kind not in ORDER_KINDS:
+        raise TradeError("invalid order type")
+
+    with immediate_transaction(dbcon):
+        if side == "sell":
+            owned = dbcon.execute("SELECT total_shares FROM portfolio WHERE user_id = ? AND symbol = ?",
+                                  (user_id, symbol,)).fetchone()
+            if not owned or owned[0] < shares:
+                raise TradeError("not enough shares to place order")
+
+        order_id = dbcon.execute("INSERT INTO orders (user_id, symbol, company, side, kind, shares, trigger_price, status, placed_at) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?, 'open', ?)",
+                                 (user_id, symbol, company, side, kind, shares, to_cents(trigger), _timestamp(),)).lastrowid
+
+    return order_id, user_id, symbol, company, side, kind, shares, to_cents(trigger)
+
+
+def cancel_order(dbcon, user_id, order_id):
+    """Cancel one of the user's open orders, returns False if it was not open."""
+    with immediate_transaction(dbcon):
+        return dbcon.execute("UPDATE orders SET status = 'cancelled', closed_at = ? "
+                             "WHERE order_id = ? AND user_id = ? AND status = 'open'",
+                             (_timestamp(), order_id, user_id,)).rowcount == 1
+
+
+def fill_order(dbcon, row, price):
+    """
+    Fill a triggered order (a book row) at price (dollars) in one transaction.
+
+    The order is claimed first, so it fills at most once across workers, then
+    goes through the same bookkeeping as a market order. Orders the user can
+    no longer afford or cover are marked rejected. Returns True when filled.
+    """
+
+    with immediate_transaction(dbcon):
+        claimed = dbcon.execute("UPDATE orders SET status = 'filled', fill_price = ?, closed_at = ? "
+                                "WHERE order_id = ? AND status = 'open'",
+                                (to_cents(price), _timestamp(), row[book_order_id_ind],)).rowcount
+        if claimed != 1:
+            return False
+
+        try:
+            if row[book_side_ind] == "buy":
+                apply_buy(dbcon, row[book_user_id_ind], row[book_symbol_ind], row[book_company_ind],
+                          row[book_shares_ind], price)
+            else:
+                apply_sell(dbcon, row[book_user_id_ind], row[book_symbol_ind], row[book_shares_ind], price)
+        except TradeError as error:
+            dbcon.execute("UPDATE orders SET status = 'rejected', fill_price = NULL, note = ? WHERE order_id = ?",
+                          (str(error), row[book_order_id_ind],))
+            return False
+
+    return True
+
+
+def init_orders_app(app, scheduler):
+    """
+    Set up the order matcher for app: unless ORDER_MATCHER_ENABLED is off, feed
+    it every fetched price and keep the prices of symbols with open orders
+    fresh with a scheduled batch lookup.
+    """
+
+    matcher = Matcher(lambda: connect_app(app))
+
+    # Nothing drains the matcher's queue unless its thread runs, so a disabled matcher is never fed prices
+    if not app.config["ORDER_MATCHER_ENABLED"]:
+        return matcher
+
+    def refresh_order_prices(dbcon):
+        symbols = [row[0] for row in dbcon.execute("SELECT DISTINCT symbol FROM orders WHERE status = 'open'")]
+        if symbols:
+            # Cache hits do not reach the price listener, so hand every price to the matcher
+            matcher.on_prices(lookup_many(symbols, max_age=app.config["ORDER_PRICE_INTERVAL"], priority=PRIORITY_REFRESH))
+
+    add_price_listener(matcher.on_prices)
+    scheduler.add_job("order-prices", app.config["ORDER_PRICE_INTERVAL"], refresh_order_prices)
+    matcher.start()
+
+    return matcher
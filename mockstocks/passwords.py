@@ -0,0 +1,98 @@
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """Raised when the password hashing queue is full; the request should be retried later."""
+
+
+def full_method(method):
+    """
+    Spell out method with werkzeug's defaults the way it is stored in a
+    hash, e.g. "pbkdf2:sha256" -> "pbkdf2:sha256:1000000", without hashing.
+    """
+    name, *args = method.split(":")
+    if name == "pbkdf2":
+        hash_name = args[0] if args else "sha256"
+        iterations = args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    if name == "scrypt":
+        return "scrypt:" + (":".join(args) if args else "32768:8:1")
+    raise ValueError(f"invalid hash method {method!r}")
+
+
+class PasswordHasher:
+    """
+    Runs pbkdf2 password hashing and checking in a bounded pool of worker processes.
+
+    Hashing is CPU bound, so on the request threads a burst of logins would
+    starve every other route. At most max_pending hashes may be running or
+    queued at once; beyond that calls fail fast with HasherBusy instead of
+    piling up. With workers 0 hashing runs inline on the calling thread.
+    """
+
+    def __init__(self, workers=2, max_pending=8, method="pbkdf2:sha256", salt_length=8):
+        self.workers = workers
+        self.method = method
+        self.salt_length = salt_length
+        self.max_pending = max_pending
+
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+        # Stored hashes not starting with this (e.g. "pbkdf2:sha256:1000000$") get rehashed on login
+        self.prefix = full_method(method) + "$"
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # forkserver, so workers are never forked from a process already running threads
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("forkserver"))
+            return self._pool
+
+    def _run(self, function, *args):
+        """Run function(*args) in the pool, raising HasherBusy when max_pending calls are already waiting."""
+
+        if self.workers == 0:
+            return function(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy("password hashing is saturated")
+        try:
+            try:
+                return self._executor().submit(function, *args).result()
+            except BrokenProcessPool:
+                # A worker died, start a fresh pool and try once more
+                with self._pool_lock:
+                    self._pool = None
+                return self._executor().submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Hash password with the configured method and salt length."""
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def check(self, pwhash, password):
+        """Check password against a stored hash."""
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when a stored hash was made with other parameters than the configured ones."""
+        if not pwhash.startswith(self.prefix):
+            return True
+        salt = pwhash[len(self.prefix):].split("$", 1)[0]
+        return len(salt) != self.salt_length
+
+    def close(self):
+        """Shut the worker processes down, a later call starts a new pool."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
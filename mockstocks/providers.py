@@ -0,0 +1,235 @@
+import bisect
+import csv
+import gzip
+import time
+import urllib.parse
+
+import requests
+
+from array import array
+from helpers import MarketDataUnavailable
+from marketdata import MarketDataClient
+from metrics import Histogram
+
+
+# Base URL of the IEX cloud API
+IEX_BASE_URL = "https://cloud.iexapis.com/stable"
+
+
+class MarketDataProvider:
+    """
+    Source of quotes behind helpers.lookup.
+
+    quote(symbol) returns {"name", "price", "symbol"}, None for an unknown
+    symbol, or raises helpers.MarketDataUnavailable on failure. quotes(symbols)
+    returns a dictionary of those for up to batch_limit symbols, or None when
+    the batch call failed and the caller should fall back to single quotes.
+    """
+
+    # Maximum number of symbols accepted by one quotes() call
+    batch_limit = 100
+
+    def __init__(self):
+        # Latency of every upstream call
+        self.latency = Histogram()
+
+    def quote(self, symbol):
+        raise NotImplementedError
+
+    def quotes(self, symbols):
+        return None
+
+    def symbols(self):
+        """Return every listed (symbol, company name), or None when the provider cannot list them."""
+        return None
+
+    def max_call_time(self):
+        """Longest one quote() call can take in seconds, retries included."""
+        return 0.0
+
+    def close(self):
+        """Release any resources held by the provider."""
+
+
+class IEXProvider(MarketDataProvider):
+    """Live quotes from IEX cloud over the pooled market data client."""
+
+    def __init__(self, api_key, client=None, base_url=IEX_BASE_URL):
+        self.api_key = api_key
+        self.client = client or MarketDataClient()
+        self.base_url = base_url
+        self.latency = self.client.latency
+
+    def quote(self, symbol):
+        """Fetch quote for symbol from IEX."""
+
+        # Contact API, IEX answers 404 for symbols it does not know
+        try:
+            url = f"{self.base_url}/stock/{urllib.parse.quote_plus(symbol)}/quote"
+            quote = self.client.get_json(url, {"token": self.api_key})
+        except requests.HTTPError as error:
+            if error.response is not None and error.response.status_code == 404:
+                return None
+            raise MarketDataUnavailable(f"IEX quote failed for {symbol}") from error
+        except (requests.RequestException, ValueError) as error:
+            raise MarketDataUnavailable(f"IEX quote failed for {symbol}") from error
+
+        # Parse response
+        return parse_iex_quote(quote)
+
+    def quotes(self, symbols):
+        """Fetch quotes for up to batch_limit symbols in one IEX batch request."""
+
+        # Contact API
+        try:
+            params = {"symbols": ",".join(symbols), "types": "quote", "token": self.api_key}
+            batch = self.client.get_json(f"{self.base_url}/stock/market/batch", params)
+        except (requests.RequestException, ValueError):
+            return None
+
+        # Parse response, symbols IEX does not know are simply absent from it
+        quotes = {}
+        for symbol in symbols:
+            entry = batch.get(symbol) if isinstance(batch, dict) else None
+            quotes[symbol] = parse_iex_quote(entry.get("quote")) if isinstance(entry, dict) else None
+        return quotes
+
+    def symbols(self):
+        """Fetch the reference list of every symbol IEX supports."""
+
+        # Contact API
+        try:
+            listing = self.client.get_json(f"{self.base_url}/ref-data/symbols", {"token": self.api_key})
+        except (requests.RequestException, ValueError):
+            return None
+
+        # Parse response
+        return [(entry["symbol"], entry.get("name") or entry["symbol"]) for entry in listing
+                if isinstance(entry, dict) and entry.get("symbol")]
+
+    def max_call_time(self):
+        return self.client.max_call_time()
+
+    def close(self):
+        self.client.close()
+
+
+def parse_iex_quote(quote):
+    """Convert an IEX quote object into the dictionary returned by lookup."""
+    try:
+        return {
+            "name": quote["companyName"],
+            "price": float(quote["latestPrice"]),
+            "symbol": quote["symbol"]
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class ReplayProvider(MarketDataProvider):
+    """
+    Offline quotes replayed from a recorded tape, for load tests and benchmarks.
+
+    The tape is a gzip-compressed CSV of symbol, epoch timestamp, price and
+    company name rows. Tape time advances speed times faster than wall time
+    from when the provider was created and wraps around at the end of the
+    tape; each call sleeps latency seconds to simulate the upstream round trip.
+    """
+
+    def __init__(self, path, latency=0.0, speed=1.0):
+        super().__init__()
+        self.latency_seconds = latency
+        self.speed = speed
+
+        # symbol -> (sorted timestamps, prices at those timestamps, company name)
+        self._series = {}
+        for symbol, times, prices, name in _load_tape(path):
+            self._series[symbol] = (times, prices, name)
+
+        all_times = [series[0] for series in self._series.values() if series[0]]
+        self._tape_start = min(times[0] for times in all_times) if all_times else 0.0
+        self._tape_span = max(times[-1] for times in all_times) - self._tape_start if all_times else 0.0
+        self._wall_start = time.monotonic()
+
+    def _tape_time(self):
+        """Current position on the tape."""
+        elapsed = (time.monotonic() - self._wall_start) * self.speed
+        if self._tape_span > 0:
+            elapsed %= self._tape_span
+        return self._tape_start + elapsed
+
+    def _price(self, symbol, at):
+        series = self._series.get(symbol)
+        if series is None:
+            return None
+        times, prices, name = series
+        i = max(bisect.bisect_right(times, at) - 1, 0)
+        return {"name": name, "price": prices[i], "symbol": symbol}
+
+    def _simulate_round_trip(self, start):
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+        self.latency.observe(time.perf_counter() - start)
+
+    def quote(self, symbol):
+        start = time.perf_counter()
+        quote = self._price(symbol.upper(), self._tape_time())
+        self._simulate_round_trip(start)
+        return quote
+
+    def quotes(self, symbols):
+        start = time.perf_counter()
+        at = self._tape_time()
+        quotes = {symbol: self._price(symbol.upper(), at) for symbol in symbols}
+        self._simulate_round_trip(start)
+        return quotes
+
+    def symbols(self):
+        return [(symbol, series[2]) for symbol, series in self._series.items()]
+
+    def max_call_time(self):
+        return self.latency_seconds
+
+
+def _load_tape(path):
+    """Read a tape file into per-symbol columns: (symbol, timestamps, prices, name)."""
+
+    rows = {}
+    with gzip.open(path, "rt", newline="") as tape:
+        for symbol, timestamp, price, name in csv.reader(tape):
+            rows.setdefault(symbol.upper(), []).append((float(timestamp), float(price), name))
+
+    for symbol, ticks in rows.items():
+        ticks.sort()
+        yield symbol, array("d", (tick[0] for tick in ticks)), array("d", (tick[1] for tick in ticks)), ticks[-1][2]
+
+
+def write_tape(path, ticks):
+    """Write (symbol, epoch timestamp, price, name) ticks to a gzip-compressed tape file."""
+    with gzip.open(path, "wt", newline="") as tape:
+        writer = csv.writer(tape)
+        for symbol, timestamp, price, name in ticks:
+            writer.writerow((symbol, f"{timestamp:.3f}", f"{price:.4f}", name))
+
+
+def create_provider(config):
+    """Build the market data provider selected by config["MARKET_DATA_PROVIDER"]."""
+
+    name = config["MARKET_DATA_PROVIDER"]
+
+    if name == "iex":
+        # Make sure API key is set
+        if not config.get("API_KEY"):
+            raise RuntimeError("API_KEY not set")
+        client = MarketDataClient(config["MARKET_DATA_POOL_SIZE"], config["MARKET_DATA_CONNECT_TIMEOUT"],
+                                  config["MARKET_DATA_READ_TIMEOUT"], config["MARKET_DATA_RETRIES"],
+                                  config["MARKET_DATA_BACKOFF"])
+        return IEXProvider(config["API_KEY"], client)
+
+    if name == "replay":
+        if not config.get("MARKET_DATA_TAPE"):
+            raise RuntimeError("MARKET_DATA_TAPE not set")
+        return ReplayProvider(config["MARKET_DATA_TAPE"], config["MARKET_DATA_REPLAY_LATENCY"],
+                              config["MARKET_DATA_REPLAY_SPEED"])
+
+    raise RuntimeError(f"unknown market data provider: {name}")
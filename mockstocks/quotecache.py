@@ -0,0 +1,353 @@
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LeaseTimeout(Exception):
+    """Raised by SharedQuoteCache.get when another worker's refresh of a symbol outlasts its lease."""
+
+
+class _Flight:
+    """A single in-progress upstream load that other callers can wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class QuoteCache:
+    """
+    In-process quote cache with a freshness TTL, a bounded LRU size and
+    single-flight loading, so concurrent misses for one symbol share one load.
+    """
+
+    def __init__(self, ttl=60.0, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+        # symbol -> (fetched_at, quote), least recently used first
+        self._entries = OrderedDict()
+        # symbol -> _Flight for loads that are currently running
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        # Counters used for tuning ttl / maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    def get(self, key, loader, max_age=None):
+        """
+        Return the cached quote for key if it is younger than max_age seconds
+        (defaults to the cache TTL), otherwise load it with loader(key).
+        """
+
+        if max_age is None:
+            max_age = self.ttl
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+            # Join a load that is already running for this symbol, if any
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                flight = _Flight()
+                self._inflight[key] = flight
+                leader = True
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader(key)
+            if flight.value is not None:
+                self.put(key, flight.value)
+            return flight.value
+        except Exception as error:
+            # Waiters fail the same way instead of reading a missing value as "no quote"
+            flight.error = error
+            raise
+        finally:
+            # Wake up waiters even when the loader raised
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    def get_fresh(self, key, max_age=None):
+        """Return the cached quote for key if younger than max_age seconds, else None."""
+
+        if max_age is None:
+            max_age = self.ttl
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def peek(self, key):
+        """Return (age in seconds, quote) for key regardless of freshness, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return time.monotonic() - entry[0], entry[1]
+
+    def put(self, key, value):
+        """Store a freshly fetched quote, evicting the least recently used entries."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every cached quote."""
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        """Return every cached quote as (symbol, fetched_at wall clock time, quote), oldest first."""
+        with self._lock:
+            offset = time.time() - time.monotonic()
+            return [(key, fetched_at + offset, value) for key, (fetched_at, value) in self._entries.items()]
+
+    def restore(self, entries):
+        """
+        Add (symbol, fetched_at wall clock time, quote) entries keeping their
+        real age, so they are only served as fresh while younger than the TTL.
+        Entries older than the cached quote for the same symbol are skipped.
+        """
+        with self._lock:
+            offset = time.time() - time.monotonic()
+            for key, fetched_at, value in sorted(entries, key=lambda entry: entry[1]):
+                fetched_at -= offset
+                current = self._entries.get(key)
+                if current is not None and current[0] >= fetched_at:
+                    continue
+                self._entries[key] = (fetched_at, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Return the cache counters as a dictionary."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+            }
+
+
+class SharedQuoteCache:
+    """
+    Quote cache shared by every worker process on the host, stored in a SQLite file.
+
+    Offers the same interface as QuoteCache. When a symbol goes stale, one
+    worker takes a refresh lease on it and fetches it from upstream while the
+    others wait for the refreshed row instead of fetching it too. The lease
+    should last as long as the slowest upstream call can take, retries
+    included; a waiter still without a row when it runs out gets LeaseTimeout.
+    Entries are evicted oldest-fetched first once maxsize is exceeded.
+    """
+
+    def __init__(self, path, ttl=60.0, maxsize=1024, lease_timeout=10.0, poll_interval=0.05):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+
+        # One connection per thread, sqlite3 connections are not shared across threads
+        self._local = threading.local()
+
+        # Per-process counters used for tuning ttl / maxsize
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+        dbcon = self._connection()
+        dbcon.execute("CREATE TABLE IF NOT EXISTS quotes (symbol TEXT PRIMARY KEY NOT NULL, name TEXT NOT NULL, "
+                      "price REAL NOT NULL, quote_symbol TEXT NOT NULL, fetched_at REAL NOT NULL) WITHOUT ROWID")
+        dbcon.execute("CREATE INDEX IF NOT EXISTS quotes_fetched_at ON quotes (fetched_at)")
+        dbcon.execute("CREATE TABLE IF NOT EXISTS refresh_leases (symbol TEXT PRIMARY KEY NOT NULL, "
+                      "owner TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID")
+        dbcon.commit()
+
+    def _connection(self):
+        """Return this thread's connection to the cache file."""
+        dbcon = getattr(self._local, "dbcon", None)
+        if dbcon is None:
+            dbcon = sqlite3.connect(self.path, timeout=self.lease_timeout, isolation_level=None)
+            dbcon.execute("PRAGMA journal_mode = WAL")
+            dbcon.execute("PRAGMA synchronous = NORMAL")
+            self._local.dbcon = dbcon
+        return dbcon
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def _read(self, key):
+        """Return (fetched_at, quote) for key, or None."""
+        row = self._connection().execute("SELECT name, price, quote_symbol, fetched_at FROM quotes WHERE symbol = ?",
+                                         (key,)).fetchone()
+        if row is None:
+            return None
+        return row[3], {"name": row[0], "price": row[1], "symbol": row[2], "fetched_at": row[3]}
+
+    def _try_lease(self, key, owner):
+        """Take the refresh lease on key unless another live worker holds it."""
+        dbcon = self._connection()
+        now = time.time()
+        dbcon.execute("BEGIN IMMEDIATE")
+        try:
+            lease = dbcon.execute("SELECT expires_at FROM refresh_leases WHERE symbol = ?", (key,)).fetchone()
+            if lease is not None and lease[0] > now:
+                return False
+            dbcon.execute("INSERT OR REPLACE INTO refresh_leases (symbol, owner, expires_at) VALUES (?, ?, ?)",
+                          (key, owner, now + self.lease_timeout))
+            return True
+        finally:
+            dbcon.execute("COMMIT")
+
+    def _release_lease(self, key, owner):
+        self._connection().execute("DELETE FROM refresh_leases WHERE symbol = ? AND owner = ?", (key, owner))
+
+    def get(self, key, loader, max_age=None):
+        """
+        Return the cached quote for key if it is younger than max_age seconds
+        (defaults to the cache TTL), otherwise load it with loader(key) or wait
+        for the worker that is already loading it.
+        """
+
+        if max_age is None:
+            max_age = self.ttl
+
+        value = self.get_fresh(key, max_age)
+        if value is not None:
+            return value
+
+        owner = f"{os.getpid()}:{threading.get_ident()}"
+        deadline = time.time() + self.lease_timeout
+        waited = False
+
+        while True:
+            if self._try_lease(key, owner):
+                try:
+                    value = loader(key)
+                    if value is not None:
+                        self.put(key, value)
+                    return value
+                finally:
+                    self._release_lease(key, owner)
+
+            # Another worker is refreshing this symbol, wait for its result
+            if not waited:
+                self._count("coalesced")
+                waited = True
+            time.sleep(self.poll_interval)
+
+            entry = self._read(key)
+            if entry is not None and time.time() - entry[0] <= max_age:
+                return entry[1]
+            if time.time() > deadline:
+                raise LeaseTimeout(f"refresh of {key} by another worker did not finish in {self.lease_timeout}s")
+
+    def get_fresh(self, key, max_age=None):
+        """Return the cached quote for key if younger than max_age seconds, else None."""
+
+        if max_age is None:
+            max_age = self.ttl
+
+        entry = self._read(key)
+        if entry is not None and time.time() - entry[0] <= max_age:
+            self._count("hits")
+            return entry[1]
+        self._count("misses")
+        return None
+
+    def peek(self, key):
+        """Return (age in seconds, quote) for key regardless of freshness, or None."""
+        entry = self._read(key)
+        if entry is None:
+            return None
+        return time.time() - entry[0], entry[1]
+
+    def put(self, key, value):
+        """Store a freshly fetched quote, evicting the oldest entries beyond maxsize."""
+
+        dbcon = self._connection()
+        dbcon.execute("INSERT OR REPLACE INTO quotes (symbol, name, price, quote_symbol, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                      (key, value["name"], value["price"], value["symbol"], value.get("fetched_at") or time.time()))
+
+        evicted = dbcon.execute("DELETE FROM quotes WHERE symbol IN (SELECT symbol FROM quotes ORDER BY fetched_at DESC "
+                                "LIMIT -1 OFFSET ?)", (self.maxsize,)).rowcount
+        if evicted > 0:
+            self._count("evictions", evicted)
+
+    def clear(self):
+        """Drop every cached quote."""
+        self._connection().execute("DELETE FROM quotes")
+
+    def snapshot(self):
+        """Return every cached quote as (symbol, fetched_at, quote), oldest first."""
+        rows = self._connection().execute("SELECT symbol, name, price, quote_symbol, fetched_at FROM quotes "
+                                          "ORDER BY fetched_at").fetchall()
+        return [(row[0], row[4], {"name": row[1], "price": row[2], "symbol": row[3]}) for row in rows]
+
+    def restore(self, entries):
+        """Add (symbol, fetched_at, quote) entries unless the file already holds a newer quote for the symbol."""
+        dbcon = self._connection()
+        dbcon.execute("BEGIN IMMEDIATE")
+        try:
+            dbcon.executemany("INSERT INTO quotes (symbol, name, price, quote_symbol, fetched_at) VALUES (?, ?, ?, ?, ?) "
+                              "ON CONFLICT (symbol) DO UPDATE SET name = excluded.name, price = excluded.price, "
+                              "quote_symbol = excluded.quote_symbol, fetched_at = excluded.fetched_at "
+                              "WHERE excluded.fetched_at > quotes.fetched_at",
+                              ((key, value["name"], value["price"], value["symbol"], fetched_at)
+                               for key, fetched_at, value in entries))
+        finally:
+            dbcon.execute("COMMIT")
+
+    def stats(self):
+        """Return the cache counters of this process as a dictionary."""
+        size = self._connection().execute("SELECT COUNT(*) FROM quotes").fetchone()[0]
+        with self._lock:
+            return {
+                "size": size,
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+
+
+class Scheduler:
+    """
+    Run periodic batch jobs on a background thread.
+
+    Every worker process may run a scheduler, the scheduled_jobs table makes
+    sure each run of a job happens in only one of them: a worker claims a run
+    by moving the job's last_run forward, and only one claim can succeed.
+    """
+
+    def __init__(self, connect, poll_interval=1.0):
+        # connect() opens a new connection to the database holding scheduled_jobs
+        self.connect = connect
+        self.poll_interval = poll_interval
+
+        # name -> (interval in seconds, job taking a connection)
+        self.jobs = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_job(self, name, interval, job):
+        """Run job(dbcon) every interval seconds."""
+        self.jobs[name] = (interval, job)
+
+    def _claim(self, dbcon, name, interval):
+        """Claim the next run of a job if it is due and no other worker has claimed it."""
+        now = time.time()
+        dbcon.execute("INSERT OR IGNORE INTO scheduled_jobs (name, last_run) VALUES (?, 0)", (name,))
+        claimed = dbcon.execute("UPDATE scheduled_jobs SET last_run = ? WHERE name = ? AND last_run <= ?",
+                                (now, name, now - interval,)).rowcount
+        dbcon.commit()
+        return claimed == 1
+
+    def run_pending(self):
+        """Run every job that is due, returns the names of the jobs that ran."""
+
+        ran = []
+        dbcon = self.connect()
+        try:
+            for name, (interval, job) in self.jobs.items():
+                if not self._claim(dbcon, name, interval):
+                    continue
+                try:
+                    job(dbcon)
+                except Exception:
+                    # A failing job is retried at its next interval, it never stops the others
+                    logging.getLogger(__name__).exception("scheduled job %s failed", name)
+                ran.append(name)
+        finally:
+            dbcon.close()
+        return ran
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_pending()
+            except Exception:
+                logging.getLogger(__name__).exception("scheduler failed")
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        """Start running due jobs on a daemon thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread after its current pass."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,108 @@
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+
+
+class SQLiteSession(SecureCookieSession):
+    """Server-side session whose data lives in the sessions table, keyed by sid."""
+
+    def __init__(self, initial=None, sid=None, new=False, expires_at=0.0):
+        super().__init__(initial)
+        self.sid = sid
+        self.new = new
+        self.expires_at = expires_at
+        # Set by clear() so login/logout get a fresh sid (no session fixation)
+        self.regenerate = False
+
+    def clear(self):
+        super().clear()
+        self.regenerate = True
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """
+    Store sessions in an indexed SQLite table shared by every worker process.
+
+    A row is only written when the session changed (or is about to expire),
+    expired rows are purged in bulk through the expires_at index, and the
+    cookie holds nothing but a random session id.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, path, ttl=86400, purge_interval=300):
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._last_purge = 0.0
+
+        dbcon = self._connection()
+        dbcon.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY NOT NULL, data TEXT NOT NULL, "
+                      "expires_at REAL NOT NULL) WITHOUT ROWID")
+        dbcon.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+
+    def _connection(self):
+        """Return this thread's connection to the session database."""
+        dbcon = getattr(self._local, "dbcon", None)
+        if dbcon is None:
+            dbcon = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            dbcon.execute("PRAGMA journal_mode = WAL")
+            dbcon.execute("PRAGMA synchronous = NORMAL")
+            self._local.dbcon = dbcon
+        return dbcon
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        now = time.time()
+
+        if sid:
+            row = self._connection().execute("SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?",
+                                             (sid, now)).fetchone()
+            if row is not None:
+                return SQLiteSession(self.serializer.loads(row[0]), sid=sid, expires_at=row[1])
+
+        return SQLiteSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        dbcon = self._connection()
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+
+        # Drop the old row when the session was cleared or emptied
+        if (session.regenerate or not session) and not session.new:
+            dbcon.execute("DELETE FROM sessions WHERE sid = ?", (session.sid,))
+            if not session:
+                response.delete_cookie(name, domain=domain, path=path)
+                return
+            session.sid = secrets.token_urlsafe(32)
+            session.new = True
+
+        if not session:
+            return
+
+        # Only write when something changed, or to slide expiry once half the TTL has passed
+        refresh = session.expires_at - now < self.ttl / 2
+        if session.modified or session.new or refresh:
+            dbcon.execute("INSERT OR REPLACE INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)",
+                          (session.sid, self.serializer.dumps(dict(session)), now + self.ttl))
+
+        if session.new:
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+        if now - self._last_purge > self.purge_interval:
+            self._last_purge = now
+            self.purge_expired(now)
+
+    def purge_expired(self, now=None):
+        """Delete every expired session in one indexed statement, returns the number removed."""
+        return self._connection().execute("DELETE FROM sessions WHERE expires_at <= ?",
+                                          (now or time.time(),)).rowcount
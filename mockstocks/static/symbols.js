@@ -0,0 +1,28 @@
+// Fills the datalist of every input with a data-autocomplete attribute from /symbols as the user types
+document.querySelectorAll("input[data-autocomplete]").forEach(function(input) {
+    let options = document.getElementById(input.getAttribute("list"));
+    let pending = null;
+
+    input.addEventListener("input", function() {
+        let query = input.value.trim();
+        clearTimeout(pending);
+        if (!query) {
+            options.replaceChildren();
+            return;
+        }
+
+        // Waits for a pause in typing instead of searching on every keystroke
+        pending = setTimeout(function() {
+            fetch("/symbols?q=" + encodeURIComponent(query))
+                .then(function(response) { return response.json(); })
+                .then(function(matches) {
+                    options.replaceChildren(...matches.map(function(match) {
+                        let option = document.createElement("option");
+                        option.value = match.symbol;
+                        option.label = match.name;
+                        return option;
+                    }));
+                });
+        }, 150);
+    });
+});
@@ -0,0 +1,171 @@
+import bisect
+import click
+import csv
+import helpers
+import os
+import tempfile
+import threading
+import time
+
+from array import array
+
+
+class _Listing:
+    """
+    One immutable load of the listing file as sorted arrays.
+
+    symbols is sorted, names is aligned with it. name_keys holds the lower
+    cased company names, sorted, and name_rows the position in symbols of
+    each of them, so both kinds of prefix search are a bisect plus a slice.
+    """
+
+    def __init__(self, rows, mtime=None):
+        rows = sorted(dict(rows).items())
+        self.symbols = [row[0] for row in rows]
+        self.names = [row[1] for row in rows]
+
+        by_name = sorted((name.lower(), i) for i, name in enumerate(self.names))
+        self.name_keys = [key for key, _ in by_name]
+        self.name_rows = array("I", (i for _, i in by_name))
+
+        self.mtime = mtime
+
+
+def _prefix_range(keys, prefix):
+    """Return the (start, end) slice of the sorted keys starting with prefix."""
+    start = bisect.bisect_left(keys, prefix)
+    return start, bisect.bisect_left(keys, prefix + "\uffff", start)
+
+
+def read_listing(path):
+    """Read (symbol, company name) rows from a listing CSV with a symbol,name header."""
+    with open(path, newline="", encoding="utf-8") as listing:
+        return [(row["symbol"].strip().upper(), row["name"].strip())
+                for row in csv.DictReader(listing) if row.get("symbol") and row["symbol"].strip()]
+
+
+def write_listing(path, rows):
+    """Atomically replace the listing file with (symbol, company name) rows."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=".symbols-", suffix=".csv")
+    try:
+        with os.fdopen(fd, "w", newline="", encoding="utf-8") as listing:
+            writer = csv.writer(listing)
+            writer.writerow(("symbol", "name"))
+            writer.writerows(sorted(rows))
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+class SymbolIndex:
+    """
+    In-memory reference index of listed symbols, loaded from a local listing file.
+
+    Validates tickers and answers ticker / company name prefix searches
+    without any upstream call. The file's modification time is checked at
+    most every check_interval seconds; a changed file is loaded into a new
+    listing which replaces the old one in a single assignment, so readers
+    never see a half loaded index. Without a listing file every ticker is
+    treated as possibly valid.
+    """
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+
+        self._listing = None
+        self._checked_at = 0.0
+        self._reload_lock = threading.Lock()
+        self._refresh()
+
+    def _refresh(self):
+        """Load the listing file again if it changed since the last load."""
+
+        # Only one thread reloads, the others keep using the current listing meanwhile
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except (OSError, TypeError):
+                self._listing = None
+                return
+            if self._listing is None or self._listing.mtime != mtime:
+                self._listing = _Listing(read_listing(self.path), mtime)
+        finally:
+            self._reload_lock.release()
+
+    def listing(self):
+        """Return the current listing, reloading it first when the file may have changed."""
+        if time.monotonic() - self._checked_at > self.check_interval:
+            self._refresh()
+        return self._listing
+
+    def loaded(self):
+        """True when a listing file is available to validate against."""
+        return self.listing() is not None
+
+    def get(self, symbol):
+        """Return (symbol, company name) for an exactly matching ticker, or None."""
+        listing = self.listing()
+        if listing is None:
+            return None
+        symbol = symbol.strip().upper()
+        i = bisect.bisect_left(listing.symbols, symbol)
+        if i < len(listing.symbols) and listing.symbols[i] == symbol:
+            return listing.symbols[i], listing.names[i]
+        return None
+
+    def valid(self, symbol):
+        """False only for tickers the listing positively does not contain."""
+        return not self.loaded() or self.get(symbol) is not None
+
+    def search(self, query, limit=10):
+        """
+        Return up to limit {"symbol", "name"} matches for query: tickers
+        starting with it first, then companies whose name starts with it.
+        """
+
+        listing = self.listing()
+        query = query.strip()
+        if listing is None or not query:
+            return []
+
+        start, end = _prefix_range(listing.symbols, query.upper())
+        rows = list(range(start, min(end, start + limit)))
+
+        if len(rows) < limit:
+            start, end = _prefix_range(listing.name_keys, query.lower())
+            for j in range(start, end):
+                i = listing.name_rows[j]
+                if i not in rows:
+                    rows.append(i)
+                    if len(rows) == limit:
+                        break
+
+        return [{"symbol": listing.symbols[i], "name": listing.names[i]} for i in rows]
+
+    def __len__(self):
+        listing = self.listing()
+        return len(listing.symbols) if listing is not None else 0
+
+
+def init_symbols_app(app):
+    """Validate tickers against the local listing and register the listing update CLI command on app."""
+
+    index = SymbolIndex(app.config["SYMBOL_LISTING"], app.config["SYMBOL_LISTING_CHECK_INTERVAL"])
+    helpers.configure_symbol_index(index)
+
+    @app.cli.command("update-symbols")
+    def update_symbols_command():
+        """Replace the local symbol listing with the market data provider's reference list."""
+        rows = helpers.provider.symbols()
+        if not rows:
+            raise click.ClickException("the market data provider returned no symbols")
+        write_listing(app.config["SYMBOL_LISTING"], rows)
+        click.echo(f"Wrote {len(rows)} symbols to {app.config['SYMBOL_LISTING']}")
+
+    return index
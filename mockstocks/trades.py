@@ -0,0 +1,99 @@
+import datetime
+
+from analytics import record_buy_basis, record_sell_basis
+from db import immediate_transaction
+from helpers import to_cents
+from valuations import record_trade
+
+
+class TradeError(Exception):
+    """Raised when an order cannot be executed; the message is shown to the user."""
+
+
+def _timestamp():
+    """Return the current time formatted for the history table."""
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def apply_buy(dbcon, user_id, symbol, company, shares, price):
+    """
+    Apply a buy inside the caller's transaction.
+
+    Cash is only taken if the user can afford the whole order, so the account
+    can never be overdrawn. Raises TradeError otherwise. Money is stored in
+    integer cents, price is the quoted price in dollars.
+    """
+
+    price = to_cents(price)
+    cost = shares * price
+
+    # Subtracts the total cost from the user's cash, only if they can afford it
+    updated = dbcon.execute("UPDATE users SET cash = cash - ? WHERE id = ? AND cash >= ?",
+                            (cost, user_id, cost,))
+    if updated.rowcount != 1:
+        raise TradeError("insufficient funds")
+
+    # Adds the shares to the user's existing holding, or creates it
+    dbcon.execute("INSERT INTO portfolio (user_id, symbol, company, total_shares) VALUES (?, ?, ?, ?) "
+                  "ON CONFLICT (user_id, symbol) DO UPDATE SET total_shares = total_shares + excluded.total_shares",
+                  (user_id, symbol, company, shares,))
+
+    # Record stock purchase in history table
+    dbcon.execute("INSERT INTO history (user_id, order_type, ticker, shares, price, timestamp) VALUES(?, ?, ?, ?, ?, ?)",
+                  (user_id, 'buy', symbol, shares, price, _timestamp(),))
+
+    # Adds the purchase to the holding's cost basis
+    record_buy_basis(dbcon, user_id, symbol, shares, price)
+
+    # Revalue the holding and the account in the valuation snapshot
+    record_trade(dbcon, user_id, symbol, price)
+
+
+def apply_sell(dbcon, user_id, symbol, shares, price):
+    """
+    Apply a sell inside the caller's transaction.
+
+    Shares are only removed if the user holds enough of them. Raises TradeError
+    otherwise. Price is the quoted price in dollars, stored as integer cents.
+    """
+
+    price = to_cents(price)
+
+    # Removes the shares from the user's holding, only if they own enough
+    updated = dbcon.execute("UPDATE portfolio SET total_shares = total_shares - ? "
+                            "WHERE user_id = ? AND symbol = ? AND total_shares >= ?",
+                            (shares, user_id, symbol, shares,))
+    if updated.rowcount != 1:
+        owned = dbcon.execute("SELECT total_shares FROM portfolio WHERE user_id = ? AND symbol = ?",
+                              (user_id, symbol,)).fetchone()
+        if not owned or owned[0] <= 0:
+            raise TradeError("you do not own any shares of this stock")
+        raise TradeError("not enough shares to complete transaction")
+
+    # Drops the holding once it is sold out, so portfolio only ever lists open positions
+    dbcon.execute("DELETE FROM portfolio WHERE user_id = ? AND symbol = ? AND total_shares = 0", (user_id, symbol,))
+
+    # Adds cash gains to user's total cash in account
+    dbcon.execute("UPDATE users SET cash = cash + ? WHERE id = ?", (shares * price, user_id,))
+
+    # Record transaction into history table
+    dbcon.execute("INSERT INTO history (user_id, order_type, ticker, shares, price, timestamp) VALUES(?, ?, ?, ?, ?, ?)",
+                  (user_id, 'sell', symbol, shares, price, _timestamp(),))
+
+    # Takes the sold shares out of the holding's cost basis, realizing the gain or loss
+    record_sell_basis(dbcon, user_id, symbol, shares, price)
+
+    # Revalue the holding and the account in the valuation snapshot
+    record_trade(dbcon, user_id, symbol, price)
+
+
+def execute_buy(dbcon, user_id, symbol, company, shares, price):
+    """Execute a market buy as a single transaction with one commit."""
+    with immediate_transaction(dbcon):
+        apply_buy(dbcon, user_id, symbol, company, shares, price)
+
+
+def execute_sell(dbcon, user_id, symbol, shares, price):
+    """Execute a market sell as a single transaction with one commit."""
+    with immediate_transaction(dbcon):
+        apply_sell(dbcon, user_id, symbol, shares, price)
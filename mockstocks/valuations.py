@@ -0,0 +1,237 @@
+import click
+import logging
+import queue
+import threading
+import time
+
+from db import connect_app, immediate_transaction
+from helpers import add_price_listener, to_cents
+
+
+## Account valuation snapshots, kept up to date incrementally so the dashboard is one indexed read. ##
+## Trades revalue their holding as they happen; every fetched price is applied by reprice() on      ##
+## the Repricer's background thread, which is registered as a price listener.                       ##
+##   symbol_prices  - last fetched price (cents) of every symbol and when it was fetched             ##
+##   holding_values - shares, price and value (cents) of every open position                        ##
+##   account_values - cash and total market value (cents) of every account                           ##
+
+# Columns returned by DASHBOARD_QUERY, in this order
+dashboard_username_ind, dashboard_cash_ind, dashboard_market_value_ind, dashboard_symbol_ind, dashboard_company_ind, \
+    dashboard_shares_ind, dashboard_price_ind, dashboard_value_ind, dashboard_priced_at_ind, dashboard_cost_ind = range(10)
+
+# Everything the dashboard shows for one user, including each holding's average-cost basis (see analytics.py)
+DASHBOARD_QUERY = ("SELECT u.username, a.cash, a.market_value, h.symbol, h.company, h.shares, h.price, h.value, p.priced_at, b.cost "
+                   "FROM users u "
+                   "LEFT JOIN account_values a ON a.user_id = u.id "
+                   "LEFT JOIN holding_values h ON h.user_id = u.id "
+                   "LEFT JOIN symbol_prices p ON p.symbol = h.symbol "
+                   "LEFT JOIN holding_basis b ON b.user_id = h.user_id AND b.symbol = h.symbol "
+                   "WHERE u.id = ? ORDER BY h.symbol ASC")
+
+
+def refresh_account(dbcon, user_id):
+    """Recompute one account's cash and market value from its holding snapshots."""
+    dbcon.execute("INSERT OR REPLACE INTO account_values (user_id, cash, market_value, priced_at) "
+                  "SELECT u.id, u.cash, (SELECT COALESCE(SUM(value), 0) FROM holding_values WHERE user_id = u.id), ? "
+                  "FROM users u WHERE u.id = ?", (time.time(), user_id,))
+
+
+def record_trade(dbcon, user_id, symbol, price):
+    """
+    Update the snapshots after a trade, inside the trade's transaction.
+
+    The changed holding is revalued at the trade price (in cents) and the
+    account's cash and market value are recomputed.
+    """
+
+    held = dbcon.execute("SELECT company, total_shares FROM portfolio WHERE user_id = ? AND symbol = ?",
+                         (user_id, symbol,)).fetchone()
+
+    if held and held[1] > 0:
+        dbcon.execute("INSERT OR REPLACE INTO holding_values (user_id, symbol, company, shares, price, value) "
+                      "VALUES (?, ?, ?, ?, ?, ?)", (user_id, symbol, held[0], held[1], price, held[1] * price,))
+    else:
+        dbcon.execute("DELETE FROM holding_values WHERE user_id = ? AND symbol = ?", (user_id, symbol,))
+
+    refresh_account(dbcon, user_id)
+
+
+def reprice(dbcon, quotes):
+    """
+    Apply freshly fetched quotes ({symbol: quote}) to every snapshot holding those symbols.
+
+    Prices are stamped with the quote's own fetch time, a quote no newer than
+    the stored price is skipped, and holdings and accounts are only rewritten
+    when a price actually changed.
+    """
+
+    with immediate_transaction(dbcon):
+        for symbol, quote in quotes.items():
+            if quote is None or quote.get("stale"):
+                continue
+            price = to_cents(quote["price"])
+            fetched_at = quote.get("fetched_at") or time.time()
+
+            newer = dbcon.execute("INSERT INTO symbol_prices (symbol, price, priced_at) VALUES (?, ?, ?) "
+                                  "ON CONFLICT (symbol) DO UPDATE SET price = excluded.price, priced_at = excluded.priced_at "
+                                  "WHERE excluded.priced_at > symbol_prices.priced_at",
+                                  (symbol, price, fetched_at,)).rowcount
+            if not newer:
+                continue
+
+            changed = dbcon.execute("UPDATE holding_values SET price = ?, value = shares * ? WHERE symbol = ? AND price IS NOT ?",
+                                    (price, price, symbol, price,)).rowcount
+            if changed:
+                dbcon.execute("UPDATE account_values SET market_value = (SELECT COALESCE(SUM(value), 0) FROM holding_values h "
+                              "WHERE h.user_id = account_values.user_id), priced_at = ? "
+                              "WHERE user_id IN (SELECT user_id FROM holding_values WHERE symbol = ?)", (fetched_at, symbol,))
+
+
+class Repricer:
+    """
+    Background writer applying fetched prices to the snapshots.
+
+    Quotes are queued by the price listener and written on one thread with a
+    pooled connection, so lookups never wait on the database. Batches queued
+    while one is being written are merged into a single transaction, keeping
+    the newest quote of each symbol.
+    """
+
+    def __init__(self, pool):
+        # Connection pool of the app (see db.ConnectionPool), one connection is held per transaction
+        self.pool = pool
+
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def on_prices(self, quotes):
+        """Price listener: queue fresh quotes for the repricer thread, never blocks the lookup."""
+        # Dropped while the thread is not running, nothing would take them off the queue
+        if self._thread is not None:
+            self._queue.put(quotes)
+
+    def apply(self, quotes):
+        """Write quotes to the snapshots and wait until they are, on the calling thread if the repricer is stopped."""
+        if self._thread is not None:
+            self._queue.put(quotes)
+            self._queue.join()
+            return
+        dbcon = self.pool.acquire()
+        try:
+            reprice(dbcon, quotes)
+        finally:
+            self.pool.release(dbcon)
+
+    def _drain(self, first):
+        """Merge first with every batch queued behind it, returns (quotes, batches taken, stop requested)."""
+        merged = {}
+        taken, stop = 0, False
+        batch = first
+        while True:
+            taken += 1
+            if batch is None:
+                stop = True
+            else:
+                for symbol, quote in batch.items():
+                    if quote is None or quote.get("stale"):
+                        continue
+                    current = merged.get(symbol)
+                    if current is None or quote.get("fetched_at", 0) >= current.get("fetched_at", 0):
+                        merged[symbol] = quote
+            try:
+                batch = self._queue.get_nowait()
+            except queue.Empty:
+                return merged, taken, stop
+
+    def _loop(self):
+        while True:
+            quotes, taken, stop = self._drain(self._queue.get())
+            try:
+                if quotes:
+                    dbcon = self.pool.acquire()
+                    try:
+                        reprice(dbcon, quotes)
+                    finally:
+                        self.pool.release(dbcon)
+            except Exception:
+                logging.getLogger(__name__).exception("snapshot repricing failed")
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def start(self):
+        """Start repricing on a daemon thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="valuation-repricer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the repricer thread once the queued quotes are written."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def _user_filter(column, user_id, keyword="WHERE"):
+    """Return (clause, params) restricting column to user_id, or an empty clause for everyone (user_id None)."""
+    if user_id is None:
+        return "", ()
+    return f"{keyword} {column} = ?", (user_id,)
+
+
+def fill_snapshots(dbcon, user_id=None):
+    """
+    Recompute snapshots from portfolio and history inside the caller's transaction,
+    for one user or (user_id None) everyone.
+
+    Positions come from portfolio. Each holding is priced at the symbol's last
+    fetched price, or failing that the holder's own last trade of it.
+    """
+
+    where, params = _user_filter("user_id", user_id)
+    dbcon.execute(f"DELETE FROM holding_values {where}", params)
+    dbcon.execute(f"DELETE FROM account_values {where}", params)
+
+    # The fallback price is one seek on history_user_ticker_timestamp per holding without a fetched price
+    where, params = _user_filter("p.user_id", user_id, "AND")
+    dbcon.execute("INSERT INTO holding_values (user_id, symbol, company, shares, price, value) "
+                  "SELECT user_id, symbol, company, total_shares, price, total_shares * price FROM ("
+                  "  SELECT p.user_id, p.symbol, p.company, p.total_shares, COALESCE(q.price, ("
+                  "    SELECT h.price FROM history h WHERE h.user_id = p.user_id AND h.ticker = p.symbol "
+                  "    ORDER BY h.timestamp DESC, h.transaction_id DESC LIMIT 1)) AS price "
+                  "  FROM portfolio p LEFT JOIN symbol_prices q ON q.symbol = p.symbol "
+                  f"  WHERE p.total_shares > 0 {where})", params)
+
+    where, params = _user_filter("u.id", user_id)
+    dbcon.execute("INSERT INTO account_values (user_id, cash, market_value, priced_at) "
+                  "SELECT u.id, u.cash, (SELECT COALESCE(SUM(value), 0) FROM holding_values WHERE user_id = u.id), ? "
+                  f"FROM users u {where}", (time.time(), *params))
+
+
+def rebuild(dbcon, user_id=None):
+    """Recompute snapshots for one user or (user_id None) everyone in a single transaction."""
+    with immediate_transaction(dbcon):
+        fill_snapshots(dbcon, user_id)
+
+
+def init_valuations_app(app):
+    """Reprice the snapshots with every fetched price on a background thread and register the rebuild CLI command on app."""
+
+    repricer = Repricer(app.extensions["db_pool"])
+    add_price_listener(repricer.on_prices)
+    repricer.start()
+
+    @app.cli.command("rebuild-valuations")
+    def rebuild_valuations_command():
+        """Recompute every account valuation snapshot from portfolio and history."""
+        dbcon = connect_app(app)
+        try:
+            rebuild(dbcon)
+        finally:
+            dbcon.close()
+        click.echo("Valuation snapshots rebuilt")
+
+    return repricer
@@ -0,0 +1,123 @@
+import atexit
+import gzip
+import helpers
+import json
+import logging
+import os
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+
+## Warm start: a new worker begins with the last known quotes and warmed database connections ##
+## instead of cold caches. The quote snapshot is a gzipped JSON file of                        ##
+##   {"saved_at": wall clock time, "quotes": [[symbol, fetched_at, quote], ...]}                ##
+## written periodically and at shutdown. Quotes keep their real age when loaded, so only       ##
+## those still younger than the cache TTL are served as fresh; older ones are the last known   ##
+## prices served when the upstream is out of budget or down.                                  ##
+
+
+def read_quote_snapshot(path, max_age):
+    """Return the (symbol, fetched_at, quote) entries of the snapshot at path younger than max_age seconds."""
+
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as snapshot:
+            entries = json.load(snapshot)["quotes"]
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError, KeyError, TypeError):
+        logging.getLogger(__name__).warning("ignoring unreadable quote snapshot %s", path)
+        return []
+
+    oldest = time.time() - max_age
+    return [(symbol, fetched_at, quote) for symbol, fetched_at, quote in entries if fetched_at >= oldest]
+
+
+def save_quote_snapshot(path, cache, max_age):
+    """
+    Merge the quotes held by cache into the snapshot at path, keeping the
+    newest quote per symbol and dropping those older than max_age seconds.
+    The file is replaced atomically. Returns the number of quotes saved.
+    """
+
+    newest = {}
+    for symbol, fetched_at, quote in read_quote_snapshot(path, max_age) + cache.snapshot():
+        if symbol not in newest or newest[symbol][0] < fetched_at:
+            newest[symbol] = (fetched_at, quote)
+
+    oldest = time.time() - max_age
+    entries = sorted(([symbol, fetched_at, quote] for symbol, (fetched_at, quote) in newest.items() if fetched_at >= oldest),
+                     key=lambda entry: entry[1])[-cache.maxsize:]
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=".quotes-", suffix=".json.gz")
+    try:
+        with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as snapshot:
+            json.dump({"saved_at": time.time(), "quotes": entries}, snapshot)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+    return len(entries)
+
+
+class StartupTimer:
+    """Durations of the named startup phases of one app, exposed on /metrics."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self.elapsed = None
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as phase name."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def finish(self):
+        """Record the total startup time, from creating the timer until now."""
+        self.elapsed = time.perf_counter() - self.started
+
+    def report(self):
+        """One line summary, slowest phase first."""
+        return f"started in {self.elapsed * 1000:.1f}ms: " + ", ".join(
+            f"{name} {seconds * 1000:.1f}ms" for name, seconds in sorted(self.phases, key=lambda phase: -phase[1]))
+
+    def metrics(self):
+        """Return the phase durations as a metric family for /metrics."""
+        return [("mockstocks_startup_seconds", "gauge", "Time spent in each startup phase of this worker.",
+                 [({"phase": name}, seconds) for name, seconds in self.phases + [("total", self.elapsed)]])]
+
+
+def init_warm_start_app(app, scheduler, timer, statements):
+    """
+    Warm app up before its first request: load the quote snapshot into the
+    quote cache and prepare statements on every pooled connection. The
+    snapshot is saved again every QUOTE_SNAPSHOT_INTERVAL seconds and at exit.
+    """
+
+    path, max_age = app.config["QUOTE_SNAPSHOT_PATH"], app.config["QUOTE_SNAPSHOT_MAX_AGE"]
+
+    if path:
+        with timer.phase("quote snapshot"):
+            entries = read_quote_snapshot(path, max_age)
+            helpers.quote_cache.restore(entries)
+        app.logger.info("restored %d quotes from %s", len(entries), path)
+
+        def save(dbcon=None):
+            try:
+                save_quote_snapshot(path, helpers.quote_cache, max_age)
+            except OSError:
+                logging.getLogger(__name__).exception("saving the quote snapshot failed")
+
+        if app.config["QUOTE_SNAPSHOT_INTERVAL"] > 0:
+            scheduler.add_job("quote-snapshot", app.config["QUOTE_SNAPSHOT_INTERVAL"], save)
+        atexit.register(save)
+
+    with timer.phase("prepare statements"):
+        app.extensions["db_pool"].warm(statements)